@@ -0,0 +1,99 @@
+import sys
+import os.path
+import json
+import subprocess
+import timeit
+from argparse import ArgumentParser, SUPPRESS
+
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Importing safe_string curses str.__add__ for the whole interpreter. Time
+# string concatenations in a fresh interpreter without safe_string and in one
+# with it, to see what every other str + str of the process pays for it.
+#
+#   python bench_concat.py
+#
+# "a + b" is usually specialized by the bytecode and never reaches the cursed
+# slot. operator.add (and any add the interpreter doesn't specialize, e.g.
+# the first executions of a function) always goes through it.
+
+PLAIN_CASES = {
+    "a + b": "a + b",
+    "operator.add(a, b)": "add(a, b)",
+    "s += b (loop of 100)": "s = a\nfor _ in r: s += b",
+}
+
+# only measured with safe_string imported
+SAFE_CASES = {
+    "a + safe": "a + safe",
+    "safe + a": "safe + a",
+    "safe + safe": "safe + safe",
+    "operator.add(a, safe)": "add(a, safe)",
+}
+
+SETUP = """
+from operator import add
+a = "SELECT * FROM users WHERE name = "
+b = "'alice'"
+r = range(100)
+"""
+
+SAFE_SETUP = """
+sys.path.append("../safe_string")
+from safe_string import safe_string
+safe = safe_string(b, [False] * 2 + [True] * (len(b) - 2))
+"""
+
+
+def worker(with_safe_string, number, repeat):
+    "Time the cases in this interpreter and print them as json."
+    setup = SETUP
+    cases = dict(PLAIN_CASES)
+    if with_safe_string:
+        setup += SAFE_SETUP
+        cases.update(SAFE_CASES)
+    namespace = {"sys": sys}
+    exec(setup, namespace)
+    results = {}
+    for name, stmt in cases.items():
+        timer = timeit.Timer(stmt, globals=namespace)
+        results[name] = min(timer.repeat(repeat, number)) / number
+    print(json.dumps(results))
+
+
+def run_worker(with_safe_string, number, repeat):
+    args = [sys.executable, os.path.basename(__file__), "--worker",
+            "--number", str(number), "--repeat", str(repeat)]
+    if with_safe_string:
+        args.append("--safe-string")
+    output = subprocess.run(args, check=True, capture_output=True, text=True).stdout
+    return json.loads(output)
+
+
+def main():
+    parser = ArgumentParser(description="Interpreter wide overhead of the cursed str.__add__.")
+    parser.add_argument("--number", type=int, default=200_000)
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--worker", action="store_true", help=SUPPRESS)
+    parser.add_argument("--safe-string", action="store_true", help=SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args.safe_string, args.number, args.repeat)
+        return
+
+    plain = run_worker(False, args.number, args.repeat)
+    cursed = run_worker(True, args.number, args.repeat)
+
+    print(f"{'case':>24} {'plain (ns)':>12} {'cursed (ns)':>12} {'ratio':>7}")
+    for name, seconds in cursed.items():
+        if name in plain:
+            print(f"{name:>24} {plain[name] * 1e9:>12.1f} {seconds * 1e9:>12.1f} "
+                  f"{seconds / plain[name]:>7.2f}")
+        else:
+            print(f"{name:>24} {'':>12} {seconds * 1e9:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+import sys
+import os.path
+import timeit
+
+os.chdir(os.path.dirname(__file__))
+
+sys.path.append("../safe_string")
+from safe_string import safe_string, orig_str_format, orig_str_mod
+
+
+# Compare safe_string.format and % against plain str.format and % on the same
+# template. The overhead should be a small constant factor, and objects with an
+# expensive __format__/__repr__ should only be rendered once.
+
+class Expensive:
+    def __format__(self, spec):
+        return format(sum(range(2000)), spec)
+
+    def __repr__(self):
+        return repr(sum(range(2000)))
+
+    def __str__(self):
+        return str(sum(range(2000)))
+
+
+template = "SELECT * FROM users WHERE name = '{name}' AND id = {0} AND note = {1!r:>10}"
+safe_template = safe_string._new_trusted(template)
+user_input = safe_string._new_untrusted("bobby")
+
+cases = [
+    ("cheap args", (5, "abc"), {"name": user_input}),
+    ("expensive args", (Expensive(), Expensive()), {"name": user_input}),
+]
+
+number = 20_000
+print(f"{'case':>15} {'str.format (us)':>16} {'safe (us)':>10} {'ratio':>6}")
+for name, args, kwargs in cases:
+    plain = timeit.timeit(lambda: orig_str_format(template, *args, **kwargs),
+                          number=number) / number
+    safe = timeit.timeit(lambda: safe_template.format(*args, **kwargs),
+                         number=number) / number
+    print(f"{name:>15} {plain * 1e6:>16.2f} {safe * 1e6:>10.2f} {safe / plain:>6.2f}")
+
+
+mod_template = "SELECT * FROM users WHERE name = '%(name)s' AND id = %(id)d AND note = %(note)10r"
+safe_mod_template = safe_string._new_trusted(mod_template)
+positional_template = "SELECT * FROM users WHERE name = '%s' AND id = %4d AND note = %-10s"
+safe_positional_template = safe_string._new_trusted(positional_template)
+
+mod_cases = [
+    ("cheap mapping", mod_template, safe_mod_template, {"name": user_input, "id": 5, "note": "abc"}),
+    ("cheap tuple", positional_template, safe_positional_template, (user_input, 5, "abc")),
+    ("expensive tuple", positional_template, safe_positional_template, (Expensive(), 5, Expensive())),
+]
+
+print()
+print(f"{'case':>15} {'str % (us)':>16} {'safe (us)':>10} {'ratio':>6}")
+for name, template, safe_template, values in mod_cases:
+    plain = timeit.timeit(lambda: orig_str_mod(template, values), number=number) / number
+    safe = timeit.timeit(lambda: safe_template % values, number=number) / number
+    print(f"{name:>15} {plain * 1e6:>16.2f} {safe * 1e6:>10.2f} {safe / plain:>6.2f}")
@@ -0,0 +1,79 @@
+import ast
+import sys
+import os.path
+import timeit
+
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.append("../safe_string")
+import safe_string as safe_string_module
+from safe_string import safe_string
+from parsing import transform_tree
+
+
+# Compare f-strings of a module uninstrumented, rewritten to their
+# precompiled FStringFormatter, and rewritten to the equivalent .format of a
+# trusted template (parsed once and then taken from the format cache). The
+# rewritten f-strings should stay within a small constant factor of plain.
+
+SAMPLE = '''
+def simple(name, id):
+    return f"SELECT * FROM users WHERE name = '{name}' AND id = {id}"
+
+
+def specs(name, id):
+    return f"{name!r:>20} {id:08.3f} {id:#x}"
+
+
+def nested(name, width):
+    return f"{name:>{width}} {width = }"
+
+
+def simple_format(name, id):
+    return "SELECT * FROM users WHERE name = '{}' AND id = {}".format(name, id)
+
+
+def specs_format(name, id):
+    return "{!r:>20} {:08.3f} {:#x}".format(name, id, id)
+
+
+def nested_format(name, width):
+    return "{:>{}} width = {!r}".format(name, width, width)
+'''
+
+
+def load(rewrite):
+    tree = ast.parse(SAMPLE)
+    if rewrite:
+        transform_tree(tree, "__safe_string__")
+    namespace = {"__safe_string__": safe_string_module}
+    exec(compile(tree, "<sample>", "exec"), namespace)
+    return namespace
+
+
+plain = load(False)
+rewritten = load(True)
+name = "bobby"
+safe_name = safe_string("bo'by", [True, True, False, True, True])
+
+cases = [
+    ("simple", (name, 5)),
+    ("simple, safe arg", (safe_name, 5)),
+    ("specs", (name, 5)),
+    ("specs, safe arg", (safe_name, 5)),
+    ("nested", (name, 12)),
+]
+
+number = 20_000
+print(f"{'case':>18} {'f-string (us)':>14} {'formatter (us)':>15} {'ratio':>6} "
+      f"{'.format (us)':>13} {'ratio':>6}")
+for case, args in cases:
+    function = case.split(",")[0]
+    times = []
+    for namespace, name in ((plain, function), (rewritten, function),
+                            (rewritten, function + "_format")):
+        times.append(min(timeit.repeat(lambda: namespace[name](*args),
+                                       number=number, repeat=5)) / number)
+    fstring, formatter, format_ = times
+    print(f"{case:>18} {fstring * 1e6:>14.2f} {formatter * 1e6:>15.2f} {formatter / fstring:>6.2f} "
+          f"{format_ * 1e6:>13.2f} {format_ / fstring:>6.2f}")
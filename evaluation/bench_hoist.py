@@ -0,0 +1,89 @@
+import ast
+import sys
+import os.path
+import timeit
+
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.append("../safe_string")
+import safe_string as safe_string_module
+from safe_string import safe_string
+from parsing import transform_tree
+
+
+# Time a loop heavy module uninstrumented, with its literals wrapped where
+# they are (a new trusted safe_string each time a literal is evaluated) and
+# with its literals hoisted to module globals (one safe_string per distinct
+# literal, created when the module is run). Also count the safe_strings
+# created by the literals during one call.
+
+SAMPLE = '''
+def build_queries(rows):
+    queries = []
+    for row in rows:
+        columns = []
+        for key, value in row.items():
+            if value is None:
+                columns.append(key + " IS NULL")
+            else:
+                columns.append(key + " = " + "'" + value + "'")
+        queries.append("SELECT * FROM users WHERE " + " AND ".join(columns))
+    return queries
+
+
+def classify(words):
+    counts = {"short": 0, "long": 0}
+    for word in words:
+        if len(word) < 5:
+            counts["short"] += 1
+        else:
+            counts["long"] += 1
+        word.startswith("x") or word.endswith("ing")
+    return counts
+'''
+
+rows = [{"name": "bob", "city": "paris", "email": None}] * 100
+words = ["alpha", "beta", "coding", "xray", "on"] * 100
+
+
+def load(rewrite, hoist=True):
+    tree = ast.parse(SAMPLE)
+    if rewrite:
+        transform_tree(tree, "__safe_string__", hoist)
+    namespace = {"__safe_string__": safe_string_module}
+    exec(compile(tree, "<sample>", "exec"), namespace)
+    return namespace
+
+
+def created_per_call(namespace, name, arg):
+    count = 0
+    new_trusted = safe_string._new_trusted
+
+    def counting(string):
+        nonlocal count
+        count += 1
+        return new_trusted(string)
+
+    safe_string._new_trusted = staticmethod(counting)
+    try:
+        namespace[name](arg)
+    finally:
+        safe_string._new_trusted = staticmethod(new_trusted)
+    return count
+
+
+variants = {
+    "plain": load(False),
+    "inline": load(True, hoist=False),
+    "hoisted": load(True),
+}
+
+number = 50
+print(f"{'function':>15} {'variant':>8} {'time (us)':>10} {'ratio':>6} {'literals created':>17}")
+for name, arg in (("build_queries", rows), ("classify", words)):
+    plain = None
+    for variant, namespace in variants.items():
+        seconds = min(timeit.repeat(lambda: namespace[name](arg), number=number, repeat=5)) / number
+        plain = plain or seconds
+        created = created_per_call(namespace, name, arg)
+        print(f"{name:>15} {variant:>8} {seconds * 1e6:>10.1f} {seconds / plain:>6.2f} {created:>17}")
@@ -0,0 +1,28 @@
+import sys
+import os.path
+import timeit
+
+os.chdir(os.path.dirname(__file__))
+
+sys.path.append("../safe_string")
+from safe_string import safe_string
+
+
+# Joining the fragments of a bulk INSERT should scale linearly with the
+# number of fragments: the time per element should stay flat.
+
+sep = safe_string._new_trusted(", ")
+row = safe_string._new_trusted("(1, '{}')")
+
+print(f"{'elements':>10} {'total (ms)':>12} {'per elem (us)':>15}")
+for num_elems in (1_000, 10_000, 100_000):
+    values = [
+        row.format("user input {}".format(i)) if i % 2 else "plain {}".format(i)
+        for i in range(num_elems)
+    ]
+    number = max(1, 100_000 // num_elems)
+    total = timeit.timeit(lambda: sep.join(values), number=number) / number
+    print(f"{num_elems:>10} {total * 1e3:>12.2f} {total / num_elems * 1e6:>15.3f}")
+
+    generated = timeit.timeit(lambda: sep.join(v for v in values), number=number) / number
+    print(f"{'(generator)':>10} {generated * 1e3:>12.2f} {generated / num_elems * 1e6:>15.3f}")
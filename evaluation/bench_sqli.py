@@ -0,0 +1,51 @@
+import sys
+import os.path
+import timeit
+
+import sqlparse
+
+os.chdir(os.path.dirname(__file__))
+
+sys.path.append("../safe_string")
+from safe_string import safe_string
+from safe_sql import has_sqli
+
+
+# Compare has_sqli, which runs on the sql_lexer tokens, against checking the
+# tokens of sqlparse's full parse tree, on the payload corpora.
+
+def sqlparse_has_sqli(query):
+    start_idx = 0
+    for statement in sqlparse.parse(query):
+        for token in statement.flatten():
+            end_idx = start_idx + len(token.value)
+            if token.ttype not in sqlparse.tokens.Literal and \
+                    token.ttype not in sqlparse.tokens.Whitespace:
+                if not query._trusted[start_idx:end_idx].all():
+                    return True
+            start_idx = end_idx
+    return False
+
+
+def read_payloads(name):
+    with open(name) as fp:
+        return [line.rstrip("\n") for line in fp]
+
+
+templates = {
+    "payload_string.csv": "SELECT * FROM people WHERE name = '{}' ORDER BY id",
+    "payload_numeric.csv": "SELECT * FROM people WHERE id = {} ORDER BY id",
+}
+
+queries = []
+for name, template in templates.items():
+    template = safe_string._new_trusted(template)
+    queries += [template.format(payload) for payload in read_payloads(name)]
+
+mismatches = sum(bool(has_sqli(query)) != sqlparse_has_sqli(query) for query in queries)
+print(f"{len(queries)} queries, {mismatches} different verdicts")
+
+number = 5
+for name, check in [("sqlparse", sqlparse_has_sqli), ("sql_lexer", has_sqli)]:
+    elapsed = timeit.timeit(lambda: [check(query) for query in queries], number=number)
+    print(f"{name:>10}: {elapsed / number / len(queries) * 1e6:8.1f} us/query")
@@ -0,0 +1,182 @@
+import sys
+import os.path
+import json
+import random
+import timeit
+from argparse import ArgumentParser
+
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.append("../safe_string")
+from safe_string import safe_string, orig_str_add, orig_str_format
+from trust import TrustMap
+
+
+# Time every safe_string override against the plain str method, for several
+# string sizes and trust patterns, and compare the overhead ratios with the
+# stored baselines so that regressions show up.
+#
+#   python bench_str_methods.py                  # run and compare with the baselines
+#   python bench_str_methods.py --save           # store the ratios as the new baselines
+#   python bench_str_methods.py --sizes 10 1000  # only some sizes
+
+BASELINES = "baselines/bench_str_methods.json"
+
+SIZES = [10, 1_000, 100_000, 10_000_000]
+
+safe_template = safe_string._new_trusted("x {} y {!r:>20}")
+
+# name -> (plain str version, safe_string version, largest size)
+# The plain versions call the original str methods where safe_string patches str.
+CASES = {
+    "__add__": (lambda s: orig_str_add(s, s), lambda s: s + s, None),
+    "__mul__": (lambda s: s * 3, lambda s: s * 3, None),
+    "__getitem__ index": (lambda s: s[len(s) // 2], lambda s: s[len(s) // 2], None),
+    "__getitem__ slice": (lambda s: s[1:-1], lambda s: s[1:-1], None),
+    "__getitem__ step": (lambda s: s[::3], lambda s: s[::3], 100_000),
+    "__iter__": (lambda s: list(s), lambda s: list(s), 100_000),
+    "__repr__": (repr, repr, None),
+    "split": (lambda s: s.split(), lambda s: s.split(), None),
+    "split sep": (lambda s: s.split(" "), lambda s: s.split(" "), None),
+    "rsplit": (lambda s: s.rsplit(None, 10), lambda s: s.rsplit(None, 10), None),
+    "splitlines": (lambda s: s.splitlines(), lambda s: s.splitlines(), None),
+    "partition": (lambda s: s.partition("\n"), lambda s: s.partition("\n"), None),
+    "replace": (lambda s: s.replace("a", "bc"), lambda s: s.replace("a", "bc"), None),
+    "expandtabs": (lambda s: s.expandtabs(), lambda s: s.expandtabs(), None),
+    "strip": (lambda s: s.strip("ab"), lambda s: s.strip("ab"), None),
+    "center": (lambda s: s.center(len(s) + 20), lambda s: s.center(len(s) + 20), None),
+    "format": (lambda s: orig_str_format("x {} y {!r:>20}", s, s),
+               lambda s: safe_template.format(s, s), None),
+    "join": (lambda parts: " ".join(parts), lambda parts: safe_string._new_trusted(" ").join(parts), None),
+    "upper": (str.upper, safe_string.upper, None),
+    "lower": (str.lower, safe_string.lower, None),
+    "title": (str.title, safe_string.title, None),
+    "capitalize": (str.capitalize, safe_string.capitalize, None),
+    "swapcase": (str.swapcase, safe_string.swapcase, None),
+    "casefold": (str.casefold, safe_string.casefold, None),
+}
+
+
+def gen_text(size, rng):
+    "Words, with some tabs and newlines."
+    words = []
+    length = 0
+    while length < size:
+        word = "".join(rng.choices("abcdefghij", k=rng.randint(1, 8)))
+        words.append(word)
+        words.append(rng.choice(" " * 8 + "\t\n"))
+        length += len(word) + 1
+    return "".join(words)[:size]
+
+
+def gen_trust(pattern, size, rng):
+    if pattern == "trusted":
+        return TrustMap.trusted(size)
+    if pattern == "untrusted":
+        return TrustMap.untrusted(size)
+    if pattern == "alternating":
+        # runs of 10 chars, like values interleaved with a template
+        return TrustMap.from_bits([i // 10 % 2 == 0 for i in range(size)])
+    if pattern == "random":
+        return TrustMap.from_bits(rng.getrandbits(1) for _ in range(size))
+    raise ValueError(pattern)
+
+
+PATTERNS = ["trusted", "untrusted", "alternating", "random"]
+
+
+def best_time(func, arg, min_time):
+    """
+    Best time per call of 3 measurements, each running for at least min_time.
+    Calls taking more than a second are only measured once.
+    """
+    timer = timeit.Timer(lambda: func(arg))
+    number = 1
+    elapsed = timer.timeit(number)
+    if elapsed > 1:
+        return elapsed
+    while elapsed < min_time:
+        number *= 2
+        elapsed = timer.timeit(number)
+    return min([elapsed] + timer.repeat(2, number)) / number
+
+
+def run(sizes, cases, min_time):
+    rng = random.Random(0)
+    results = {}
+    for size in sizes:
+        text = gen_text(size, rng)
+        for pattern in PATTERNS:
+            safe = safe_string(text, gen_trust(pattern, size, rng))
+            # pieces for join: every 10 chars, alternating safe and plain
+            plain_parts = [text[i:i + 10] for i in range(0, size, 10)]
+            safe_parts = [safe[i:i + 10] if i % 20 == 0 else text[i:i + 10] for i in range(0, size, 10)]
+
+            for name in cases:
+                plain_func, safe_func, max_size = CASES[name]
+                if max_size is not None and size > max_size:
+                    continue
+                if name == "join":
+                    plain_arg, safe_arg = plain_parts, safe_parts
+                else:
+                    plain_arg, safe_arg = text, safe
+
+                plain_time = best_time(plain_func, plain_arg, min_time)
+                safe_time = best_time(safe_func, safe_arg, min_time)
+                key = f"{name}/{size}/{pattern}"
+                results[key] = {"plain": plain_time, "safe": safe_time, "ratio": safe_time / plain_time}
+                print(f"{name:>18} {size:>9} {pattern:>11} {plain_time * 1e6:>12.2f} "
+                      f"{safe_time * 1e6:>12.2f} {safe_time / plain_time:>9.1f}", flush=True)
+    return results
+
+
+def compare(results, baselines, tolerance):
+    "Keys whose ratio got worse than the baseline by more than `tolerance`."
+    regressions = []
+    for key, result in results.items():
+        baseline = baselines.get(key)
+        if baseline is not None and result["ratio"] > baseline["ratio"] * (1 + tolerance):
+            regressions.append((key, baseline["ratio"], result["ratio"]))
+    return regressions
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark the safe_string overrides against str.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--cases", nargs="+", default=list(CASES), choices=list(CASES), metavar="CASE")
+    parser.add_argument("--min-time", type=float, default=0.05,
+                        help="minimum seconds per measurement")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="allowed relative increase of the overhead ratio")
+    parser.add_argument("--save", action="store_true", help="store the results as the baselines")
+    args = parser.parse_args()
+
+    print(f"{'case':>18} {'size':>9} {'trust':>11} {'str (us)':>12} {'safe (us)':>12} {'ratio':>9}")
+    results = run(args.sizes, args.cases, args.min_time)
+
+    if args.save:
+        baselines = {}
+        if os.path.exists(BASELINES):
+            with open(BASELINES) as fp:
+                baselines = json.load(fp)
+        baselines.update(results)
+        os.makedirs(os.path.dirname(BASELINES), exist_ok=True)
+        with open(BASELINES, "w") as fp:
+            json.dump(baselines, fp, indent=1, sort_keys=True)
+        print(f"saved {len(results)} baselines to {BASELINES}")
+        return
+
+    if not os.path.exists(BASELINES):
+        print("no baselines stored, run with --save")
+        return
+    with open(BASELINES) as fp:
+        regressions = compare(results, json.load(fp), args.tolerance)
+    for key, baseline, ratio in regressions:
+        print(f"REGRESSION {key}: ratio {ratio:.1f}, baseline {baseline:.1f}")
+    if regressions:
+        sys.exit(1)
+    print("no regressions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+import ast
+from fnmatch import fnmatchcase
+
+# Find the code of a program which can build the queries run by the
+# execute methods guarded by safe_execute, so that only that code is
+# rewritten (see rec.py --selective) and the rest keeps native str speed.
+#
+# A module is split into regions: its functions, the methods of its
+# classes (with the functions nested in them) and its other top level and
+# class level statements. The call graph between the regions is built by
+# name, without type inference: a call of f(...) or x.f(...) is a call of
+# every region which defines the name f. This over approximates the calls,
+# which only rewrites more code than needed.
+#
+# The selected regions are:
+# - the regions which reach a sink: they call one of the sink methods, or a
+#   region which reaches a sink (they build the queries or pass them down),
+# - the regions which feed them: the regions defining a name which flows
+#   into the arguments of those calls (the functions returning pieces of
+#   the queries, the constants), and the regions feeding what they return,
+# - the regions matching the allow patterns and the regions feeding them,
+# and never the regions matching the deny patterns. A name flows into an
+# expression if it is used in it or in the value of a local variable used
+# in it (without regard to the order of the statements).
+
+# the methods guarded by safe_execute (execute_funcs of the sync and async drivers)
+SINK_METHODS = frozenset((
+    "execute", "executemany",
+    "execute_fetchall", "execute_insert",
+    "fetch", "fetchrow", "fetchval",
+))
+
+# methods called through the class name
+_constructors = frozenset(("__init__", "__new__"))
+
+
+def regions(tree):
+    """
+    Yield the (key, scope, node) of the regions of a parsed module. The key
+    of a function or method is its qualified name, the key of another
+    statement is "<scope>:<line>". The scope is the qualified name of the
+    class of a class level region, "" at the top level.
+    """
+    yield from _body_regions(tree.body, "")
+
+
+def _body_regions(body, scope):
+    for node in body:
+        if isinstance(node, ast.ClassDef):
+            yield from _body_regions(node.body, _qualname(scope, node.name))
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            yield _qualname(scope, node.name), scope, node
+        else:
+            yield "{}:{}".format(scope or "<module>", node.lineno), scope, node
+
+
+def _qualname(scope, name):
+    return "{}.{}".format(scope, name) if scope else name
+
+
+def _import_aliases(tree):
+    "The names imported under another name at the top level: {alias: name}."
+    aliases = {}
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                if alias.asname is not None:
+                    aliases[alias.asname] = alias.name.rpartition(".")[2]
+    return aliases
+
+
+def _names(node, aliases):
+    "The names used by an expression: variables, functions and attributes."
+    names = set()
+    for child in ast.walk(node):
+        if isinstance(child, ast.Name) and isinstance(child.ctx, ast.Load):
+            names.add(aliases.get(child.id, child.id))
+        elif isinstance(child, ast.Attribute):
+            names.add(child.attr)
+    return names
+
+
+def _callee(call):
+    func = call.func
+    if isinstance(func, ast.Name):
+        return func.id
+    if isinstance(func, ast.Attribute):
+        return func.attr
+    return None
+
+
+class _Flows:
+    "The local variables of a region and the names flowing into them."
+
+    def __init__(self, node, aliases):
+        self.aliases = aliases
+        self.assigned = {}
+        for child in ast.walk(node):
+            if isinstance(child, ast.Assign):
+                self._add(child.targets, child.value)
+            elif isinstance(child, (ast.AugAssign, ast.AnnAssign)) and child.value is not None:
+                self._add([child.target], child.value)
+            elif isinstance(child, (ast.For, ast.AsyncFor, ast.comprehension)):
+                self._add([child.target], child.iter)
+            elif isinstance(child, ast.NamedExpr):
+                self._add([child.target], child.value)
+            elif isinstance(child, ast.withitem) and child.optional_vars is not None:
+                self._add([child.optional_vars], child.context_expr)
+
+    def _add(self, targets, value):
+        names = _names(value, self.aliases)
+        for target in targets:
+            for child in ast.walk(target):
+                if isinstance(child, ast.Name):
+                    self.assigned.setdefault(child.id, set()).update(names)
+
+    def into(self, nodes):
+        "The names flowing into the expressions `nodes`."
+        names = set()
+        for node in nodes:
+            names |= _names(node, self.aliases)
+        stack = list(names)
+        while stack:
+            for name in self.assigned.get(stack.pop(), ()):
+                if name not in names:
+                    names.add(name)
+                    stack.append(name)
+        return names
+
+
+def summarize(tree, module):
+    """
+    Summarize the regions of a parsed module for `select`: a list of
+    (key, dotted name, defined names, calls, returned names, sink) tuples.
+    The defined names include the attributes the region sets, the returned
+    names what flows into its returns and into those attributes. `calls` maps the names of the called functions to the names flowing
+    into their arguments, `sink` is the names flowing into the arguments of
+    the sink methods (None if the region calls none). `module` is the
+    dotted name of the module.
+    """
+    aliases = _import_aliases(tree)
+    summary = []
+    for key, scope, node in regions(tree):
+        flows = _Flows(node, aliases)
+        calls = {}
+        sink = None
+        returns = []
+        defines = set()
+        attributes = set()
+        for child in ast.walk(node):
+            if isinstance(child, ast.Call):
+                callee = _callee(child)
+                if callee is None:
+                    continue
+                arguments = child.args + [keyword.value for keyword in child.keywords]
+                names = flows.into(arguments)
+                if isinstance(child.func, ast.Attribute) and callee in SINK_METHODS:
+                    sink = (sink or set()) | names
+                callee = aliases.get(callee, callee)
+                calls[callee] = calls.get(callee, set()) | names
+            elif isinstance(child, (ast.Return, ast.Yield, ast.YieldFrom)) and child.value is not None:
+                returns.append(child.value)
+            elif isinstance(child, ast.Name) and not isinstance(child.ctx, ast.Load):
+                defines.add(child.id)
+            elif isinstance(child, ast.Attribute) and isinstance(child.ctx, ast.Store):
+                # self.query = ...: read back as an attribute by other regions
+                attributes.add(child.attr)
+            elif isinstance(child, (ast.Assign, ast.AugAssign, ast.AnnAssign)) and child.value is not None:
+                targets = child.targets if isinstance(child, ast.Assign) else [child.target]
+                if any(isinstance(target, ast.Attribute)
+                       for target_node in targets for target in ast.walk(target_node)):
+                    # what is stored in an attribute comes out of the region like a return
+                    returns.append(child.value)
+            elif isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                defines.add(child.name)
+
+        class_name = scope.rpartition(".")[2]
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            # the local variables of a function aren't visible to the others,
+            # the attributes it sets are
+            defines = {node.name} | attributes
+            if class_name and node.name in _constructors:
+                defines.add(class_name)
+            name = _qualname(module, key)
+            returns = flows.into(returns)
+        else:
+            # a statement provides everything it computes
+            defines |= attributes
+            if class_name:
+                defines.add(class_name)
+            name = _qualname(module, scope)
+            returns = _names(node, aliases)
+        summary.append((key, name, sorted(defines),
+                        {callee: sorted(names) for callee, names in calls.items()},
+                        sorted(returns), None if sink is None else sorted(sink)))
+    return summary
+
+
+def matches(patterns, name):
+    """
+    True if one of the glob `patterns` matches the dotted `name` or one of
+    its parents ("app.db" matches "app.db.Queries.get").
+    """
+    parts = name.split(".")
+    for end in range(len(parts), 0, -1):
+        prefix = ".".join(parts[:end])
+        for pattern in patterns:
+            if fnmatchcase(prefix, pattern):
+                return True
+    return False
+
+
+def select(summaries, allow=(), deny=()):
+    """
+    The regions to rewrite, from the summaries of the modules of a program
+    ({module: summarize(...)}). Returns {module: set of region keys}.
+    """
+    nodes = []
+    definers = {}
+    callers = {}
+    for module, summary in summaries.items():
+        for key, name, defines, calls, returns, sink in summary:
+            index = len(nodes)
+            nodes.append((module, key, name, defines, calls, returns, sink))
+            for defined in defines:
+                definers.setdefault(defined, []).append(index)
+            for callee in calls:
+                callers.setdefault(callee, []).append(index)
+
+    reaching = _closure(
+        [index for index, node in enumerate(nodes) if node[6] is not None],
+        lambda index: (caller for defined in nodes[index][3] for caller in callers.get(defined, ())))
+    reaching_names = {defined for index in reaching for defined in nodes[index][3]}
+
+    # the names flowing into the queries, from the regions which reach a sink
+    # and from the allowed regions
+    flows = {}
+    for index in reaching:
+        calls, sink = nodes[index][4], nodes[index][6]
+        names = set(sink or ())
+        for callee, arguments in calls.items():
+            if callee in reaching_names:
+                names.update(arguments)
+        flows[index] = names
+    for index, node in enumerate(nodes):
+        if allow and matches(allow, node[2]):
+            flows.setdefault(index, set()).update(
+                node[5], *node[4].values())
+
+    def feeders(index):
+        names = flows[index] if index in flows else nodes[index][5]
+        return (definer for name in names for definer in definers.get(name, ()))
+
+    selected = _closure(flows, feeders)
+
+    result = {module: set() for module in summaries}
+    for index in selected:
+        module, key, name = nodes[index][:3]
+        if not (deny and matches(deny, name)):
+            result[module].add(key)
+    return result
+
+
+def _closure(seeds, neighbours):
+    "The nodes reachable from `seeds` (included) through `neighbours(node)`."
+    reached = set(seeds)
+    stack = list(reached)
+    while stack:
+        for neighbour in neighbours(stack.pop()):
+            if neighbour not in reached:
+                reached.add(neighbour)
+                stack.append(neighbour)
+    return reached
@@ -0,0 +1,230 @@
+import ast
+import importlib.machinery
+import importlib.util
+import marshal
+import os
+import os.path
+import runpy
+import sys
+import sysconfig
+import types
+from argparse import ArgumentParser, REMAINDER
+
+try:
+    from . import safe_string, safe_execute
+    from .parsing import transform_tree, transform_version
+except ImportError:
+    import safe_string
+    import safe_execute
+    from parsing import transform_tree, transform_version
+
+# Instrument modules when they are imported, instead of rewriting a copy of
+# the source tree with rec.py:
+#
+#   from safe_string import import_hook
+#   import_hook.install(paths=["/srv/app"])
+#   import app
+#
+# or run a script or module with:
+#
+#   python -m safe_string.import_hook [--path DIR] [--package NAME] (script.py | -m module) [args]
+#
+# Importing this module guards the database drivers (safe_execute). The
+# rewritten code refers to safe_string through a global of this name, which
+# the loader sets before running the module, so the modules need no imports.
+module_global = "__safe_string__"
+
+# Rewritten code is cached next to the normal bytecode, in
+# __pycache__/<module>.<cache tag>.opt-waspy<version>.pyc, with the hash of
+# the source like hash based pycs (PEP 552). A cached file is only used if
+# the source hash and the version of the rewriting match.
+_cache_optimization = "waspy{}".format(transform_version)
+_hash_pyc_flags = 0b11  # hash based, checked
+
+_own_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def cache_path(source_path):
+    "Path of the cached rewritten code of a source file."
+    optimization = _cache_optimization
+    if sys.flags.optimize:
+        optimization += "o{}".format(sys.flags.optimize)
+    return importlib.util.cache_from_source(source_path, optimization=optimization)
+
+
+def _read_cache(path, source_hash):
+    try:
+        with open(path, "rb") as fp:
+            data = fp.read()
+    except OSError:
+        return None
+    magic = importlib.util.MAGIC_NUMBER
+    if (data[:4] != magic or int.from_bytes(data[4:8], "little") != _hash_pyc_flags
+            or data[8:16] != source_hash):
+        return None
+    try:
+        return marshal.loads(data[16:])
+    except (EOFError, ValueError, TypeError):
+        return None
+
+
+def _write_cache(path, source_hash, code):
+    data = (importlib.util.MAGIC_NUMBER + _hash_pyc_flags.to_bytes(4, "little")
+            + source_hash + marshal.dumps(code))
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, "wb") as fp:
+            fp.write(data)
+        os.replace(tmp_path, path)
+    except OSError:
+        # read only source trees: rewrite on every import
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+
+
+def compile_source(data, path):
+    "Rewrite and compile the source of a module (bytes or str)."
+    tree = ast.parse(data, path)
+    transform_tree(tree, module_global)
+    return compile(tree, path, "exec", dont_inherit=True)
+
+
+class SafeStringLoader(importlib.machinery.SourceFileLoader):
+    "Loads a source module with its str literals rewritten to trusted safe_strings."
+
+    def get_code(self, fullname):
+        source_path = self.get_filename(fullname)
+        data = self.get_data(source_path)
+        source_hash = importlib.util.source_hash(data)
+        path = cache_path(source_path)
+
+        code = _read_cache(path, source_hash)
+        if code is None:
+            code = compile_source(data, source_path)
+            if not sys.dont_write_bytecode:
+                _write_cache(path, source_hash, code)
+        return code
+
+    def exec_module(self, module):
+        setattr(module, module_global, safe_string)
+        super().exec_module(module)
+
+
+class SafeStringFinder:
+    """
+    Meta path finder which has the modules found by the path based finder
+    loaded by SafeStringLoader if they are in one of the packages `packages`
+    or their file is under one of the directories `paths`.
+    The standard library, the installed packages and safe_string itself are
+    never rewritten.
+    """
+
+    def __init__(self, paths=(), packages=()):
+        self.paths = tuple(os.path.join(os.path.abspath(path), "") for path in paths)
+        self.packages = tuple(packages)
+        excluded = {_own_dir}
+        for name in ("stdlib", "platstdlib", "purelib", "platlib"):
+            path = sysconfig.get_paths().get(name)
+            if path:
+                excluded.add(path)
+        self.excluded = tuple(os.path.join(path, "") for path in excluded)
+
+    def selected(self, fullname, origin):
+        "True if the module `fullname` at the path `origin` must be rewritten."
+        origin = os.path.abspath(origin)
+        if origin.startswith(self.excluded):
+            return False
+        for package in self.packages:
+            if fullname == package or fullname.startswith(package + "."):
+                return True
+        return origin.startswith(self.paths)
+
+    def find_spec(self, fullname, path=None, target=None):
+        spec = importlib.machinery.PathFinder.find_spec(fullname, path, target)
+        if (spec is None or type(spec.loader) is not importlib.machinery.SourceFileLoader
+                or not self.selected(fullname, spec.origin)):
+            # this finder is right before the path based finder, which
+            # would find the same spec
+            return spec
+        spec.loader = SafeStringLoader(fullname, spec.origin)
+        spec.cached = cache_path(spec.origin)
+        return spec
+
+    def invalidate_caches(self):
+        pass
+
+
+def install(paths=None, packages=()):
+    """
+    Rewrite the modules imported from now on which are under one of the
+    directories `paths` (by default the current directory) or in one of the
+    packages `packages`. Returns the finder, see `uninstall`.
+    Modules which are already imported are not rewritten.
+    """
+    if paths is None:
+        paths = () if packages else (os.getcwd(),)
+    finder = SafeStringFinder(paths, packages)
+    # after the builtin and frozen module importers
+    index = len(sys.meta_path)
+    for i, meta_finder in enumerate(sys.meta_path):
+        if meta_finder is importlib.machinery.PathFinder:
+            index = i
+            break
+    sys.meta_path.insert(index, finder)
+    return finder
+
+
+def uninstall(finder=None):
+    "Stop rewriting imported modules (only those of `finder` if given)."
+    sys.meta_path[:] = [meta_finder for meta_finder in sys.meta_path
+                        if not (isinstance(meta_finder, SafeStringFinder)
+                                and (finder is None or meta_finder is finder))]
+
+
+def run_path(path, argv=()):
+    "Run a script as __main__ with its str literals rewritten."
+    with open(path, "rb") as fp:
+        code = compile_source(fp.read(), path)
+    main = types.ModuleType("__main__")
+    main.__file__ = path
+    main.__builtins__ = __builtins__
+    setattr(main, module_global, safe_string)
+    sys.modules["__main__"] = main
+    sys.argv = [path] + list(argv)
+    exec(code, main.__dict__)
+
+
+def main():
+    parser = ArgumentParser(description="Run a python script or module with safe_string instrumentation.")
+    parser.add_argument("--path", dest="paths", action="append",
+                        help="rewrite the modules under this directory (default: the script's directory)")
+    parser.add_argument("--package", dest="packages", action="append", default=[],
+                        help="rewrite the modules of this package")
+    parser.add_argument("-m", dest="module", help="run a module, like python -m")
+    parser.add_argument("args", nargs=REMAINDER)
+    args = parser.parse_args()
+
+    if args.module is None and not args.args:
+        parser.error("a script or -m module is required")
+
+    if args.module is not None:
+        paths = args.paths if args.paths is not None else [os.getcwd()]
+        install(paths, args.packages)
+        sys.argv = [args.module] + args.args
+        # runpy executes the code of the loader without its exec_module
+        runpy.run_module(args.module, init_globals={module_global: safe_string},
+                         run_name="__main__", alter_sys=True)
+    else:
+        script = args.args[0]
+        script_dir = os.path.dirname(os.path.abspath(script))
+        paths = args.paths if args.paths is not None else [script_dir]
+        install(paths, args.packages)
+        sys.path.insert(0, script_dir)
+        run_path(script, args.args[1:])
+
+
+if __name__ == "__main__":
+    main()
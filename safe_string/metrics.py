@@ -0,0 +1,194 @@
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import threading
+
+# Metrics of the guarded execute calls, per driver class.
+# Recording is off by default: the guard then only checks `enabled`.
+enabled = False
+
+latency_buckets = (1e-6, 5e-6, 1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 1e-2, 5e-2, 0.1, 1.0)
+length_buckets = (16, 64, 256, 1024, 4096, 16384, 65536, 262144)
+
+_lock = threading.Lock()
+_drivers = {}  # driver name -> DriverMetrics
+
+
+class Histogram:
+    "Counts of observed values per bucket (value <= upper bound), with their sum."
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        "(upper bound, number of values <= bound) for each bucket and +Inf."
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            yield bound, total
+
+
+class DriverMetrics:
+    __slots__ = ("calls", "detections", "check_seconds", "lex_seconds",
+                 "trust_check_seconds", "query_length")
+
+    def __init__(self):
+        self.calls = 0
+        self.detections = 0
+        self.check_seconds = Histogram(latency_buckets)
+        self.lex_seconds = Histogram(latency_buckets)
+        self.trust_check_seconds = Histogram(latency_buckets)
+        self.query_length = Histogram(length_buckets)
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    "Forget everything recorded so far."
+    with _lock:
+        _drivers.clear()
+
+
+def driver_name(class_):
+    return "{}.{}".format(class_.__module__, class_.__qualname__)
+
+
+def record(class_, length, detected, lex_seconds, trust_check_seconds, check_seconds):
+    "Record one guarded call of a method of the driver class `class_`."
+    name = driver_name(class_)
+    with _lock:
+        metrics = _drivers.get(name)
+        if metrics is None:
+            metrics = _drivers[name] = DriverMetrics()
+        metrics.calls += 1
+        metrics.detections += bool(detected)
+        metrics.check_seconds.observe(check_seconds)
+        metrics.lex_seconds.observe(lex_seconds)
+        metrics.trust_check_seconds.observe(trust_check_seconds)
+        metrics.query_length.observe(length)
+
+
+def snapshot():
+    """
+    The recorded metrics as a dict: driver name -> calls, detections and, for each
+    histogram, a dict with its buckets (upper bound -> count of values <= bound),
+    sum and count.
+    """
+    result = {}
+    with _lock:
+        for name, metrics in _drivers.items():
+            result[name] = {"calls": metrics.calls, "detections": metrics.detections}
+            for attr in _histograms:
+                histogram = getattr(metrics, attr)
+                result[name][attr] = {
+                    "buckets": dict(histogram.cumulative()),
+                    "sum": histogram.sum,
+                    "count": histogram.count,
+                }
+    return result
+
+
+_counters = {
+    "calls": "Guarded calls of the driver's execute methods.",
+    "detections": "Sql injections detected by the guard.",
+}
+
+_histograms = {
+    "check_seconds": "Time spent in the guard per call.",
+    "lex_seconds": "Time spent lexing the query per call.",
+    "trust_check_seconds": "Time spent checking the trust of the query per call.",
+    "query_length": "Length of the checked queries, in characters.",
+}
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value)
+
+
+def _escape_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def to_prometheus(prefix="safe_string_guard"):
+    "The recorded metrics in the Prometheus text exposition format."
+    drivers = snapshot()
+    lines = []
+    for attr, help_text in _counters.items():
+        name = "{}_{}_total".format(prefix, attr)
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} counter".format(name))
+        for driver, metrics in drivers.items():
+            lines.append('{}{{driver="{}"}} {}'.format(name, _escape_label(driver), metrics[attr]))
+
+    for attr, help_text in _histograms.items():
+        name = "{}_{}".format(prefix, attr)
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} histogram".format(name))
+        for driver, metrics in drivers.items():
+            driver = _escape_label(driver)
+            histogram = metrics[attr]
+            for bound, count in histogram["buckets"].items():
+                lines.append('{}_bucket{{driver="{}",le="{}"}} {}'.format(
+                    name, driver, _format_value(bound), count))
+            lines.append('{}_sum{{driver="{}"}} {}'.format(name, driver, _format_value(histogram["sum"])))
+            lines.append('{}_count{{driver="{}"}} {}'.format(name, driver, histogram["count"]))
+
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path, prefix="safe_string_guard"):
+    """
+    Write the metrics to `path` in the Prometheus text format, replacing the
+    file atomically (e.g. for node_exporter's textfile collector).
+    """
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as fp:
+        fp.write(to_prometheus(prefix))
+    os.replace(tmp_path, path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = to_prometheus(self.server.prefix).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_prometheus(port=9464, host="127.0.0.1", prefix="safe_string_guard"):
+    """
+    Serve the metrics over http at /metrics from a daemon thread.
+    Returns the server, call its `shutdown()` to stop it.
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.prefix = prefix
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="safe_string-metrics", daemon=True).start()
+    return server
@@ -4,11 +4,23 @@ import ast
 import os
 import os.path
 
+try:
+    from .callgraph import regions
+except ImportError:
+    from callgraph import regions
 
-def _wrap(node):
+
+# Bump whenever the rewriting changes: code rewritten by an older version
+# (e.g. cached by the import hook) is then rewritten again.
+transform_version = 3
+
+
+def _wrap(node, module_name="safe_string"):
     return ast.Call(
-        func=ast.Attribute(value=ast.Name(id="safe_string", ctx=ast.Load()),
-                           attr="safe_string._new_trusted", ctx=ast.Load()),
+        func=ast.Attribute(
+            value=ast.Attribute(value=ast.Name(id=module_name, ctx=ast.Load()),
+                                attr="safe_string", ctx=ast.Load()),
+            attr="_new_trusted", ctx=ast.Load()),
         args=[
             node
         ],
@@ -16,49 +28,202 @@ def _wrap(node):
     )
 
 
+# names assigned lists of identifiers, whose str literals are left as they are
+_identifier_lists = {"__all__", "__slots__", "__match_args__"}
+
+# prefix of the module globals holding the hoisted trusted literals (no
+# leading double underscore, it would be mangled in class bodies)
+_constant_prefix = "_waspy_str_"
+_formatter_prefix = "_waspy_fstr_"
+
+
+def _formatter(parts, module_name):
+    "FStringFormatter(parts)"
+    return ast.Call(
+        func=ast.Attribute(value=ast.Name(id=module_name, ctx=ast.Load()),
+                           attr="FStringFormatter", ctx=ast.Load()),
+        args=[ast.Constant(value=parts)],
+        keywords=[],
+    )
+
+
+def _docstring(body):
+    if (body and isinstance(body[0], ast.Expr) and isinstance(body[0].value, ast.Constant)
+            and isinstance(body[0].value.value, str)):
+        return body[0].value
+    return None
+
+
+def _body_start(module):
+    "Index of the first statement of a module after its docstring and __future__ imports."
+    index = 1 if _docstring(module.body) is not None else 0
+    while (index < len(module.body) and isinstance(module.body[index], ast.ImportFrom)
+           and module.body[index].module == "__future__"):
+        index += 1
+    return index
+
+
+def plain_constants(tree):
+    """
+    The str literals of `tree` which must stay str: docstrings, annotations,
+    match patterns, identifier keys of dict displays and the values of
+    __all__ and __slots__.
+    """
+    plain = []
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Module, ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)):
+            docstring = _docstring(node.body)
+            if docstring is not None:
+                plain.append(docstring)
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and node.returns is not None:
+            plain.extend(ast.walk(node.returns))
+        elif isinstance(node, ast.arg) and node.annotation is not None:
+            plain.extend(ast.walk(node.annotation))
+        elif isinstance(node, ast.AnnAssign):
+            plain.extend(ast.walk(node.annotation))
+        elif isinstance(node, ast.match_case):
+            plain.extend(ast.walk(node.pattern))
+        elif isinstance(node, ast.Dict):
+            plain.extend(key for key in node.keys
+                         if isinstance(key, ast.Constant) and isinstance(key.value, str)
+                         and key.value.isidentifier())
+
+        if isinstance(node, (ast.Assign, ast.AugAssign, ast.AnnAssign)) and node.value is not None:
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            if any(isinstance(target, ast.Name) and target.id in _identifier_lists
+                   for target in targets):
+                plain.extend(ast.walk(node.value))
+    return {id(node) for node in plain if isinstance(node, ast.Constant)}
+
+
 class SafeStringVisitor(ast.NodeTransformer):
+    """
+    Wrap every str literal in a trusted safe_string.
+    `module_name` is the global name of the safe_string module in the rewritten code.
+
+    In a module, each distinct literal is made a trusted safe_string once, in
+    a global assigned at the top of the module, and the literals are replaced
+    by that global: a literal in a loop doesn't create a safe_string on every
+    iteration. With `hoist=False` (or when visiting something else than a
+    module) the literals are wrapped where they are.
+    The literals listed by `plain_constants` are left as they are.
+
+    F-strings are rewritten to a call of a safe_string.FStringFormatter with
+    their expressions. Like the literals, one formatter is created per
+    distinct f-string in a global when hoisting.
+
+    `select` is the set of keys of the regions of the module to rewrite (see
+    callgraph.regions), None to rewrite the whole module.
+    """
+
+    def __init__(self, module_name="safe_string", hoist=True, select=None):
+        self.module_name = module_name
+        self.hoist = hoist
+        self.select = select
+        self.constants = None
+        self.formatters = None
+        self.plain = set()
+
+    def visit_Module(self, node):
+        self.plain = plain_constants(node)
+        if not self.hoist:
+            return self._visit_selected(node)
+
+        self.constants = {}
+        self.formatters = {}
+        try:
+            self._visit_selected(node)
+            start = _body_start(node)
+            node.body[start:start] = [
+                ast.Assign(targets=[ast.Name(id=name, ctx=ast.Store())],
+                           value=_wrap(ast.Constant(value=value), self.module_name))
+                for value, name in self.constants.items()
+            ] + [
+                ast.Assign(targets=[ast.Name(id=name, ctx=ast.Store())],
+                           value=_formatter(parts, self.module_name))
+                for parts, name in self.formatters.items()
+            ]
+        finally:
+            self.constants = self.formatters = None
+        return node
+
+    def _visit_selected(self, node):
+        if self.select is None:
+            return self.generic_visit(node)
+        for key, scope, region in regions(node):
+            if key in self.select:
+                # statements are rewritten in place
+                self.visit(region)
+        return node
+
     def visit_Constant(self, node):
-        if isinstance(node.value, str):
-            return _wrap(node)
-        else:
+        if not isinstance(node.value, str) or id(node) in self.plain:
             return node
+        if self.constants is None:
+            return _wrap(node, self.module_name)
+        name = self.constants.get(node.value)
+        if name is None:
+            name = self.constants[node.value] = "{}{}".format(_constant_prefix, len(self.constants))
+        return ast.copy_location(ast.Name(id=name, ctx=ast.Load()), node)
+
+    def visit_JoinedStr(self, node):
+        # f"..." -> formatter(values...), see safe_string.FStringFormatter
+        if not any(isinstance(child, ast.FormattedValue) for child in node.values):
+            text = "".join(child.value for child in node.values)
+            return self.visit_Constant(ast.copy_location(ast.Constant(value=text), node))
 
-    # def visit_JoinedStr(self, node):
-    #     """
-    #     Cases to take care of:
-
-    #     f'{x}'
-    #     f'{x!r:4d}'
-    #     f'{1 + 2}'
-    #     f'{1 + 2:4d}'
-    #     f'{1 + 2!r:4}'
-    #     f'{foo()!r:4}'
-    #     """
-    #     args = []
-    #     fmt_string = ""
-    #     for child in node.values:
-    #         if not isinstance(child, ast.FormattedValue):
-    #             args.append(child.value)
-
-    #             conv = ""
-    #             for conv_value in ('r', 's', 'a'):
-    #                 if child.conversion == ord(conv_value):
-    #                     conv = "!" + conv_value
-    #                     break
-
-    #             fmt_string += (
-    #                 "{"
-    #                 + conv
-    #                 + "}"
-    #             )
+        values = []
+        parts = self._fstring_parts(node, values)
+        if self.constants is None:
+            formatter = _formatter(parts, self.module_name)
+        else:
+            name = self.formatters.get(parts)
+            if name is None:
+                name = self.formatters[parts] = "{}{}".format(_formatter_prefix, len(self.formatters))
+            formatter = ast.Name(id=name, ctx=ast.Load())
+        return ast.copy_location(ast.Call(func=formatter, args=values, keywords=[]), node)
 
+    def _fstring_parts(self, node, values):
+        "The parts of an f-string for FStringFormatter, appends its rewritten expressions to `values`."
+        parts = []
+        for child in node.values:
+            if isinstance(child, ast.Constant):
+                parts.append(child.value)
+                continue
+            values.append(self.visit(child.value))
+            conv = chr(child.conversion) if child.conversion != -1 else None
+            spec = None
+            if child.format_spec is not None:
+                spec = self._fstring_parts(child.format_spec, values)
+            parts.append((conv, spec))
+        return tuple(parts)
 
-def replace_safe_str(code):
-    tree = ast.parse(code)
-    tree.body.insert(0, ast.Import(names=[ast.alias(name='sys')]))
-    tree.body.insert(1, ast.Import(names=[ast.alias(name='safe_string', asname='safe_string')]))
-    tree.body.insert(2, ast.Import(names=[ast.alias(name='safe_execute')]))
-    SafeStringVisitor().visit(tree)
-    tree.body.insert(1, ast.parse("sys.path.insert(1, \'{path}\')".format(path=os.path.dirname(__file__))))
+
+def transform_tree(tree, module_name="safe_string", hoist=True, select=None):
+    "Rewrite the str literals of a parsed module in place, see SafeStringVisitor."
+    SafeStringVisitor(module_name, hoist, select).visit(tree)
     ast.fix_missing_locations(tree)
-    return ast.unparse(tree)
+    return tree
+
+
+def instrument_module(tree, select=None):
+    """
+    Rewrite the str literals of a parsed module in place (only those of the
+    regions `select` if given), and insert the imports the rewritten code
+    needs at the top.
+    """
+    SafeStringVisitor(select=select).visit(tree)
+    # before the trusted literals, after the docstring and __future__ imports
+    start = _body_start(tree)
+    tree.body[start:start] = [
+        ast.Import(names=[ast.alias(name='sys')]),
+        ast.parse("sys.path.insert(1, \'{path}\')".format(path=os.path.dirname(__file__))).body[0],
+        ast.Import(names=[ast.alias(name='safe_string', asname='safe_string')]),
+        ast.Import(names=[ast.alias(name='safe_execute')]),
+    ]
+    ast.fix_missing_locations(tree)
+    return tree
+
+
+def replace_safe_str(code):
+    return ast.unparse(instrument_module(ast.parse(code)))
@@ -1,40 +1,364 @@
+import ast
 import glob
+import hashlib
+import json
 import os
-from argparse import ArgumentParser
-from parsing import replace_safe_str
+import os.path
 import shutil
+import sys
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from . import callgraph
+    from .parsing import instrument_module, transform_version
+except ImportError:
+    import callgraph
+    from parsing import instrument_module, transform_version
+
+# Rewrite the str literals of a source tree (in place, or into a copy with
+# --out) so that they become trusted safe_strings.
+#
+#   python rec.py app/ --out app_instrumented/ [-j 8] [--quiet]
+#                 [--selective [--allow PATTERN] [--deny PATTERN]]
+#
+# Files are rewritten in parallel by a pool of processes. A manifest in the
+# output directory records the hash of each source and of its rewritten
+# output, so that the next run only rewrites the files which changed:
+# - with --out, the sources whose hash (or size and mtime) didn't change
+#   are skipped.
+# - in place, the files which are still the output of the last rewrite are
+#   skipped, since rewriting them again would wrap the literals twice.
+#
+# With --selective, only the code which can build the queries of the
+# database drivers is rewritten (see callgraph.py). The regions to rewrite
+# are recorded in the manifest too: a file is rewritten again when its
+# regions change because of a change in another file.
+
+MANIFEST = ".waspy-manifest.json"
+PHASES = ("parse", "visit", "unparse", "write")
+
+# import inserted by instrument_module, after the docstring and __future__ imports
+_rewritten_marker = b"\nimport safe_string as safe_string\n"
+
+
+def file_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def rewrite_file(source_path, out_path, select=None):
+    """
+    Rewrite one file (only the regions `select` if given) into `out_path`
+    (which can be the same file). Returns the hashes of the source and of
+    the output, and the seconds spent per phase. A file without selected
+    regions is copied as it is.
+    """
+    timings = {}
+    start = time.perf_counter()
+    with open(source_path, "rb") as fp:
+        data = fp.read()
+    if select is not None and not select:
+        # no parsing and no imports: it keeps its comments and formatting
+        os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+        if not (os.path.exists(out_path) and os.path.samefile(source_path, out_path)):
+            shutil.copyfile(source_path, out_path)
+        timings["write"] = time.perf_counter() - start
+        source_hash = file_hash(data)
+        return source_hash, source_hash, timings
+
+    tree = ast.parse(data, source_path)
+    parsed = time.perf_counter()
+    timings["parse"] = parsed - start
+
+    instrument_module(tree, select)
+    visited = time.perf_counter()
+    timings["visit"] = visited - parsed
+
+    output = (ast.unparse(tree) + "\n").encode("utf-8")
+    unparsed = time.perf_counter()
+    timings["unparse"] = unparsed - visited
+
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    with open(out_path, "wb") as fp:
+        fp.write(output)
+    timings["write"] = time.perf_counter() - unparsed
+
+    return file_hash(data), file_hash(output), timings
+
+
+def _rewrite_job(job):
+    "Rewrite a file in a worker process, returning the error instead of raising it."
+    rel_path, source_path, out_path, select = job
+    try:
+        source_hash, output_hash, timings = rewrite_file(source_path, out_path, select)
+    except (SyntaxError, ValueError, OSError, RecursionError) as error:
+        return rel_path, None, None, None, "{}: {}".format(type(error).__name__, error)
+    return rel_path, source_hash, output_hash, timings, None
+
+
+def module_name(rel_path):
+    "Dotted name of the module of a .py file relative to the root of the tree."
+    parts = os.path.normpath(rel_path)[:-len(".py")].split(os.sep)
+    if parts[-1] == "__init__" and len(parts) > 1:
+        parts.pop()
+    return ".".join(parts)
+
+
+def _summarize_job(job):
+    "Summarize the regions of a file for callgraph.select in a worker process."
+    rel_path, source_path = job
+    start = time.perf_counter()
+    try:
+        with open(source_path, "rb") as fp:
+            tree = ast.parse(fp.read(), source_path)
+    except (SyntaxError, ValueError, OSError, RecursionError):
+        # nothing selected in it: copied as it is
+        return rel_path, [], time.perf_counter() - start
+    name = module_name(rel_path or os.path.basename(source_path))
+    return rel_path, callgraph.summarize(tree, name), time.perf_counter() - start
+
+
+def selection_hash(select):
+    return None if select is None else file_hash(json.dumps(sorted(select)).encode("utf-8"))
+
+
+def load_manifest(path):
+    try:
+        with open(path) as fp:
+            manifest = json.load(fp)
+    except (OSError, ValueError):
+        return {}
+    return manifest.get("files", {}) if manifest.get("version") == transform_version else {}
+
 
-parser = ArgumentParser()
-parser.add_argument("in_path")
-parser.add_argument("--out", dest="out_path")
-args = parser.parse_args()
+def save_manifest(path, files):
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as fp:
+        json.dump({"version": transform_version, "files": files}, fp, indent=0, sort_keys=True)
+    os.replace(tmp_path, path)
 
-if args.out_path:
-    if os.path.isdir(args.in_path):
-        shutil.copytree(args.in_path, args.out_path)
+
+def _stat(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def unchanged(entry, path, key):
+    """
+    True if the file `path` still has the hash `entry[key]` recorded in the
+    manifest. Only hashes files whose size or mtime changed.
+    """
+    if not entry:
+        return False
+    try:
+        mtime_ns, size = _stat(path)
+        if [mtime_ns, size] == entry["stat"]:
+            return True
+        with open(path, "rb") as fp:
+            same = file_hash(fp.read()) == entry[key]
+    except OSError:
+        return False
+    if same:
+        # only touched, don't hash it again next time
+        entry["stat"] = [mtime_ns, size]
+    return same
+
+
+def _already_rewritten(path):
+    try:
+        with open(path, "rb") as fp:
+            return _rewritten_marker in fp.read()
+    except OSError:
+        return False
+
+
+def _copy_if_changed(source, destination):
+    if os.path.exists(destination):
+        source_stat = os.stat(source)
+        destination_stat = os.stat(destination)
+        if (source_stat.st_size == destination_stat.st_size
+                and source_stat.st_mtime_ns == destination_stat.st_mtime_ns):
+            return destination
+    return shutil.copy2(source, destination)
+
+
+def _py_files(in_path):
+    "Relative paths of the .py files of a tree, or [\"\"] for a single file."
+    if os.path.isdir(in_path):
+        return sorted(glob.glob("**/*.py", root_dir=in_path, recursive=True))
+    return [""]
+
+
+def plan(in_path, out_path, files, selection=None):
+    """
+    The (relative path, source path, output path, regions) of the files to
+    rewrite, and the number of files skipped. `selection` is the regions to
+    rewrite of each file ({relative path: keys}), None to rewrite everything.
+    """
+    in_place = out_path == in_path
+    jobs = []
+    skipped = 0
+    for rel_path in _py_files(in_path):
+        source = os.path.join(in_path, rel_path) if rel_path else in_path
+        out = os.path.join(out_path, rel_path) if rel_path else out_path
+        select = None if selection is None else selection.get(rel_path, set())
+        entry = files.get(rel_path)
+        if entry is not None and entry.get("selection") != selection_hash(select):
+            entry = None
+        if in_place:
+            if unchanged(entry, source, "output"):
+                skipped += 1
+                continue
+            if entry is None and _already_rewritten(source):
+                # rewritten by a run which didn't save its manifest
+                skipped += 1
+                continue
+        elif unchanged(entry, source, "source") and os.path.exists(out):
+            skipped += 1
+            continue
+        jobs.append((rel_path, source, out, select))
+    return jobs, skipped
+
+
+def _format_seconds(seconds):
+    return "{:.2f}s".format(seconds)
+
+
+def _map(executor, processes, func, jobs):
+    if executor is None:
+        return map(func, jobs)
+    return executor.map(func, jobs, chunksize=max(1, len(jobs) // (processes * 16)))
+
+
+def analyze(in_path, executor=None, processes=1, allow=(), deny=()):
+    """
+    The regions to rewrite of each .py file of `in_path` ({relative path:
+    keys}, see callgraph.select), and the seconds spent summarizing the files.
+    """
+    jobs = [(rel_path, os.path.join(in_path, rel_path) if rel_path else in_path)
+            for rel_path in _py_files(in_path)]
+    summaries = {}
+    modules = {}
+    seconds = 0.0
+    for rel_path, summary, job_seconds in _map(executor, processes, _summarize_job, jobs):
+        name = module_name(rel_path) if rel_path else "__main__"
+        summaries[name] = summary
+        modules[name] = rel_path
+        seconds += job_seconds
+    start = time.perf_counter()
+    selected = callgraph.select(summaries, allow, deny)
+    seconds += time.perf_counter() - start
+    return {modules[name]: keys for name, keys in selected.items()}, seconds
+
+
+def run(in_path, out_path, processes=None, quiet=False, save_interval=2.0,
+        selective=False, allow=(), deny=()):
+    """
+    Rewrite the .py files of `in_path` into `out_path` (the same path for in place).
+    With `selective`, only rewrite the code which can reach the execute
+    methods of the database drivers, plus the code matching the `allow`
+    patterns and minus the code matching the `deny` patterns (see callgraph).
+    Returns the list of (file, error) which couldn't be rewritten.
+    """
+    start = time.perf_counter()
+    in_path = os.path.normpath(in_path)
+    out_path = os.path.normpath(out_path)
+    if selective and out_path == in_path:
+        # the regions of a file rewritten in place can't be changed anymore
+        raise ValueError("selective rewriting needs an output path")
+    if os.path.isdir(in_path):
+        manifest_path = os.path.join(out_path, MANIFEST)
+        if out_path != in_path:
+            shutil.copytree(in_path, out_path, dirs_exist_ok=True, copy_function=_copy_if_changed,
+                            ignore=shutil.ignore_patterns("*.py", "__pycache__", MANIFEST))
     else:
-        shutil.copyfile(args.in_path, args.out_path)
+        manifest_path = os.path.join(os.path.dirname(out_path), MANIFEST)
+    files = load_manifest(manifest_path)
+
+    processes = processes or os.cpu_count() or 1
+    executor = ProcessPoolExecutor(processes) if processes > 1 else None
+    phase_seconds = {"analyze": 0.0} if selective else {}
+    phase_seconds.update(dict.fromkeys(PHASES, 0.0))
+    failures = []
+    try:
+        selection = None
+        if selective:
+            selection, phase_seconds["analyze"] = analyze(in_path, executor, processes, allow, deny)
+            if not quiet:
+                print("{} regions to rewrite in {} of {} files".format(
+                    sum(map(len, selection.values())),
+                    sum(1 for keys in selection.values() if keys), len(selection)), flush=True)
+
+        jobs, skipped = plan(in_path, out_path, files, selection)
+        total = len(jobs)
+        if not quiet:
+            print("{} files to rewrite, {} unchanged, {} processes".format(total, skipped, processes),
+                  flush=True)
+
+        last_save = time.perf_counter()
+        results = _map(executor, processes, _rewrite_job, jobs)
+        for done, (rel_path, source_hash, output_hash, timings, error) in enumerate(results, 1):
+            name = rel_path or in_path
+            if error is not None:
+                failures.append((name, error))
+                print("[{}/{}] FAILED {}: {}".format(done, total, name, error), flush=True)
+                continue
+
+            for phase, seconds in timings.items():
+                phase_seconds[phase] += seconds
+            # the file compared on the next run: the source, or the output in place
+            source = os.path.join(in_path, rel_path) if rel_path else in_path
+            select = None if selection is None else selection.get(rel_path, set())
+            files[rel_path] = {"source": source_hash, "output": output_hash,
+                               "stat": list(_stat(source)), "selection": selection_hash(select)}
+            if not quiet:
+                print("[{}/{}] {}".format(done, total, name), flush=True)
+
+            if time.perf_counter() - last_save > save_interval:
+                # an interrupted run must not forget the files it rewrote in place
+                save_manifest(manifest_path, files)
+                last_save = time.perf_counter()
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        save_manifest(manifest_path, files)
+
+    elapsed = time.perf_counter() - start
+    print("rewrote {} files, {} unchanged, {} failed in {}".format(
+        total - len(failures), skipped, len(failures), _format_seconds(elapsed)))
+    print("time per phase (summed over the processes): " + ", ".join(
+        "{} {}".format(phase, _format_seconds(seconds)) for phase, seconds in phase_seconds.items()))
+    return failures
 
-    path = args.out_path
 
-else:
-    path = args.in_path
+def main():
+    parser = ArgumentParser(description="Rewrite the str literals of python files into trusted safe_strings.")
+    parser.add_argument("in_path")
+    parser.add_argument("--out", dest="out_path", help="write the rewritten tree here instead of in place")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of processes (default: number of CPUs)")
+    parser.add_argument("-q", "--quiet", action="store_true", help="don't print every file")
+    parser.add_argument("--selective", action="store_true",
+                        help="only rewrite the code which can build the queries of the database drivers")
+    parser.add_argument("--allow", action="append", default=[], metavar="PATTERN",
+                        help="with --selective, also rewrite the modules, classes or functions "
+                             "matching this glob (e.g. 'app.db.*')")
+    parser.add_argument("--deny", action="append", default=[], metavar="PATTERN",
+                        help="with --selective, never rewrite the modules, classes or functions "
+                             "matching this glob")
+    args = parser.parse_args()
 
+    if (args.allow or args.deny) and not args.selective:
+        parser.error("--allow and --deny need --selective")
+    if args.selective and args.out_path is None:
+        parser.error("--selective needs --out")
 
-def replace_file(file):
-    print("Writing:", file)
-    replaced_data = None
-    with open(file, 'r') as fileptr:
-        data = fileptr.read()
-        replaced_data = replace_safe_str(data)
-    if replaced_data is not None:
-        with open(file, 'w') as fileptr:
-            fileptr.write(replaced_data)
+    failures = run(args.in_path, args.out_path or args.in_path, args.jobs, args.quiet,
+                   selective=args.selective, allow=args.allow, deny=args.deny)
+    if failures:
+        sys.exit(1)
 
 
-if os.path.isdir(path):
-    files = glob.glob(path + '/**/*.py', recursive=True)
-    for file in files:
-        replace_file(file)
-else:
-    replace_file(path)
+if __name__ == "__main__":
+    main()
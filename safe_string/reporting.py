@@ -0,0 +1,97 @@
+import atexit
+import json
+import queue
+import sys
+import threading
+import time
+
+
+def sqli_event(class_, query, sqli, stack_limit=8):
+    """
+    Describe a detected sql injection as a json serializable dict: the query,
+    the offending token, the untrusted ranges of the query, the class whose
+    method was called and a summary of the caller's stack (without source lines,
+    so that building it never reads files).
+    """
+    trusted = getattr(query, "_trusted", None)
+    if trusted is None:
+        untrusted = [(0, len(query))]
+    else:
+        untrusted = []
+        pos = 0
+        for start, end in trusted.runs():
+            if start > pos:
+                untrusted.append((pos, start))
+            pos = end
+        if pos < len(query):
+            untrusted.append((pos, len(query)))
+
+    stack = []
+    frame = sys._getframe(1)
+    while frame is not None and len(stack) < stack_limit:
+        code = frame.f_code
+        stack.append("{}:{} in {}".format(code.co_filename, frame.f_lineno, code.co_name))
+        frame = frame.f_back
+
+    return {
+        "time": time.time(),
+        "class": "{}.{}".format(class_.__module__, class_.__qualname__),
+        "query": str.__str__(query) if isinstance(query, str) else repr(query),
+        "sqli": {"start": sqli.start, "end": sqli.end, "token_type": sqli.token_type},
+        "untrusted": untrusted,
+        "stack": stack,
+    }
+
+
+class JsonLinesSink:
+    """
+    Write events as json lines from a background thread.
+
+    `emit` only puts the event in a bounded queue, so it never blocks on I/O:
+    when the queue is full the event is dropped and counted in `dropped`.
+    The writer thread is started on the first event and flushes the output
+    whenever the queue is empty.
+    """
+
+    def __init__(self, file=None, maxsize=10000):
+        # None means the current sys.stderr, looked up when writing
+        self.file = file
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def emit(self, event):
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        "Wait until all the emitted events are written."
+        self._queue.join()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                thread = threading.Thread(target=self._write_events, name="safe_string-events",
+                                          daemon=True)
+                thread.start()
+                atexit.register(self.flush)
+                self._thread = thread
+
+    def _write_events(self):
+        while True:
+            event = self._queue.get()
+            file = self.file if self.file is not None else sys.stderr
+            try:
+                file.write(json.dumps(event, default=str) + "\n")
+                if self._queue.empty():
+                    file.flush()
+            except Exception:
+                # reporting must never take the application down
+                pass
+            finally:
+                self._queue.task_done()
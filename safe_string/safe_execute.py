@@ -1,32 +1,201 @@
 from forbiddenfruit import curse
+import asyncio
 import sqlite3
 import psycopg2
 import mysql.connector
 from functools import wraps
+import inspect
+import random
+from time import perf_counter
 import ast
 from ast import AST
 
-from safe_string import safe_string
-import safe_sql
+# optional asyncio drivers
+try:
+    import aiosqlite
+except ImportError:
+    aiosqlite = None
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+try:
+    from .safe_string import safe_string
+    from . import safe_sql, sql_lexer, metrics
+    from .reporting import JsonLinesSink, sqli_event
+except ImportError:
+    from safe_string import safe_string
+    import safe_sql
+    import sql_lexer
+    import metrics
+    from reporting import JsonLinesSink, sqli_event
+
+
+# guard policies
+# ==============
+
+class Policy:
+    """
+    What the guard does with a detected sql injection: report a sample
+    of them to the event sink, and block the query or let it run.
+    Subclass and override `should_report`/`should_block` for other policies.
+    """
+
+    def __init__(self, block=True, sample_rate=1.0):
+        self.block = block
+        self.sample_rate = sample_rate
+
+    def should_report(self, class_, query, sqli):
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def should_block(self, class_, query, sqli):
+        return self.block
+
+    def __repr__(self):
+        return "Policy(block={!r}, sample_rate={!r})".format(self.block, self.sample_rate)
+
+
+BLOCK = Policy(block=True)
+LOG_ONLY = Policy(block=False)
+
+
+def sample(rate):
+    "Monitoring policy: report a fraction `rate` of the injections, never block."
+    return Policy(block=False, sample_rate=rate)
+
+
+policy = BLOCK
+event_sink = JsonLinesSink()
+
+
+def set_policy(new_policy):
+    global policy
+    policy = new_policy
+
+
+def set_event_sink(sink):
+    "Send the events to `sink`, any object with an `emit(event)` method."
+    global event_sink
+    event_sink = sink
 
 
 # utility functions
 # =================
 
-def wrap_execute(class_, unsafe_func, error_class):
+def check_query(class_, query, error_class, dialect=sql_lexer.GENERIC):
+    handle_sqli(class_, query, detect_sqli(class_, query, dialect), error_class)
+
+
+def detect_sqli(class_, query, dialect=sql_lexer.GENERIC):
+    """
+    has_sqli with the sql dialect of the driver, recording the metrics of
+    the check if they are enabled.
+    """
+    if metrics.enabled:
+        start = perf_counter()
+        sqli, lex_seconds, trust_check_seconds = safe_sql.timed_has_sqli(query, dialect)
+        metrics.record(class_, len(query), sqli, lex_seconds, trust_check_seconds,
+                       perf_counter() - start)
+        return sqli
+    return safe_sql.has_sqli(query, dialect)
+
+
+def handle_sqli(class_, query, sqli, error_class):
+    "Report and block a detected injection according to the policy."
+    if sqli:
+        if policy.should_report(class_, query, sqli):
+            event_sink.emit(sqli_event(class_, query, sqli))
+        if policy.should_block(class_, query, sqli):
+            raise error_class("sqli detected")
+
+
+def wrap_execute(class_, unsafe_func, error_class, dialect=sql_lexer.GENERIC):
     @wraps(unsafe_func)
     def safe_func(self, query, *args, **kwargs):
         # print(f'DEBUG: calling {class_.__module__}.{unsafe_func.__name__}')
-        if safe_sql.has_sqli(query):
-            print("[!] SQLi detected in {}".format(class_.__module__))
-            print(f"query: {query!r}")
-            raise error_class("sqli detected")
-
+        check_query(class_, query, error_class, dialect)
         return unsafe_func(self, query, *args, **kwargs)
 
     return safe_func
 
 
+def wrap_executemany(class_, unsafe_func, error_class, dialect=sql_lexer.GENERIC):
+    """
+    executemany runs a single query template for every row of parameters,
+    so only the template is checked, once, before any row is read.
+    The rows are passed on untouched: drivers which consume them lazily
+    (like sqlite3 with a generator) keep streaming them.
+    """
+    @wraps(unsafe_func)
+    def safe_func(self, query, seq_of_parameters, *args, **kwargs):
+        check_query(class_, query, error_class, dialect)
+        return unsafe_func(self, query, seq_of_parameters, *args, **kwargs)
+
+    return safe_func
+
+
+async def check_query_async(class_, query, error_class, dialect=sql_lexer.GENERIC):
+    """
+    check_query for coroutines: has_sqli is cpu bound, so queries longer
+    than `async_offload_threshold` are checked in the loop's default executor
+    instead of stalling the event loop.
+    """
+    if async_offload_threshold is not None and len(query) > async_offload_threshold:
+        loop = asyncio.get_running_loop()
+        sqli = await loop.run_in_executor(None, detect_sqli, class_, query, dialect)
+        # reported here, so that the event has the stack of the caller
+        # rather than the one of the executor's thread
+        handle_sqli(class_, query, sqli, error_class)
+    else:
+        check_query(class_, query, error_class, dialect)
+
+
+def wrap_execute_async(class_, unsafe_func, error_class, dialect=sql_lexer.GENERIC):
+    @wraps(unsafe_func)
+    async def safe_func(self, query, *args, **kwargs):
+        await check_query_async(class_, query, error_class, dialect)
+        return await unsafe_func(self, query, *args, **kwargs)
+
+    return _async_call_style(unsafe_func, safe_func)
+
+
+def wrap_executemany_async(class_, unsafe_func, error_class, dialect=sql_lexer.GENERIC):
+    "Like `wrap_executemany`: the template is checked once and the rows are passed on untouched."
+    @wraps(unsafe_func)
+    async def safe_func(self, query, seq_of_parameters, *args, **kwargs):
+        await check_query_async(class_, query, error_class, dialect)
+        return await unsafe_func(self, query, seq_of_parameters, *args, **kwargs)
+
+    return _async_call_style(unsafe_func, safe_func)
+
+
+def _async_call_style(unsafe_func, safe_func):
+    """
+    aiosqlite's connection methods aren't coroutine functions: they return a
+    Result which can be awaited or used with `async with`, so keep that.
+    """
+    if aiosqlite is not None and not inspect.iscoroutinefunction(unsafe_func):
+        return aiosqlite.context.contextmanager(safe_func)
+    return safe_func
+
+
+def guard_async_class(class_, error_class, dialect=sql_lexer.GENERIC):
+    """
+    Guard the coroutine methods of an asyncio driver class which take a query
+    (execute, executemany, fetch...), raising `error_class` on sql injections.
+    The queries are checked with the lexer of the sql `dialect` of the driver.
+    """
+    for func_name in async_execute_funcs:
+        try:
+            unsafe_func = getattr(class_, func_name)
+        except AttributeError:
+            pass
+        else:
+            wrap = wrap_executemany_async if func_name == "executemany" else wrap_execute_async
+            curse(class_, func_name, wrap(class_, unsafe_func, error_class, dialect))
+
+
 class ToUnsafeVisitor(ast.NodeTransformer):
     def generic_visit(self, node):
         for field, value in ast.iter_fields(node):
@@ -47,30 +216,60 @@ class ToUnsafeVisitor(ast.NodeTransformer):
 # override sql.execute methods
 # ============================
 
+# (class, error raised on sql injections, sql dialect of its queries)
 unsafe_execute_classes = [
-    (sqlite3.Connection, sqlite3.Error),
-    (sqlite3.Cursor, sqlite3.Error),
-    (psycopg2.extensions.cursor, psycopg2.OperationalError),
-    (mysql.connector.cursor.MySQLCursor, mysql.connector.Error),
+    (sqlite3.Connection, sqlite3.Error, sql_lexer.SQLITE),
+    (sqlite3.Cursor, sqlite3.Error, sql_lexer.SQLITE),
+    (psycopg2.extensions.cursor, psycopg2.OperationalError, sql_lexer.POSTGRES),
+    (mysql.connector.cursor.MySQLCursor, mysql.connector.Error, sql_lexer.MYSQL),
 ]
 
 if mysql.connector.HAVE_CEXT:
     unsafe_execute_classes.append(
-        (mysql.connector.cursor_cext.CMySQLCursor, mysql.connector.Error)
+        (mysql.connector.cursor_cext.CMySQLCursor, mysql.connector.Error, sql_lexer.MYSQL)
     )
 
 
-for class_, error_class in unsafe_execute_classes:
-    for func_name in ("execute", "executemany"):
+for class_, error_class, dialect in unsafe_execute_classes:
+    for func_name, wrap in (("execute", wrap_execute), ("executemany", wrap_executemany)):
         try:
             unsafe_func = getattr(class_, func_name)
         except AttributeError:
             pass
         else:
-            safe_func = wrap_execute(class_, unsafe_func, error_class)
+            safe_func = wrap(class_, unsafe_func, error_class, dialect)
             curse(class_, func_name, safe_func)
 
 
+# override async sql.execute methods
+# ==================================
+
+# queries longer than this are checked in a thread (None to always check inline)
+async_offload_threshold = 4096
+
+async_execute_funcs = (
+    "execute", "executemany",
+    "execute_fetchall", "execute_insert",  # aiosqlite
+    "fetch", "fetchrow", "fetchval",  # asyncpg
+)
+
+unsafe_async_execute_classes = []
+
+if aiosqlite is not None:
+    unsafe_async_execute_classes += [
+        (aiosqlite.Connection, sqlite3.Error, sql_lexer.SQLITE),
+        (aiosqlite.Cursor, sqlite3.Error, sql_lexer.SQLITE),
+    ]
+
+if asyncpg is not None:
+    unsafe_async_execute_classes.append(
+        (asyncpg.connection.Connection, asyncpg.PostgresError, sql_lexer.POSTGRES)
+    )
+
+for class_, error_class, dialect in unsafe_async_execute_classes:
+    guard_async_class(class_, error_class, dialect)
+
+
 # override builtin functions
 # ==========================
 
@@ -1,31 +1,270 @@
-import sqlparse
+from bisect import bisect_right
+from collections import namedtuple, OrderedDict
+import re
+import threading
+from time import perf_counter
+
 import sqlvalidator
-from safe_string import safe_string
+
+try:
+    from .safe_string import safe_string
+    from . import sql_lexer
+except ImportError:
+    from safe_string import safe_string
+    import sql_lexer
+
+# token types which may contain untrusted characters
+_untrusted_types = sql_lexer.LITERALS | {sql_lexer.WHITESPACE}
+
+# The offending part of a query found by `has_sqli`: the token [start, end)
+# which contains untrusted characters, and its type (None if nothing is trusted).
+SQLi = namedtuple("SQLi", ["start", "end", "token_type"])
+
+verdict_cache_size = 1024
+
+# (dialect, skeleton) -> literal context of each untrusted span, see `has_sqli`
+_verdict_cache = OrderedDict()
+_verdict_lock = threading.Lock()  # has_sqli may run in several threads
+_verdict_hits = 0
+_verdict_misses = 0
+
+# Characters which can end a string, comment or quoted identifier of any
+# dialect. An untrusted span without them can't change where any token that
+# reaches it ends, except for the string it lies in.
+_string_breakers = re.compile(r"""['"`´\\$*/\[\]\r\n]""")
+_digits = re.compile(r"[0-9]+")
 
 
-def has_sqli(query):
+def has_sqli(query, dialect=sql_lexer.GENERIC):
     """
     Check if the query has an sql injection.
+
+    Every token which is not a literal or whitespace must be completely trusted.
+    The query is split with the lexer of `dialect` (see `sql_lexer`), the
+    generic dialect gives the same verdicts as checking `sqlparse`'s tokens.
+
+    Returns the first offending token as an `SQLi` (which is always truthy),
+    or False if there is no injection.
+
+    Only the tokens overlapping the untrusted part of the query need to be checked:
+    fully trusted queries are accepted without tokenizing them, and tokenizing
+    stops after the last untrusted character.
+
+    Queries which only differ in the contents of their untrusted spans share
+    a skeleton (the trusted text around the spans). When a query is accepted
+    and each of its untrusted spans lies inside a string (or is a number),
+    the skeleton is cached: a later query with the same skeleton is accepted
+    by re-matching only the literal around each span, as long as the new
+    contents can't end the literal (no quotes, backslashes, comment markers...)
+    or are digits. Injections are never cached.
+    """
+    return _has_sqli(query, dialect, None)
+
+
+def timed_has_sqli(query, dialect=sql_lexer.GENERIC):
+    """
+    has_sqli, also returning the seconds spent lexing the query and the
+    seconds spent checking its trust (everything else, including the cache).
     """
+    timings = [0.0]
+    start = perf_counter()
+    sqli = _has_sqli(query, dialect, timings)
+    elapsed = perf_counter() - start
+    return sqli, timings[0], elapsed - timings[0]
+
+
+def _has_sqli(query, dialect, timings):
+    "has_sqli, adding the time spent lexing to timings[0] unless timings is None."
+    global _verdict_hits, _verdict_misses
+
     if not isinstance(query, safe_string):
-        return True
+        return SQLi(0, len(query), None)
+
+    trusted = query._trusted
+    first_untrusted = trusted.find(False)
+    if first_untrusted == -1:
+        # no untrusted characters, so no injection is possible
+        return False
+    last_untrusted = trusted.rfind(False)
 
-    start_idx = 0
-    for statement in sqlparse.parse(query):
-        for token in statement.flatten():
-            end_idx = start_idx + len(token.value)  # non-inclusive
-            if token.ttype not in sqlparse.tokens.Literal and \
-                    token.ttype not in sqlparse.tokens.Whitespace:
-                # all chars should be trusted
-                for char_idx in range(start_idx, end_idx):
-                    if not query._trusted[char_idx]:
-                        return True
+    text = query._to_unsafe_str()
+    use_cache = verdict_cache_size != 0
+    if use_cache:
+        skeleton, starts, spans = _split_skeleton(text, trusted)
+        key = (dialect, skeleton)
+        contexts = _verdict_cache.get(key)
+        if contexts is not None and _contexts_hold(text, starts, spans, contexts, dialect):
+            with _verdict_lock:
+                _verdict_hits += 1
+                if key in _verdict_cache:
+                    _verdict_cache.move_to_end(key)
+            return False
+        with _verdict_lock:
+            _verdict_misses += 1
 
-            start_idx = end_idx
+    tokens = sql_lexer.tokenize(text, dialect)
+    if timings is not None:
+        tokens = _timed(tokens, timings)
+
+    literals = []
+    for ttype, start_idx, end_idx in tokens:
+        if start_idx > last_untrusted:
+            # everything from here on is trusted
+            break
+
+        if end_idx > first_untrusted:
+            if ttype in _untrusted_types:
+                literals.append((ttype, start_idx, end_idx))
+            # all chars should be trusted
+            elif not trusted[start_idx:end_idx].all():
+                return SQLi(start_idx, end_idx, ttype)
+
+    if use_cache:
+        contexts = _literal_contexts(text, skeleton, starts, spans, literals)
+        if contexts is not None:
+            with _verdict_lock:
+                _verdict_cache[key] = contexts
+                _verdict_cache.move_to_end(key)
+                if verdict_cache_size is not None and len(_verdict_cache) > verdict_cache_size:
+                    _verdict_cache.popitem(last=False)
 
     return False
 
 
+def _timed(tokens, timings):
+    "Yield the tokens, adding the time spent producing them to timings[0]."
+    while True:
+        start = perf_counter()
+        token = next(tokens, None)
+        timings[0] += perf_counter() - start
+        if token is None:
+            return
+        yield token
+
+
+def _split_skeleton(text, trusted):
+    """
+    Split the query into pieces: trusted text, and untrusted spans (None in the skeleton).
+    Returns the skeleton, the start of each piece (and the end of the query),
+    and the (piece index, start, end) of each untrusted span.
+    """
+    skeleton = []
+    starts = []
+    spans = []
+    pos = 0
+    for start, end in trusted.runs():
+        if start > pos:
+            spans.append((len(skeleton), pos, start))
+            starts.append(pos)
+            skeleton.append(None)
+        starts.append(start)
+        skeleton.append(text[start:end])
+        pos = end
+    if pos < len(text):
+        spans.append((len(skeleton), pos, len(text)))
+        starts.append(pos)
+        skeleton.append(None)
+    starts.append(len(text))
+    return tuple(skeleton), starts, spans
+
+
+def _piece_offset(skeleton, starts, idx):
+    """
+    Position of idx as (piece index, offset), which stays valid for queries
+    with the same skeleton. None when idx is inside an untrusted span.
+    """
+    piece = bisect_right(starts, idx) - 1
+    offset = idx - starts[piece]
+    if offset and skeleton[piece] is None:
+        return None
+    return piece, offset
+
+
+def _literal_contexts(text, skeleton, starts, spans, literals):
+    """
+    The (type, start piece, start offset, end piece, end offset) of the
+    literal containing each untrusted span, or None if some span can't be
+    checked without lexing the whole query.
+    """
+    contexts = []
+    literals = iter(literals)
+    ttype, start, end = next(literals, (None, 0, 0))
+    for _, span_start, span_end in spans:
+        while end < span_end:
+            ttype, start, end = next(literals, (None, 0, len(text)))
+        if start > span_start:
+            # the span is split between several tokens
+            return None
+
+        content = text[span_start:span_end]
+        if ttype == sql_lexer.STRING:
+            if not start < span_start < span_end < end or _string_breakers.search(content):
+                return None
+        elif ttype == sql_lexer.NUMBER:
+            if not _digits.fullmatch(content):
+                return None
+        else:
+            return None
+
+        token_start = _piece_offset(skeleton, starts, start)
+        token_end = _piece_offset(skeleton, starts, end)
+        if token_start is None or token_end is None:
+            return None
+        contexts.append((ttype,) + token_start + token_end)
+
+    return tuple(contexts)
+
+
+def _contexts_hold(text, starts, spans, contexts, dialect):
+    "Check that each untrusted span still lies in its cached literal."
+    for (_, span_start, span_end), (ttype, sp, so, ep, eo) in zip(spans, contexts):
+        content = text[span_start:span_end]
+        if ttype == sql_lexer.STRING:
+            if _string_breakers.search(content):
+                return False
+        elif not _digits.fullmatch(content):
+            return False
+
+        start = starts[sp] + so
+        token = next(sql_lexer.tokenize(text, dialect, start), None)
+        if token != (ttype, start, starts[ep] + eo):
+            return False
+    return True
+
+
+def verdict_cache_info():
+    """
+    Statistics of the has_sqli verdict cache as a dict with
+    hits, misses, hit_rate, maxsize and currsize.
+    """
+    lookups = _verdict_hits + _verdict_misses
+    return {
+        "hits": _verdict_hits,
+        "misses": _verdict_misses,
+        "hit_rate": _verdict_hits / lookups if lookups else 0.0,
+        "maxsize": verdict_cache_size,
+        "currsize": len(_verdict_cache),
+    }
+
+
+def verdict_cache_clear():
+    "Remove all cached verdicts and reset the cache statistics."
+    global _verdict_hits, _verdict_misses
+    with _verdict_lock:
+        _verdict_cache.clear()
+        _verdict_hits = _verdict_misses = 0
+
+
+def set_verdict_cache_size(maxsize):
+    "Change the maximum number of cached verdicts (None for unbounded, 0 to disable)."
+    global verdict_cache_size
+    verdict_cache_size = maxsize
+    if maxsize is not None:
+        with _verdict_lock:
+            while len(_verdict_cache) > maxsize:
+                _verdict_cache.popitem(last=False)
+
+
 def is_valid(query):
     """
     Simple sql validator.
@@ -1,43 +1,177 @@
-from bitarray import bitarray, frozenbitarray
-from forbiddenfruit import curse
+from forbiddenfruit import curse, override_dict, tp_func_dict, PyTypeObject
+from functools import lru_cache
+import _string
 import itertools
+import re
+
+try:
+    from .trust import TrustMap, TrustMapBuilder
+except ImportError:
+    from trust import TrustMap, TrustMapBuilder
 
 orig_str_add = str.__add__
 orig_str_format = str.format
+orig_str_mod = str.__mod__
+
+# maximum number of compiled format strings kept in the cache,
+# see `compile_format` and `compile_mod`
+format_cache_size = 1024
+
 
 def safe_format(fmt_string, *args, **kwargs):
-    result_string = orig_str_format(fmt_string, *args, **kwargs)
-    arg_holes, all_holes = _do_build_string(fmt_string)
-    arg_hole_trusts = render_field(arg_holes, fmt_string, args, kwargs)
-    final_trusted = construct_trusted(fmt_string, all_holes, arg_hole_trusts)
-    return safe_string(result_string, trusted=final_trusted)
+    builder = Builder()
+    try:
+        parts = compile_format(fmt_string)
+        _render_parts(parts, args, kwargs, [-1, None], builder)
+    except Exception:
+        # raise the same error as str.format
+        orig_str_format(fmt_string, *args, **kwargs)
+        raise
+
+    return builder.build()
+
+
+class _FormatField:
+    "A replacement field of a compiled format string, see `compile_format`."
+
+    __slots__ = ("index", "lookups", "conv", "spec")
+
+    def __init__(self, index, lookups, conv, spec):
+        self.index = index
+        self.lookups = lookups
+        self.conv = conv
+        # plain str, or compiled parts if the spec has nested fields
+        self.spec = spec
+
+
+def compile_format(fmt_string):
+    """
+    Parse a format string into its parts: (text, trusted) tuples for the
+    literal text (with escaped braces collapsed) and a _FormatField for
+    each replacement field.
+
+    Applications format the same few templates over and over, so the result is
+    cached (LRU) on the text and trust values of the format string, and repeated
+    formats only need to evaluate the arguments and splice their trust values.
+    """
+    return _compile_format(fmt_string._to_unsafe_str(), fmt_string._trusted, False)
+
+
+def _parse_format(text, trusted):
+    # same errors as str.format for malformed format strings
+    for _ in _string.formatter_parser(text):
+        pass
+
+    arg_holes, all_holes = _do_build_string(text)
+
+    parts = []
+
+    def add_literal(start, end, literal_text):
+        if start == end:
+            return
+        literal_trusted = trusted[start:end]
+        if parts and isinstance(parts[-1], tuple):
+            prev_text, prev_trusted = parts.pop()
+            literal_text = prev_text + literal_text
+            literal_trusted = prev_trusted + literal_trusted
+        parts.append((literal_text, literal_trusted))
+
+    prev_index = 0
+    for kind, (start, end) in all_holes:
+        add_literal(prev_index, start, text[prev_index:start])
+        if kind == 'h':
+            name, conv, spec = parse_field(text[start:end + 1])
+            index, lookups = _split_field_name(name)
+            if conv is not None:
+                conv = str.__str__(conv)
+            spec = str.__str__(spec)
+            if "{" in spec:
+                spec = _parse_format(spec, TrustMap.untrusted(len(spec)))
+            parts.append(_FormatField(index, lookups, conv, spec))
+        else:
+            # escaped brace: keep the second one
+            add_literal(end, end + 1, text[end])
+        prev_index = end + 1
+    add_literal(prev_index, len(text), text[prev_index:])
+
+    return tuple(parts)
+
+
+def _parse_template(text, trusted, printf):
+    "Parse a str.format format string, or a printf-style one if `printf`."
+    if printf:
+        return _parse_mod(text, trusted)
+    return _parse_format(text, trusted)
+
+
+# shared by both kinds of format strings
+_compile_format = lru_cache(maxsize=format_cache_size)(_parse_template)
+
+
+def format_cache_info():
+    """
+    Statistics of the compiled format string cache (str.format and %
+    format strings) as a dict with hits, misses, hit_rate, maxsize and currsize.
+    """
+    info = _compile_format.cache_info()
+    lookups = info.hits + info.misses
+    return {
+        "hits": info.hits,
+        "misses": info.misses,
+        "hit_rate": info.hits / lookups if lookups else 0.0,
+        "maxsize": info.maxsize,
+        "currsize": info.currsize,
+    }
+
+
+def format_cache_clear():
+    "Remove all compiled format strings from the cache and reset its statistics."
+    _compile_format.cache_clear()
+
+
+def set_format_cache_size(maxsize):
+    "Change the maximum number of cached format strings (None for unbounded)."
+    global _compile_format, format_cache_size
+    format_cache_size = maxsize
+    _compile_format = lru_cache(maxsize=maxsize)(_parse_template)
 
 
 def _do_build_string(s):
-    isHole = False
     res = []
     holes = []
     lb_loc = 0
+    depth = 0  # number of unmatched '{' in the current hole
+    in_spec = False
     i = 0
+    end = len(s)
 
-    while i < len(s):
-        if s[i] == '{':
-            if i < len(s)-1 and s[i+1] == '{':
+    while i < end:
+        c = s[i]
+        if depth:
+            if c == '[' and not in_spec:
+                # index lookups in the field name can contain any character
+                while i < end and s[i] != ']':
+                    i += 1
+            elif c == ':' or c == '!':
+                in_spec = True
+            elif c == '{':
+                # nested field in the format spec
+                depth += 1
+            elif c == '}':
+                depth -= 1
+                if not depth:
+                    res.append(('h', (lb_loc, i)))
+                    holes.append((lb_loc, i))
+        elif c == '{':
+            if i < end - 1 and s[i+1] == '{':
                 res.append(('l', (i, i+1)))
-                isHole = False
                 i += 1
             else:
-                isHole = True
+                depth = 1
+                in_spec = False
                 lb_loc = i
-        elif s[i] == '[':
-            while s[i] != ']':
-                i += 1
-        elif s[i] == '}':
-            if isHole:
-                res.append(('h', (lb_loc, i)))
-                holes.append((lb_loc, i))
-                isHole = False
-            elif i < len(s)-1 and s[i+1] == '}':
+        elif c == '}':
+            if i < end - 1 and s[i+1] == '}':
                 res.append(('r', (i, i+1)))
                 i += 1
         i += 1
@@ -45,71 +179,483 @@ def _do_build_string(s):
     return holes, res
 
 
-def render_field(holes, fmt_string, args, kwargs):
-    result = []
-    parser = field_parser(args, kwargs)
-    for hole in holes:
-        value, conv, spec = parser(fmt_string[hole[0]:hole[1] + 1])
-        if not isinstance(spec, safe_string):
-            spec = safe_string(spec)
-        s = value
-        is_safe = False
-        if isinstance(value, safe_string):
-            is_safe = True
-            s = value._to_unsafe_str()
-
-        if conv == 'r':
-            trusted = bitarray(value.__repr__()._trusted) if is_safe else bitarray([
-                False]*len(repr(s).__format__(spec._to_unsafe_str())))
-            result.append(trusted)
-        elif conv == 's':
-            trusted = bitarray(value.__str__()._trusted) if is_safe else bitarray([
-                False]*len(str(s).__format__(spec._to_unsafe_str())))
-            result.append(trusted)
-        elif conv == 'a':
-            if not is_safe:
-                trusted = bitarray([False] * len(ascii(value)))
-            elif value.isascii():
-                trusted = bitarray([False]) + value._trusted + bitarray([False])
+def _render_parts(parts, args, kwargs, numbering, builder):
+    """
+    Render the parts of a compiled format string into `builder`.
+    `numbering` is [last automatic index, "auto"/"manual"/None],
+    shared with the nested fields of format specs.
+    """
+    for part in parts:
+        if isinstance(part, tuple):
+            text, trusted = part
+        else:
+            index = part.index
+            if index is None:
+                if numbering[1] == "manual":
+                    raise ValueError("cannot switch from manual field specification "
+                                     "to automatic field numbering")
+                numbering[0] += 1
+                numbering[1] = "auto"
+                value = args[numbering[0]]
+            elif isinstance(index, int):
+                if numbering[1] == "auto":
+                    raise ValueError("cannot switch from automatic field numbering "
+                                     "to manual field specification")
+                numbering[1] = "manual"
+                value = args[index]
             else:
-                # go char-by-char and call ascii
-                trusted = bitarray()
-                for char in value:
-                    newchar = ascii(char._to_unsafe_str())[1:-1]  # remove quotes
-                    trusted += len(newchar) * char._trusted
-                trusted = bitarray([False]) + trusted + bitarray([False])  # for quotes
-
-            result.append(trusted)
+                value = kwargs[index]
+            value = _apply_lookups(value, part.lookups)
+
+            spec = part.spec
+            if not isinstance(spec, str):
+                spec_builder = Builder()
+                _render_parts(spec, args, kwargs, numbering, spec_builder)
+                spec = spec_builder.build()._to_unsafe_str()
+
+            text, trusted = render_field(value, part.conv, spec)
+
+        builder._append(text, trusted)
+
+
+def render_field(value, conv, spec):
+    """
+    Render a replacement field like str.format, returning the text and its
+    trust values. The conversion and __format__ of `value` are called exactly
+    once; only safe_strings contribute trusted characters.
+    """
+    if conv == 'r':
+        value = repr(value)
+    elif conv == 's':
+        # a safe_string is its own str(), with its trust values
+        if not isinstance(value, safe_string):
+            value = str(value)
+    elif conv == 'a':
+        value = _safe_ascii(value) if isinstance(value, safe_string) else ascii(value)
+    elif conv is not None:
+        raise ValueError("Unknown conversion specifier {}".format(conv))
+
+    if isinstance(value, safe_string):
+        return _format_safe(value, spec)
+
+    text = format(value, spec)
+    if isinstance(text, safe_string):
+        return text._to_unsafe_str(), text._trusted
+    return text, TrustMap.untrusted(len(text))
+
+
+def _safe_ascii(value):
+    "ascii() of a safe_string: its repr with non-ascii characters escaped."
+    value_repr = repr(value)
+    text = value_repr._to_unsafe_str()
+    if text.isascii():
+        return value_repr
+
+    # non-ascii characters become \xhh, \uxxxx or \Uxxxxxxxx
+    ascii_lengths = _ascii_lengths
+    trusted = TrustMapBuilder()
+    for start, end, value in value_repr._trusted.spans():
+        if end - start == 1:
+            char = text[start]
+            len_escaped = ascii_lengths.get(char) or _escape_length(ascii_lengths, char, _ascii_quoted)
         else:
-            trusted = bitarray(value._trusted) if is_safe else bitarray([
-                False]*len(s.__format__(spec._to_unsafe_str())))
-            result.append(trusted)
+            len_escaped = len(text[start:end].encode("ascii", "backslashreplace"))
+        trusted.append_run(value, len_escaped)
 
-    return result
+    return safe_string(text.encode("ascii", "backslashreplace").decode("ascii"),
+                       trusted.build())
 
 
-def construct_trusted(format_string, gl_holes, trusted_result):
-    prev_index = 0
-    gl_index = 0
-    hl_index = 0
-    final_trusted = bitarray()
-    while gl_index < len(gl_holes):
-        start = gl_holes[gl_index][1][0]
-        end = gl_holes[gl_index][1][1]
-        final_trusted += format_string._trusted[prev_index:start]
-        new_trusted = bitarray()
-        if gl_holes[gl_index][0] == 'l' or gl_holes[gl_index][0] == 'r':
-            new_trusted += [format_string._trusted[end]]
+# [[fill]align][sign][z][#][0][width][grouping][.precision][type]
+_string_format_spec = re.compile(
+    r"(?:(.)?([<>=^]))?[-+ ]?z?#?0?(\d*)[_,]?(?:\.(\d+))?[a-zA-Z%]?", re.DOTALL)
+
+
+def _format_safe(value, spec):
+    "format() a safe_string, the padding is untrusted."
+    text = value._to_unsafe_str()
+    if not spec:
+        return text, value._trusted
+
+    formatted = str.__format__(text, spec)
+    match = _string_format_spec.fullmatch(spec)
+    align = match.group(2) or "<"
+    precision = match.group(4)
+    content_trusted = value._trusted[:int(precision)] if precision else value._trusted
+
+    pad = len(formatted) - len(content_trusted)
+    if align == ">":
+        left_pad = pad
+    elif align == "^":
+        left_pad = pad // 2
+    else:
+        left_pad = 0
+
+    return formatted, (TrustMap.untrusted(left_pad) + content_trusted
+                       + TrustMap.untrusted(pad - left_pad))
+
+
+class _FStringField:
+    "A replacement field of an f-string, see `FStringFormatter`."
+
+    __slots__ = ("conv", "spec")
+
+    def __init__(self, conv, spec):
+        self.conv = conv
+        # plain str, or the parts of the spec if it has nested fields
+        self.spec = spec
+
+
+def _compile_fstring(parts):
+    compiled = []
+    for part in parts:
+        if isinstance(part, str):
+            if part:
+                compiled.append(part)
+            continue
+        conv, spec = part
+        if spec is None:
+            spec = ""
+        elif all(isinstance(spec_part, str) for spec_part in spec):
+            spec = "".join(spec)
+        else:
+            spec = _compile_fstring(spec)
+        compiled.append(_FStringField(conv, spec))
+    return tuple(compiled)
+
+
+def _render_fstring_spec(parts, values, index):
+    "Render the nested fields of a format spec, returns the spec and the next value index."
+    chunks = []
+    for part in parts:
+        if isinstance(part, str):
+            chunks.append(part)
+        else:
+            spec = part.spec
+            value = values[index]
+            index += 1
+            if not isinstance(spec, str):
+                spec, index = _render_fstring_spec(spec, values, index)
+            chunks.append(str.__str__(render_field(value, part.conv, spec)[0]))
+    return "".join(chunks), index
+
+
+class FStringFormatter:
+    """
+    Trust aware formatter of one f-string, created once by the rewritten code
+    for each f-string of a module (see parsing.SafeStringVisitor):
+
+        f"SELECT * FROM {table!r:>{width}} WHERE id = {id}"
+
+    is rewritten to a global
+
+        formatter = FStringFormatter(("SELECT * FROM ", ("r", (">", (None, None))),
+                                      " WHERE id = ", (None, None)))
+
+    and the f-string to formatter(table, width, id).
+
+    `parts` are the literal texts of the f-string and a (conversion, spec)
+    tuple for each replacement field, where the conversion is None, "r", "s"
+    or "a" and the spec is None or the parts of the format spec. Calling the
+    formatter with the values of the fields, in the order of the f-string
+    (a value before the values of its format spec), returns the formatted
+    safe_string. The literal texts are trusted, the values keep their trust
+    values if they are safe_strings, like `render_field`.
+    """
+
+    __slots__ = ("parts",)
+
+    def __init__(self, parts):
+        self.parts = _compile_fstring(parts)
+
+    def __call__(self, *values):
+        # the trust runs are accumulated here like TrustMapBuilder does,
+        # without its method calls: f-strings are usually short and hot
+        chunks = []
+        bounds = []
+        length = 0
+        index = 0
+        for part in self.parts:
+            if isinstance(part, str):
+                # literal text, trusted
+                chunks.append(part)
+                if bounds and bounds[-1] == length:
+                    bounds[-1] = length = length + len(part)
+                else:
+                    bounds.append(length)
+                    length += len(part)
+                    bounds.append(length)
+                continue
+
+            value = values[index]
+            index += 1
+            spec = part.spec
+            if not isinstance(spec, str):
+                spec, index = _render_fstring_spec(spec, values, index)
+            if part.conv is None and not isinstance(value, safe_string):
+                # the usual case: neither a conversion nor trust values
+                text = format(value, spec)
+                if not isinstance(text, safe_string):
+                    chunks.append(text)
+                    length += len(text)
+                    continue
+            text, trusted = render_field(value, part.conv, spec)
+            chunks.append(text)
+            piece = trusted._bounds
+            if piece:
+                if bounds and bounds[-1] == length and piece[0] == 0:
+                    # trusted run continues across the boundary
+                    bounds.pop()
+                    piece = piece[1:]
+                bounds.extend([b + length for b in piece])
+            length += trusted._length
+        return safe_string._from_parts("".join(chunks), TrustMap(length, tuple(bounds)))
+
+
+def safe_mod(fmt_string, values):
+    "fmt_string % values, keeping the trust values of the format string and of safe_string values."
+    builder = Builder()
+    try:
+        parts = compile_mod(fmt_string)
+        _render_mod(parts, values, builder)
+    except Exception:
+        # raise the same error as str.__mod__
+        orig_str_mod(fmt_string._to_unsafe_str(), values)
+        raise
+
+    return builder.build()
+
+
+class _ModField:
+    "A conversion specifier of a compiled printf-style format string, see `compile_mod`."
+
+    __slots__ = ("key", "conv", "template", "width", "precision", "stars", "left")
+
+    def __init__(self, key, conv, template, width, precision, left):
+        self.key = key
+        self.conv = conv
+        # the specifier without the mapping key, for str.__mod__.
+        # Ends with "s" for the r, s and a conversions, which are applied beforehand.
+        self.template = template
+        # "*" (taken from the values), or if the specifier has them, int
+        self.width = width
+        self.precision = precision
+        self.stars = (width == "*") + (precision == "*")
+        # "-" flag
+        self.left = left
+
+
+# %[(key)][flags][width][.precision][length modifier]type
+_mod_flags = frozenset("-+ #0")
+_mod_conversions = frozenset("diouxXeEfFgGcrsa")
+
+
+def compile_mod(fmt_string):
+    """
+    Parse a printf-style format string into its parts: (text, trusted)
+    tuples for the literal text (with "%%" collapsed) and a _ModField
+    for each conversion specifier.
+
+    Cached with the str.format format strings, see `compile_format`.
+    """
+    return _compile_format(fmt_string._to_unsafe_str(), fmt_string._trusted, True)
+
+
+def _parse_mod(text, trusted):
+    parts = []
+
+    def add_literal(start, end):
+        if start == end:
+            return
+        literal_text = text[start:end]
+        literal_trusted = trusted[start:end]
+        if parts and isinstance(parts[-1], tuple):
+            prev_text, prev_trusted = parts.pop()
+            literal_text = prev_text + literal_text
+            literal_trusted = prev_trusted + literal_trusted
+        parts.append((literal_text, literal_trusted))
+
+    end = len(text)
+    literal_start = 0
+    i = text.find("%")
+    while i >= 0:
+        add_literal(literal_start, i)
+        j = i + 1
+        if j < end and text[j] == "%":
+            # escaped %: keep the second one
+            add_literal(j, j + 1)
+            literal_start = j + 1
+            i = text.find("%", literal_start)
+            continue
+
+        key = None
+        if j < end and text[j] == "(":
+            # keys can contain balanced parentheses
+            depth = 1
+            key_start = j + 1
+            while depth:
+                j += 1
+                if j >= end:
+                    raise ValueError("incomplete format key")
+                if text[j] == "(":
+                    depth += 1
+                elif text[j] == ")":
+                    depth -= 1
+            key = text[key_start:j]
+            j += 1
+
+        flags_start = j
+        while j < end and text[j] in _mod_flags:
+            j += 1
+        flags = text[flags_start:j]
+
+        width = None
+        if j < end and text[j] == "*":
+            width = "*"
+            j += 1
+        else:
+            width_start = j
+            while j < end and text[j].isdigit():
+                j += 1
+            if j > width_start:
+                width = int(text[width_start:j])
+
+        precision = None
+        if j < end and text[j] == ".":
+            j += 1
+            if j < end and text[j] == "*":
+                precision = "*"
+                j += 1
+            else:
+                precision_start = j
+                while j < end and text[j].isdigit():
+                    j += 1
+                precision = int(text[precision_start:j] or 0)
+
+        if j < end and text[j] in "hlL":
+            # length modifiers are ignored
+            j += 1
+
+        if j >= end:
+            raise ValueError("incomplete format")
+        conv = text[j]
+        if conv not in _mod_conversions:
+            raise ValueError("unsupported format character {!r} (0x{:x}) at index {}".format(
+                conv, ord(conv), j))
+
+        template = "%" + flags
+        if width is not None:
+            template += str(width)
+        if precision is not None:
+            template += "." + str(precision)
+        template += "s" if conv in "rsa" else conv
+        parts.append(_ModField(key, conv, template, width, precision, "-" in flags))
+
+        literal_start = j + 1
+        i = text.find("%", literal_start)
+    add_literal(literal_start, end)
+
+    return tuple(parts)
+
+
+def _render_mod(parts, values, builder):
+    """
+    Render the parts of a compiled printf-style format string into `builder`,
+    taking the values like str.__mod__: a tuple is the positional values, any
+    other value is the single positional value, and the mapping of the keys
+    if it's a mapping.
+    """
+    if isinstance(values, tuple):
+        args = values
+        num_args = len(values)
+        arg_index = 0
+    else:
+        args = values
+        # same as str.__mod__: `args` itself is the next (and only) value
+        num_args = -1
+        arg_index = -2
+    if not isinstance(values, (tuple, str)) and hasattr(type(values), "__getitem__"):
+        mapping = values
+    else:
+        mapping = None
+
+    for part in parts:
+        if isinstance(part, tuple):
+            builder._append(*part)
+            continue
+
+        if part.key is not None:
+            if mapping is None:
+                raise TypeError("format requires a mapping")
+            # the value of the key replaces the positional values
+            args = mapping[part.key]
+            num_args = -1
+            arg_index = -2
+
+        star_args = ()
+        width = part.width
+        precision = part.precision
+        if part.stars:
+            for star in (width, precision):
+                if star == "*":
+                    if arg_index >= num_args:
+                        raise TypeError("not enough arguments for format string")
+                    star_args += (args if num_args < 0 else args[arg_index],)
+                    arg_index += 1
+            if width == "*":
+                width = star_args[0]
+            if precision == "*":
+                precision = star_args[-1]
+
+        if arg_index >= num_args:
+            raise TypeError("not enough arguments for format string")
+        value = args if num_args < 0 else args[arg_index]
+        arg_index += 1
+
+        conv = part.conv
+        if conv == "s":
+            if not isinstance(value, safe_string):
+                value = str(value)
+        elif conv == "r":
+            value = repr(value)
+        elif conv == "a":
+            value = _safe_ascii(value) if isinstance(value, safe_string) else ascii(value)
+        elif conv != "c" or not isinstance(value, safe_string):
+            # numbers are never trusted
+            builder.append_untrusted(orig_str_mod(part.template, star_args + (value,)))
+            continue
+
+        if isinstance(value, safe_string):
+            content = value._to_unsafe_str()
+            trusted = value._trusted
         else:
-            new_trusted += trusted_result[hl_index]
-            hl_index += 1
-        final_trusted += new_trusted
-        gl_index += 1
-        prev_index = end+1
+            content = value
+            trusted = None
+        if part.template == "%s":
+            if trusted is None:
+                builder.append_untrusted(content)
+            else:
+                builder._append(content, trusted)
+            continue
 
-    final_trusted += format_string._trusted[prev_index:]
+        text = orig_str_mod(part.template, star_args + (content,))
+        if trusted is None:
+            builder.append_untrusted(text)
+            continue
+
+        content_length = len(content)
+        if precision is not None and conv != "c":
+            content_length = min(content_length, max(precision, 0))
+        pad = len(text) - content_length
+        # the padding is untrusted
+        trusted = trusted[:content_length]
+        if part.left or (isinstance(width, int) and width < 0):
+            builder._append(text, trusted.padded(0, pad))
+        else:
+            builder._append(text, trusted.padded(pad, 0))
 
-    return final_trusted
+    if arg_index < num_args and mapping is None:
+        raise TypeError("not all arguments converted during string formatting")
 
 
 def parse_field(hole):
@@ -150,36 +696,27 @@ def parse_field(hole):
     return hole, None, ""
 
 
-def get_argument(args, kwargs):
-    auto_numbering = -1
-
-    def _get_argument(name):
-        nonlocal auto_numbering
-
-        i = 0
-        end = len(name)
-        while i < end and name[i] not in ("[", "."):
-            i += 1
-
-        index = name[:i]
-        if not index:
-            auto_numbering += 1
-            return args[auto_numbering]
-        elif index.isnumeric():
-            return args[int(index)]
-        else:
-            return kwargs[index]
-
-    return _get_argument
-
+def _split_field_name(name):
+    """
+    Split a field name into the argument it refers to and the lookups on it.
 
-def resolve_lookups(obj, name):
+    The argument is None for automatic numbering, an int for positional
+    arguments and a str for keyword arguments. Each lookup is a tuple
+    (is_attribute, key), e.g. ".name[0]" -> [(True, "name"), (False, 0)].
+    """
     end = len(name)
 
     i = 0
     while i < end and name[i] not in ("[", "."):
         i += 1
 
+    index = str.__str__(name[:i])
+    if not index:
+        index = None
+    elif index.isnumeric():
+        index = int(index)
+
+    lookups = []
     while i < end:
         c = name[i]
         if c == ".":
@@ -189,8 +726,10 @@ def resolve_lookups(obj, name):
                 if name[i] in (".", "["):
                     break
                 i += 1
-            attr = name[start:i]
-            obj = getattr(obj, attr)
+            key = str.__str__(name[start:i])
+            if not key:
+                raise ValueError("Empty attribute in format string")
+            lookups.append((True, key))
 
         elif c == "[":
             i += 1
@@ -199,15 +738,52 @@ def resolve_lookups(obj, name):
                 if name[i] == "]":
                     break
                 i += 1
-            index = name[start:i]
+            if i == end:
+                raise ValueError("Missing ']' in format string")
+            key = str.__str__(name[start:i])
+            if not key:
+                raise ValueError("Empty attribute in format string")
             i += 1  # skip the ']'
-            if index.isnumeric():
-                index = int(index)
-            obj = obj[index]
+            if key.isnumeric():
+                key = int(key)
+            lookups.append((False, key))
+
+        else:
+            # same error as str.format, and don't loop forever on the character
+            raise ValueError("Only '.' or '[' may follow ']' in format field specifier")
 
+    return index, tuple(lookups)
+
+
+def _apply_lookups(obj, lookups):
+    for is_attribute, key in lookups:
+        obj = getattr(obj, key) if is_attribute else obj[key]
     return obj
 
 
+def get_argument(args, kwargs):
+    auto_numbering = -1
+
+    def _get_argument(name):
+        nonlocal auto_numbering
+
+        index, _ = _split_field_name(name)
+        if index is None:
+            auto_numbering += 1
+            return args[auto_numbering]
+        elif isinstance(index, int):
+            return args[index]
+        else:
+            return kwargs[index]
+
+    return _get_argument
+
+
+def resolve_lookups(obj, name):
+    _, lookups = _split_field_name(name)
+    return _apply_lookups(obj, lookups)
+
+
 def field_parser(args, kwargs):
     get_arg = get_argument(args, kwargs)
 
@@ -220,37 +796,81 @@ def field_parser(args, kwargs):
     return _parser
 
 
+# characters which str.splitlines splits on (in addition to "\r\n")
+_line_boundaries = frozenset("\n\r\v\f\x1c\x1d\x1e\x85\u2028\u2029")
+
+# trust of a single character, shared by all the characters __iter__ yields
+_trusted_char = TrustMap.trusted(1)
+_untrusted_char = TrustMap.untrusted(1)
+
+# char -> length of its escape in a repr (with "'" not escaped), or in _safe_ascii
+_repr_lengths = {}
+_ascii_lengths = {}
+_escape_lengths_size = 65536
+
+
+def _ascii_quoted(char):
+    # like ascii(char) for the text of a repr, in which only non-ascii characters get escaped
+    return "'" + char.encode("ascii", "backslashreplace").decode("ascii") + "'"
+
+
+def _escape_length(table, char, escape):
+    length = table.get(char)
+    if length is None:
+        length = len(escape(char)) - 2
+        if len(table) < _escape_lengths_size:
+            table[char] = length
+    return length
+
+
 class safe_string(str):
     """
     A string which tracks trust values of each character.
     """
 
     # Need to overload __new__ to not pass trusted to super().__new__.
-    # Use frozenbitarray instead of bitarray since it is immutable,
-    # similar to str. This should prevent sharing errors.
+    # Trust values are kept in an immutable TrustMap, similar to str.
+    # This should prevent sharing errors. Any other sequence of bits
+    # (e.g. a frozenbitarray) is converted to one.
     def __new__(cls, value, trusted=None):
         return super().__new__(cls, value)
 
-    def __init__(self, _string, trusted: frozenbitarray = None):
+    def __init__(self, _string, trusted: TrustMap = None):
+        if _string is self:
+            # str(s) returns s itself (see __str__), and the interpreter
+            # then calls s.__init__(s) on it: keep its trust values
+            return
         if trusted is None:
-            trusted = frozenbitarray([False]*len(_string))
+            trusted = TrustMap.untrusted(len(_string))
+        elif not isinstance(trusted, TrustMap):
+            trusted = TrustMap.from_bits(trusted)
         super().__init__()
         # keep as a private attribute
         self._trusted = trusted
 
+    @staticmethod
+    def _from_parts(string, trusted):
+        """
+        Create a safe_string from a str and its TrustMap without the
+        checks of __init__, for the hot paths which already have both.
+        """
+        self = str.__new__(safe_string, string)
+        self._trusted = trusted
+        return self
+
     @staticmethod
     def _new_untrusted(string):
         """
         Convenience method to create completely untrusted safe_string.
         """
-        return safe_string(string, trusted=frozenbitarray([False] * len(string)))
+        return safe_string(string, trusted=TrustMap.untrusted(len(string)))
 
     @staticmethod
     def _new_trusted(string):
         """
         Convenience method to create completely trusted safe_string.
         """
-        return safe_string(string, trusted=frozenbitarray([True] * len(string)))
+        return safe_string(string, trusted=TrustMap.trusted(len(string)))
 
     def _to_unsafe_str(self):
         "Convert back to a simple str."
@@ -295,12 +915,11 @@ class safe_string(str):
         if len(repr_string) - len(self) == 2:
             # nothing has been escaped; only quotes have been added
             # TODO: should these quotes be trusted? since this is performed by the developer
-            repr_trusted = frozenbitarray([False]) + self._trusted + frozenbitarray([False])
+            repr_trusted = TrustMap.untrusted(1) + self._trusted + TrustMap.untrusted(1)
         else:
-            # some characters have been escaped
-            # we have no way to know which without looping through the string
-
-            repr_trusted = bitarray([False])
+            # some characters have been escaped: find the length of the
+            # escaped text of each run of equally trusted characters
+            text = self._to_unsafe_str()
 
             # single quote is only escaped if the repr string
             # is surrounded with single quotes, but this doesn't
@@ -308,18 +927,26 @@ class safe_string(str):
             # it in double quotes).
             single_quote_escaped = (repr_string[0] == "'")
 
-            for char in self:
-                if char == "'" and single_quote_escaped:
-                    len_repr = 2
+            repr_lengths = _repr_lengths
+            repr_trusted = TrustMapBuilder()
+            repr_trusted.append_run(False, 1)
+            for start, end, value in self._trusted.spans():
+                if end - start == 1:
+                    char = text[start]
+                    if char == "'" and single_quote_escaped:
+                        len_repr = 2
+                    else:
+                        len_repr = repr_lengths.get(char) or _escape_length(repr_lengths, char, str.__repr__)
                 else:
-                    len_repr = len(str.__repr__(char)) - 2
-
-                repr_trusted.extend(char._trusted * len_repr)
-
-            repr_trusted.append(False)
-
-            # freeze to make immutable
-            repr_trusted = frozenbitarray(repr_trusted)
+                    chunk = text[start:end]
+                    chunk_repr = str.__repr__(chunk)
+                    len_repr = len(chunk_repr) - 2
+                    if single_quote_escaped and chunk_repr[0] == '"':
+                        # the chunk alone has its single quotes unescaped
+                        len_repr += chunk.count("'")
+                repr_trusted.append_run(value, len_repr)
+            repr_trusted.append_run(False, 1)
+            repr_trusted = repr_trusted.build()
 
         return safe_string(repr_string, repr_trusted)
 
@@ -328,7 +955,7 @@ class safe_string(str):
         new_string = super().__getitem__(key)
 
         if isinstance(key, int):
-            new_trusted = self._trusted[key:key + 1]
+            new_trusted = TrustMap.uniform(self._trusted[key], 1)
         elif isinstance(key, slice):
             new_trusted = self._trusted[key]
         else:
@@ -337,21 +964,33 @@ class safe_string(str):
         return safe_string(new_string, new_trusted)
 
     def __iter__(self):
-        for char, trust_bit in zip(super().__iter__(), self._trusted):
-            yield safe_string(char, frozenbitarray([trust_bit]))
+        for char, trust_bit in self._iter_trust():
+            yield safe_string(char, _trusted_char if trust_bit else _untrusted_char)
+
+    def _iter_trust(self):
+        "Iterate over (char, trust value) pairs, without creating a safe_string per char."
+        return zip(super().__iter__(), self._trusted)
 
     def __add__(self, other):
         # call str method first to get same behaviour on error
         string = orig_str_add(self, other)
         if isinstance(other, safe_string):
             trusted = self._trusted + other._trusted
-            return safe_string(string, trusted)
+            return safe_string._from_parts(string, trusted)
         elif isinstance(other, str):
-            trusted = self._trusted + (frozenbitarray([False] * len(other)))
-            return safe_string(string, trusted)
+            trusted = self._trusted.padded(0, len(other))
+            return safe_string._from_parts(string, trusted)
         else:
             raise TypeError("argument must be a str or safe_string")
 
+    def __radd__(self, other):
+        # str + safe_string: called before the cursed str.__add__, since
+        # safe_string is a subclass of str
+        if not isinstance(other, str):
+            return NotImplemented
+        string = orig_str_add(other, self)
+        return safe_string._from_parts(string, self._trusted.padded(len(other), 0))
+
     def __mul__(self, num):
         return safe_string(
             super().__mul__(num),
@@ -380,7 +1019,7 @@ class safe_string(str):
         else:
             fillchar_trust = False
 
-        trusted = self._trusted + max(0, width - len(self)) * frozenbitarray([fillchar_trust])
+        trusted = self._trusted + TrustMap.uniform(fillchar_trust, width - len(self))
         return safe_string(string, trusted)
 
     def rjust(self, width, fillchar=" "):
@@ -391,7 +1030,7 @@ class safe_string(str):
         else:
             fillchar_trust = False
 
-        trusted = max(0, width - len(self)) * frozenbitarray([fillchar_trust]) + self._trusted
+        trusted = TrustMap.uniform(fillchar_trust, width - len(self)) + self._trusted
         return safe_string(string, trusted)
 
     def center(self, width, fillchar=" "):
@@ -402,11 +1041,9 @@ class safe_string(str):
         else:
             fillchar_trust = False
 
-        fillchar_trusted = frozenbitarray([fillchar_trust])
-
         marg = width - len(self)
-        left_fill = (marg // 2 + (marg & width & 1)) * fillchar_trusted
-        right_fill = (marg - len(left_fill)) * fillchar_trusted
+        left_fill = TrustMap.uniform(fillchar_trust, marg // 2 + (marg & width & 1))
+        right_fill = TrustMap.uniform(fillchar_trust, marg - len(left_fill))
         trusted = left_fill + self._trusted + right_fill
 
         return safe_string(string, trusted)
@@ -419,9 +1056,9 @@ class safe_string(str):
 
         num_extra = len(string) - len(self)
         if string[0] == self[0]:
-            trusted = self._trusted[0:1] + frozenbitarray([False]) * num_extra + self._trusted[1:]
+            trusted = self._trusted[0:1] + TrustMap.untrusted(num_extra) + self._trusted[1:]
         else:
-            trusted = frozenbitarray([False]) * num_extra + self._trusted
+            trusted = TrustMap.untrusted(num_extra) + self._trusted
 
         return safe_string(string, trusted)
 
@@ -470,44 +1107,41 @@ class safe_string(str):
         splitted = self.split("\t")
         # keep track of idx to get trust value of \t
         oldtoken = splitted.pop(0)
-        final_trusted = bitarray(oldtoken._trusted)
-        start_idx = len(final_trusted)
+        final_trusted = TrustMapBuilder()
+        final_trusted.append(oldtoken._trusted)
+        start_idx = len(oldtoken)
         for token in splitted:
             dist = self._tabindent(oldtoken, tabsize)
-            final_trusted.extend(self._trusted[start_idx:start_idx + 1] * dist)
-            final_trusted.extend(token._trusted)
+            final_trusted.append_run(self._trusted[start_idx], dist)
+            final_trusted.append(token._trusted)
             start_idx += 1 + len(token)
             oldtoken = token
 
-        final_trusted = frozenbitarray(final_trusted)
-
-        return safe_string(string, final_trusted)
+        return safe_string(string, final_trusted.build())
 
     def splitlines(self, keepends=False):
+        result = []
+        trusted = self._trusted
+        start_idx = 0
+        # split once keeping the line ends, so that we can track the offset
+        # of each line in the original string
+        for line in super().splitlines(True):
+            end_idx = start_idx + len(line)
+            if keepends:
+                line_end = end_idx
+            elif line.endswith("\r\n"):
+                line_end = end_idx - 2
+            elif line[-1] in _line_boundaries:
+                line_end = end_idx - 1
+            else:
+                # last line without a line boundary
+                line_end = end_idx
 
-        line_boundaries = ['\n', '\r', '\r\n', '\v', '\x0b', '\f', '\x0c', '\x1c', 
-                            '\x1d', '\x1e', '\x85', '\u2028', '\u2029']
-        
-        safe_string_list = []
-        start = 0
-        i = 0
-        while i < len(self):
-            if self[i] in line_boundaries:
-                start_idx = start
-                end_idx = i+1 if keepends else i
-                if i+1 < len(self) and self[i] == '\r' and self[i+1] == '\n':
-                    if keepends:
-                        end_idx += 1
-                    safe_string_list.append(self[start_idx:end_idx])
-                    i += 1
-                else:
-                    safe_string_list.append(self[start_idx:end_idx])
-                start = i+1
-            i += 1
+            result.append(safe_string(line[:line_end - start_idx],
+                                      trusted._slice(start_idx, line_end)))
+            start_idx = end_idx
 
-        if start < len(self):
-            safe_string_list.append(self[start:])
-        return safe_string_list
+        return result
 
     def split(self, sep=None, maxsplit=-1):
         str_splits = super().split(sep, maxsplit)
@@ -564,17 +1198,17 @@ class safe_string(str):
         return result
 
     def join(self, iterable):
-        seq = iter(iterable)
-        try:
-            first_elem = next(seq)
-            final = first_elem
-        except StopIteration:
-            return safe_string("", trusted=frozenbitarray())
-
-        for elem in seq:
-            final += self + elem
-
-        return final
+        builder = Builder()
+        for i, elem in enumerate(iterable):
+            if not isinstance(elem, str):
+                # same error as str.join
+                raise TypeError("sequence item {}: expected str instance, {} found"
+                                .format(i, type(elem).__name__))
+            if i:
+                builder.append(self)
+            builder.append(elem)
+
+        return builder.build()
 
     def partition(self, sep):
         (before, sep_part, after) = super().partition(sep)
@@ -598,28 +1232,48 @@ class safe_string(str):
             safe_string(after, after_trusted)
         )
 
+    def _find_all(self, sub, count=-1):
+        """
+        Offsets of the (non-overlapping) occurrences of `sub` which
+        `str.replace` would replace, in a single left-to-right scan.
+        """
+        if count < 0:
+            count = len(self) + 1
+        if not sub:
+            # the empty string matches before each character and at the end
+            return range(min(count, len(self) + 1))
+
+        offsets = []
+        find = super().find
+        idx = find(sub)
+        while idx != -1 and len(offsets) < count:
+            offsets.append(idx)
+            idx = find(sub, idx + len(sub))
+        return offsets
+
     def replace(self, old, new, count=-1):
-        count = super().count(old) if count == -1 else min(count, super().count(old))
+        # call str method first to get same behaviour on error
         result_string = super().replace(old, new, count)
 
-        if not isinstance(new, safe_string):
-            new = self._new_untrusted(new)
-
-        result_trusted = bitarray()
-        start_idx = 0
-        while count > 0:
-            idx = self.find(old, start_idx)
-            if idx == -1:
-                break
-            else:
-                result_trusted.extend(self._trusted[start_idx:idx])
-                result_trusted.extend(new._trusted)
+        trusted = self._trusted
+        new_trusted = new._trusted if isinstance(new, safe_string) \
+            else TrustMap.untrusted(len(new))
+
+        # no need to look for matches if everything has the same trust value
+        if trusted.all() and new_trusted.all():
+            return safe_string(result_string, TrustMap.trusted(len(result_string)))
+        if not trusted.any() and not new_trusted.any():
+            return safe_string(result_string, TrustMap.untrusted(len(result_string)))
+
+        def pieces():
+            start_idx = 0
+            for idx in self._find_all(old, count):
+                yield trusted._slice(start_idx, idx)
+                yield new_trusted
                 start_idx = idx + len(old)
-                count -= 1
+            yield trusted._slice(start_idx, len(trusted))
 
-        result_trusted.extend(self._trusted[start_idx:])
-
-        return safe_string(result_string, frozenbitarray(result_trusted))
+        return safe_string(result_string, TrustMap.concat(pieces()))
 
     # XXX comment for debugging
     def __format__(self, format_spec):
@@ -631,6 +1285,16 @@ class safe_string(str):
     def format_map(self, kwargs):
         return self.format(**kwargs)
 
+    def __mod__(self, values):
+        return safe_mod(self, values)
+
+    def __rmod__(self, fmt_string):
+        # str % safe_string: called before str.__mod__, since safe_string
+        # is a subclass of str. The format string is untrusted.
+        if not isinstance(fmt_string, str):
+            return NotImplemented
+        return safe_mod(safe_string._new_untrusted(fmt_string), self)
+
     def title(self):
         return safe_string(
             super().title(),
@@ -668,12 +1332,71 @@ class safe_string(str):
         )
 
 
+class Builder:
+    """
+    Mutable builder for safe_strings.
+
+    Repeatedly adding safe_strings copies both the text and the trust values
+    each time. The builder instead accumulates the text chunks and trust runs,
+    and creates a single safe_string in `build()`.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._trusted = TrustMapBuilder()
+
+    def __len__(self):
+        return len(self._trusted)
+
+    def _append(self, text, trusted):
+        "Append a plain str with the given trust values."
+        self._chunks.append(text)
+        self._trusted.append(trusted)
+
+    def append(self, string):
+        """
+        Append a str, keeping the trust values of safe_strings.
+        Other strings are untrusted.
+        """
+        if isinstance(string, safe_string):
+            self._chunks.append(string._to_unsafe_str())
+            self._trusted.append(string._trusted)
+        elif isinstance(string, str):
+            self.append_untrusted(string)
+        else:
+            raise TypeError("can only append str (not \"{}\")".format(type(string).__name__))
+
+    def append_trusted(self, string):
+        "Append a str as completely trusted."
+        self._chunks.append(str.__str__(string))
+        self._trusted.append_run(True, len(string))
+
+    def append_untrusted(self, string):
+        "Append a str as completely untrusted."
+        self._chunks.append(str.__str__(string))
+        self._trusted.append_run(False, len(string))
+
+    def extend(self, strings):
+        "Append each str of an iterable."
+        for string in strings:
+            self.append(string)
+
+    def build(self):
+        "Create the safe_string of everything appended so far."
+        return safe_string("".join(self._chunks), self._trusted.build())
+
+
 def new_str_add(str1, str2):
-    if isinstance(str2, safe_string):
-        str1 = safe_string._new_untrusted(str1)
-        return str1 + str2
-    else:
-        return orig_str_add(str1, str2)
+    # every str + str of the interpreter which isn't specialized by the
+    # bytecode comes through here, so keep the plain case short.
+    # Exceptions can't propagate out of the ctypes callback which calls this:
+    # for anything but str + safe_string return NotImplemented, and the
+    # interpreter falls back on the (uncursed) sequence concat slot of str,
+    # which is the original str + str with its errors.
+    if isinstance(str2, safe_string) and isinstance(str1, str):
+        string = orig_str_add(str1, str2)
+        return safe_string._from_parts(string, str2._trusted.padded(len(str1), 0))
+    return NotImplemented
 
 
 def new_str_format(fmt_string, *args, **kwargs):
@@ -690,7 +1413,24 @@ def new_str_format(fmt_string, *args, **kwargs):
             *args, **kwargs)
 
 
-curse(str, "__add__", new_str_add)
+def _curse_slot(klass, attr, func):
+    """
+    Curse a dunder method like forbiddenfruit's curse, but have the C slot
+    call `func` directly instead of through forbiddenfruit's generic
+    (*args, **kwargs) wrapper, which costs about a third of the call.
+    `func` must return NotImplemented itself rather than raise NotImplementedError.
+    """
+    curse(klass, attr, func)
+    tp_as_name, impl_method = override_dict[attr]
+    cfunc = tp_func_dict[(klass, attr)]
+    direct = type(cfunc)(func)
+    # keep a reference to the callback, like curse does
+    tp_func_dict[(klass, attr)] = direct
+    tp_as = getattr(PyTypeObject.from_address(id(klass)), tp_as_name)[0]
+    setattr(tp_as, impl_method, direct)
+
+
+_curse_slot(str, "__add__", new_str_add)
 curse(str, "format", new_str_format)
 
 
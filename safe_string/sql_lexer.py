@@ -0,0 +1,180 @@
+import re
+
+# dialects
+GENERIC = "generic"
+SQLITE = "sqlite"
+POSTGRES = "postgres"
+MYSQL = "mysql"
+
+# token types
+WHITESPACE = "whitespace"
+COMMENT = "comment"
+STRING = "string"
+NUMBER = "number"
+IDENTIFIER = "identifier"  # keywords and unquoted names
+QUOTED_IDENTIFIER = "quoted_identifier"
+PLACEHOLDER = "placeholder"
+OPERATOR = "operator"
+PUNCTUATION = "punctuation"
+ERROR = "error"
+
+LITERALS = frozenset([STRING, NUMBER])
+
+
+# The generic dialect follows the rules of sqlparse's lexer, so that it
+# classifies literals exactly like `sqlparse.parse(...).flatten()`:
+# '' and \' escapes in strings, "..." is a string too, and a leading
+# minus sign is part of a number.
+_generic_rules = [
+    (COMMENT, r"/\*[\s\S]*?\*/"),
+    (STRING, r'(?<![\w"$])\$(?P<tag>(?:[_A-ZÀ-Ü]\w*)?)\$[\s\S]*?\$(?P=tag)\$'),
+    (COMMENT, r"(?:--|\# ).*?(?:\r\n|\r|\n|$)"),
+    (WHITESPACE, r"\s+"),
+    (OPERATOR, r":="),
+    (PUNCTUATION, r"::"),
+    (OPERATOR, r"\*"),
+    (QUOTED_IDENTIFIER, r"`(?:``|[^`])*`"),
+    (QUOTED_IDENTIFIER, r"´(?:´´|[^´])*´"),
+    (PLACEHOLDER, r"\?"),
+    (PLACEHOLDER, r"%(?:\(\w+\))?s"),
+    (PLACEHOLDER, r"(?<!\w)[$:?]\w+"),
+    (IDENTIFIER, r"\\\w+"),
+    (IDENTIFIER, r"(?:CASE|IN|VALUES|USING|FROM|AS)\b"),
+    (IDENTIFIER, r"(?:@|\#\#|\#)[A-ZÀ-Ü]\w+"),
+    (IDENTIFIER, r"[A-ZÀ-Ü]\w*(?=\s*\.(?!\d))"),
+    (IDENTIFIER, r"[A-ZÀ-Ü]\w*(?=\()"),
+    (NUMBER, r"-?0x[\dA-F]+"),
+    (NUMBER, r"-?\d+(?:\.\d+)?E-?\d+"),
+    (NUMBER, r"-?(?:\d+\.\d*|\.\d+)(?![_A-ZÀ-Ü])"),
+    (NUMBER, r"-?\d+(?![_A-ZÀ-Ü])"),
+    (STRING, r"'(?:''|\\'|[^'])*'"),
+    (STRING, r'"(?:""|\\"|[^"])*"'),
+    (STRING, r'(?:""|".*?[^\\]")'),
+    (QUOTED_IDENTIFIER, r"(?<![\w\])])\[[^\]\[]+\]"),
+    # keywords spanning several words
+    (IDENTIFIER, r"(?:(?:LEFT\s+|RIGHT\s+|FULL\s+)?(?:INNER\s+|OUTER\s+|STRAIGHT\s+)?"
+                 r"|(?:CROSS\s+|NATURAL\s+)?)?JOIN\b"),
+    (IDENTIFIER, r"END(?:\s+IF|\s+LOOP|\s+WHILE|\s+FOR|\s+CASE)?\b"),
+    (IDENTIFIER, r"IF\s+(?:NOT\s+)?EXISTS\b"),
+    (IDENTIFIER, r"NOT\s+NULL\b"),
+    (IDENTIFIER, r"(?:ASC|DESC)(?:\s+NULLS\s+(?:FIRST|LAST))?\b"),
+    (IDENTIFIER, r"NULLS\s+(?:FIRST|LAST)\b"),
+    (IDENTIFIER, r"UNION\s+ALL\b"),
+    (IDENTIFIER, r"CREATE(?:\s+OR\s+REPLACE)?\b"),
+    (IDENTIFIER, r"DOUBLE\s+PRECISION\b"),
+    (IDENTIFIER, r"(?:GROUP|ORDER)\s+BY\b"),
+    (IDENTIFIER, r"PRIMARY\s+KEY\b"),
+    (IDENTIFIER, r"HANDLER\s+FOR\b"),
+    (IDENTIFIER, r"GO(?:\s\d+)\b"),
+    (IDENTIFIER, r"LATERAL\s+VIEW\s+(?:EXPLODE|INLINE|PARSE_URL_TUPLE|POSEXPLODE|STACK)\b"),
+    (IDENTIFIER, r"(?:AT|WITH')\s+TIME\s+ZONE\s+'[^']+'"),
+    (OPERATOR, r"(?:NOT\s+)?(?:LIKE|ILIKE|RLIKE)\b"),
+    (OPERATOR, r"(?:NOT\s+)?REGEXP(?:\s+BINARY)?\b"),
+    (IDENTIFIER, r"\w[$#\w]*"),
+    (PUNCTUATION, r"[;:()\[\],.]"),
+    (OPERATOR, r"(?:->>?|\#>>?|@>|<@|\?\|?|\?&|-|\#-)"),
+    (OPERATOR, r"[<>=~!]+"),
+    (OPERATOR, r"[+/@\#%^&|-]+"),
+]
+
+# SQLite: no escapes in strings, "..." `...` and [...] are identifiers,
+# unterminated block comments run until the end of the query.
+_sqlite_rules = [
+    (COMMENT, r"/\*[\s\S]*?(?:\*/|\Z)"),
+    (COMMENT, r"--[^\r\n]*"),
+    (WHITESPACE, r"\s+"),
+    (STRING, r"X'[\dA-F]*'"),
+    (STRING, r"'(?:''|[^'])*'"),
+    (QUOTED_IDENTIFIER, r'"(?:""|[^"])*"'),
+    (QUOTED_IDENTIFIER, r"`(?:``|[^`])*`"),
+    (QUOTED_IDENTIFIER, r"\[[^\]]*\]"),
+    (PLACEHOLDER, r"\?\d*"),
+    (PLACEHOLDER, r"[:@$][A-Z_]\w*"),
+    (NUMBER, r"-?0x[\dA-F]+(?![\w$])"),
+    (NUMBER, r"-?(?:\d+(?:\.\d*)?|\.\d+)(?:E[+-]?\d+)?(?![\w$])"),
+    (IDENTIFIER, r"\w[\w$]*"),
+    (OPERATOR, r"\|\||<<|>>|<=|>=|==|!=|<>|->>?|[-+*/%&|~<>=]"),
+    (PUNCTUATION, r"[;(),.]"),
+]
+
+# Postgres: standard conforming strings, E'' strings with backslash escapes,
+# $tag$ quoted strings, "..." identifiers and $1 parameters.
+# Nested block comments are not supported, the nested part is lexed as code.
+_postgres_rules = [
+    (COMMENT, r"/\*[\s\S]*?\*/"),
+    (COMMENT, r"--[^\r\n]*"),
+    (WHITESPACE, r"\s+"),
+    (STRING, r"(?<![\w$])\$(?P<tag>(?:[A-Z_][\w]*)?)\$[\s\S]*?\$(?P=tag)\$"),
+    (STRING, r"E'(?:''|\\[\s\S]|[^'\\])*'"),
+    (STRING, r"(?:[BX]|U&)?'(?:''|[^'])*'"),
+    (QUOTED_IDENTIFIER, r'(?:U&)?"(?:""|[^"])*"'),
+    (PLACEHOLDER, r"\$\d+"),
+    (PLACEHOLDER, r"%(?:\(\w+\))?s"),
+    (NUMBER, r"-?0[XOB][\dA-F_]+(?![\w$])"),
+    (NUMBER, r"-?(?:\d+(?:\.\d*)?|\.\d+)(?:E[+-]?\d+)?(?![\w$])"),
+    (IDENTIFIER, r"\w[\w$]*"),
+    (PUNCTUATION, r"::|[;(),.\[\]:]"),
+    (OPERATOR, r"[-+*/<>=~!@\#%^&|`?]+"),
+]
+
+# MySQL: backslash escapes in strings, "..." is a string, `...` is an
+# identifier, # comments and -- comments followed by whitespace.
+_mysql_rules = [
+    (COMMENT, r"/\*[\s\S]*?\*/"),
+    (COMMENT, r"\#[^\r\n]*"),
+    (COMMENT, r"--(?:\s[^\r\n]*)?(?=[\r\n]|\Z)|--\s[^\r\n]*"),
+    (WHITESPACE, r"\s+"),
+    (STRING, r"(?:[XBN])?'(?:''|\\[\s\S]|[^'\\])*'"),
+    (STRING, r'"(?:""|\\[\s\S]|[^"\\])*"'),
+    (QUOTED_IDENTIFIER, r"`(?:``|[^`])*`"),
+    (PLACEHOLDER, r"\?"),
+    (PLACEHOLDER, r"%(?:\(\w+\))?s"),
+    (NUMBER, r"-?0x[\dA-F]+(?![\w$])"),
+    (NUMBER, r"-?0b[01]+(?![\w$])"),
+    (NUMBER, r"-?(?:\d+(?:\.\d*)?|\.\d+)(?:E[+-]?\d+)?(?![\w$])"),
+    (IDENTIFIER, r"@@?[\w.$]+"),
+    (IDENTIFIER, r"[\w$]+"),
+    (OPERATOR, r":=|<=>|<<|>>|<=|>=|!=|<>|&&|\|\||->>?|[-+*/%&|^~<>=!]"),
+    (PUNCTUATION, r"[;(),.]"),
+]
+
+
+def _compile(rules):
+    """
+    Combine the rules into a single regex, with one named group per rule.
+    Like sqlparse, the first rule which matches at a position wins.
+    """
+    pattern = "|".join("(?P<t{}>{})".format(i, regex) for i, (_, regex) in enumerate(rules))
+    types = {"t{}".format(i): ttype for i, (ttype, _) in enumerate(rules)}
+    return re.compile(pattern, re.IGNORECASE | re.UNICODE).match, types
+
+
+_dialects = {
+    GENERIC: _compile(_generic_rules),
+    SQLITE: _compile(_sqlite_rules),
+    POSTGRES: _compile(_postgres_rules),
+    MYSQL: _compile(_mysql_rules),
+}
+
+
+def tokenize(query, dialect=GENERIC, pos=0):
+    """
+    Split an sql query into tokens, yielding (type, start, end) for each.
+
+    Tokens cover the whole query from `pos` on: characters which don't
+    start any token are yielded as single character ERROR tokens.
+    """
+    try:
+        match, types = _dialects[dialect]
+    except KeyError:
+        raise ValueError("unknown sql dialect: {!r}".format(dialect)) from None
+
+    end = len(query)
+    while pos < end:
+        m = match(query, pos)
+        if m is None:
+            yield ERROR, pos, pos + 1
+            pos += 1
+        else:
+            yield types[m.lastgroup], pos, m.end()
+            pos = m.end()
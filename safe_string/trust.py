@@ -0,0 +1,391 @@
+from bisect import bisect_left, bisect_right
+from itertools import repeat
+
+from bitarray import bitarray
+
+
+class TrustMap:
+    """
+    Immutable map of the trust values of each character of a safe_string.
+
+    Instead of storing one bit per character, only the boundaries of the
+    trusted runs are stored: `_bounds` is a sorted tuple (s0, e0, s1, e1, ...)
+    where each [s, e) is a maximal run of trusted characters. A character at
+    index i is trusted iff an odd number of boundaries are <= i.
+
+    Completely untrusted strings have no boundaries and completely trusted
+    strings have exactly one run, so memory is O(number of trust boundaries)
+    and concatenating uniform maps is O(1).
+
+    Supports the subset of the frozenbitarray interface used on `_trusted`
+    (indexing, slicing, +, *, iteration, comparison, all/any/count/to01).
+    """
+
+    __slots__ = ("_length", "_bounds")
+
+    def __init__(self, length=0, bounds=()):
+        # `bounds` must already be canonical (sorted, no empty or adjacent runs).
+        # Use the classmethods to construct maps from other values.
+        self._length = length
+        self._bounds = bounds
+
+    @classmethod
+    def trusted(cls, length):
+        "Map with `length` trusted characters."
+        return cls(length, (0, length)) if length > 0 else cls()
+
+    @classmethod
+    def untrusted(cls, length):
+        "Map with `length` untrusted characters."
+        return cls(max(length, 0))
+
+    @classmethod
+    def uniform(cls, value, length):
+        "Map with `length` characters, all having the trust value `value`."
+        return cls.trusted(length) if value else cls.untrusted(length)
+
+    @classmethod
+    def from_bits(cls, bits):
+        """
+        Convert a sequence of trust values (TrustMap, bitarray, list of bools...)
+        into a TrustMap.
+        """
+        if isinstance(bits, TrustMap):
+            return bits
+
+        bounds = []
+        if isinstance(bits, bitarray):
+            # let bitarray search for the run boundaries in C
+            length = len(bits)
+            pos = 0
+            value = True
+            while pos < length:
+                try:
+                    pos = bits.index(value, pos)
+                except ValueError:
+                    break
+                bounds.append(pos)
+                value = not value
+        else:
+            length = 0
+            value = False
+            for bit in bits:
+                if bool(bit) != value:
+                    bounds.append(length)
+                    value = not value
+                length += 1
+
+        if len(bounds) % 2:
+            bounds.append(length)
+
+        return cls(length, tuple(bounds))
+
+    @classmethod
+    def concat(cls, maps):
+        """
+        Concatenate an iterable of TrustMaps in a single pass.
+        Equivalent to summing them, without building the intermediate maps.
+        """
+        builder = TrustMapBuilder()
+        for trust in maps:
+            builder.append(trust)
+        return builder.build()
+
+    def runs(self):
+        "Iterate over the (start, end) ranges of trusted characters."
+        bounds = self._bounds
+        return zip(bounds[::2], bounds[1::2])
+
+    def spans(self):
+        "Iterate over (start, end, value) for each maximal run of equally trusted characters."
+        pos = 0
+        for start, end in self.runs():
+            if start > pos:
+                yield pos, start, False
+            yield start, end, True
+            pos = end
+        if pos < self._length:
+            yield pos, self._length, False
+
+    def padded(self, before, after):
+        "Map with `before` untrusted characters prepended and `after` appended."
+        bounds = self._bounds
+        if before and bounds:
+            bounds = tuple([b + before for b in bounds])
+        return TrustMap(before + self._length + after, bounds)
+
+    def _slice(self, start, stop):
+        "Trust values of [start, stop) for 0 <= start <= stop <= len(self)."
+        length = stop - start
+        bounds = self._bounds
+        if not bounds or not length:
+            return TrustMap(length)
+        if len(bounds) == 2 and bounds[0] <= start and stop <= bounds[1]:
+            return TrustMap.trusted(length)
+
+        # bounds[i:j] are the boundaries strictly inside (start, stop).
+        # An odd number of boundaries <= start means `start` is trusted,
+        # and similarly for `stop - 1`.
+        i = bisect_right(bounds, start)
+        j = bisect_left(bounds, stop)
+        if j - i >= _view_min_bounds and (j - i) * _view_max_ratio >= len(bounds):
+            # large enough to be worth not copying, and not so small that
+            # it would keep alive a disproportionately large parent
+            return _TrustMapView(length, bounds, start, i, j)
+        return TrustMap(length, _sliced_bounds(bounds, start, length, i, j))
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        pos = 0
+        for start, end in self.runs():
+            yield from repeat(False, start - pos)
+            yield from repeat(True, end - start)
+            pos = end
+        yield from repeat(False, self._length - pos)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self._length)
+            if step == 1:
+                return self._slice(start, max(start, stop))
+            return TrustMap.from_bits(
+                bisect_right(self._bounds, i) % 2 == 1
+                for i in range(start, stop, step)
+            )
+
+        if key < 0:
+            key += self._length
+        if not 0 <= key < self._length:
+            raise IndexError("TrustMap index out of range")
+
+        return bisect_right(self._bounds, key) % 2 == 1
+
+    def __add__(self, other):
+        other = _coerce(other)
+        if other is None:
+            return NotImplemented
+
+        if not other._length:
+            return self
+        if not self._length:
+            return other
+
+        shift = self._length
+        left = self._bounds
+        right = other._bounds
+        if left and right and left[-1] == shift and right[0] == 0:
+            # trusted run continues across the boundary
+            left = left[:-1]
+            right = right[1:]
+
+        return TrustMap(
+            shift + other._length,
+            left + tuple([b + shift for b in right])
+        )
+
+    def __radd__(self, other):
+        other = _coerce(other)
+        if other is None:
+            return NotImplemented
+        return other + self
+
+    def __mul__(self, num):
+        if not isinstance(num, int):
+            return NotImplemented
+
+        if num <= 0 or not self._length:
+            return TrustMap()
+        if not self._bounds:
+            return TrustMap(self._length * num)
+        if self.all():
+            return TrustMap.trusted(self._length * num)
+
+        # tile the bounds in one pass: adding the copies one by one would
+        # copy the growing bounds every time
+        length = self._length
+        bounds = self._bounds
+        if bounds[0] == 0 and bounds[-1] == length:
+            # the last run of a copy continues into the first run of the next
+            inner = bounds[1:-1]
+            tiled = [0]
+            for offset in range(0, length * num, length):
+                tiled.extend([b + offset for b in inner])
+            tiled.append(length * num)
+        else:
+            tiled = [b + offset for offset in range(0, length * num, length) for b in bounds]
+        return TrustMap(length * num, tuple(tiled))
+
+    __rmul__ = __mul__
+
+    def __eq__(self, other):
+        other = _coerce(other)
+        if other is None:
+            return NotImplemented
+
+        return self._length == other._length and self._bounds == other._bounds
+
+    def __hash__(self):
+        return hash((self._length, self._bounds))
+
+    def __repr__(self):
+        return "TrustMap(length={}, runs={})".format(self._length, list(self.runs()))
+
+    def all(self):
+        "True if every character is trusted."
+        return not self._length or self._bounds == (0, self._length)
+
+    def any(self):
+        "True if any character is trusted."
+        return bool(self._bounds)
+
+    def find(self, value, start=0, stop=None):
+        "Index of the first character in [start, stop) with the trust value `value`, or -1."
+        start, stop, _ = slice(start, stop).indices(self._length)
+        if start >= stop:
+            return -1
+
+        i = bisect_right(self._bounds, start)
+        if (i % 2 == 1) == bool(value):
+            return start
+        # the trust value changes at the next boundary
+        if i < len(self._bounds) and self._bounds[i] < stop:
+            return self._bounds[i]
+        return -1
+
+    def rfind(self, value, start=0, stop=None):
+        "Index of the last character in [start, stop) with the trust value `value`, or -1."
+        start, stop, _ = slice(start, stop).indices(self._length)
+        if start >= stop:
+            return -1
+
+        j = bisect_right(self._bounds, stop - 1)
+        if (j % 2 == 1) == bool(value):
+            return stop - 1
+        # the trust value changes at the previous boundary
+        if j > 0 and self._bounds[j - 1] - 1 >= start:
+            return self._bounds[j - 1] - 1
+        return -1
+
+    def count(self, value=True):
+        "Number of characters with the trust value `value`."
+        num_trusted = sum(end - start for start, end in self.runs())
+        return num_trusted if value else self._length - num_trusted
+
+    def to01(self):
+        return "".join("1" if bit else "0" for bit in self)
+
+
+
+# Slices with at least this many boundaries, and at least 1/ratio of the
+# boundaries of the map they are taken from, are lazy views.
+_view_min_bounds = 16
+_view_max_ratio = 4
+
+
+def _sliced_bounds(bounds, start, length, i, j):
+    "Boundaries of the slice [start, start + length), given bounds[i:j] are strictly inside it."
+    new_bounds = [b - start for b in bounds[i:j]]
+    if i % 2:
+        new_bounds.insert(0, 0)
+    if j % 2:
+        new_bounds.append(length)
+    return tuple(new_bounds)
+
+
+class _TrustMapView(TrustMap):
+    """
+    A slice of a TrustMap which shares the boundaries of the map it was
+    taken from, and only copies its own out of them when they are first
+    used. Most slices of a string (split and partition results, tokens...)
+    never have their trust looked at.
+    """
+
+    __slots__ = ("_parent_bounds", "_start", "_i", "_j")
+
+    def __init__(self, length, parent_bounds, start, i, j):
+        # `_bounds` is left unset until __getattr__ computes it
+        self._length = length
+        self._parent_bounds = parent_bounds
+        self._start = start
+        self._i = i
+        self._j = j
+
+    def __getattr__(self, name):
+        # only called for unset slots
+        if name != "_bounds":
+            raise AttributeError(name)
+        bounds = _sliced_bounds(self._parent_bounds, self._start, self._length, self._i, self._j)
+        self._bounds = bounds
+        self._parent_bounds = None
+        return bounds
+
+    def _slice(self, start, stop):
+        if self._parent_bounds is None:
+            return super()._slice(start, stop)
+        # slice the parent's boundaries directly, without materializing ours
+        return TrustMap(0, self._parent_bounds)._slice(self._start + start, self._start + stop)
+
+    def all(self):
+        if self._parent_bounds is None:
+            return super().all()
+        # no boundary inside, and the slice starts in a trusted run
+        return self._i == self._j and self._i % 2 == 1
+
+    def any(self):
+        if self._parent_bounds is None:
+            return super().any()
+        return self._i != self._j or self._i % 2 == 1
+
+
+class TrustMapBuilder:
+    """
+    Accumulates trust values piece by piece and builds one TrustMap at the end,
+    without creating the intermediate maps that repeated + would.
+    """
+
+    __slots__ = ("_length", "_bounds")
+
+    def __init__(self):
+        self._length = 0
+        self._bounds = []
+
+    def __len__(self):
+        return self._length
+
+    def append(self, trust):
+        "Append the trust values of a TrustMap."
+        piece = trust._bounds
+        if piece:
+            bounds = self._bounds
+            length = self._length
+            if bounds and bounds[-1] == length and piece[0] == 0:
+                # trusted run continues across the boundary
+                bounds.pop()
+                piece = piece[1:]
+            bounds.extend([b + length for b in piece] if length else piece)
+        self._length += trust._length
+
+    def append_run(self, value, length):
+        "Append `length` characters with the trust value `value`."
+        if length <= 0:
+            return
+        if value:
+            bounds = self._bounds
+            if bounds and bounds[-1] == self._length:
+                bounds[-1] += length
+            else:
+                bounds.append(self._length)
+                bounds.append(self._length + length)
+        self._length += length
+
+    def build(self):
+        return TrustMap(self._length, tuple(self._bounds))
+
+
+def _coerce(other):
+    "Convert bit sequences to a TrustMap for binary operations, or None if unsupported."
+    if isinstance(other, (TrustMap, bitarray, list, tuple)):
+        return TrustMap.from_bits(other)
+    return None
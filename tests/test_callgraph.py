@@ -0,0 +1,142 @@
+import ast
+import textwrap
+
+from safe_string import callgraph
+
+
+MODULES = {
+    "app.db": '''
+        import sqlite3
+        from app.names import TABLE, column as col
+
+        conn = sqlite3.connect(":memory:")
+        conn.execute("CREATE TABLE " + TABLE + " (name TEXT)")
+
+
+        def run(query):
+            return conn.execute(query).fetchall()
+
+
+        def where(name):
+            clause = col() + " = '" + name + "'"
+            return clause
+
+
+        def get_user(name):
+            query = "SELECT * FROM " + TABLE + " WHERE " + where(name)
+            log("looking up " + name)
+            return run(query)
+
+
+        def log(message):
+            print("log: " + message)
+    ''',
+    "app.names": '''
+        TABLE = "users"
+        UNUSED = "nothing"
+
+
+        def column():
+            return "name"
+    ''',
+    "app.report": '''
+        from app.db import get_user
+
+
+        class Report:
+            TITLE = "report"
+
+            def render(self, name):
+                return self.TITLE + ": " + crunch(10) + str(get_user(name))
+
+
+        def crunch(n):
+            return "-".join(str(i) for i in range(n))
+    ''',
+}
+
+
+def summaries(modules=MODULES):
+    return {name: callgraph.summarize(ast.parse(textwrap.dedent(source)), name)
+            for name, source in modules.items()}
+
+
+def test_regions():
+    tree = ast.parse(textwrap.dedent(MODULES["app.report"]))
+    assert [key for key, scope, node in callgraph.regions(tree)] == [
+        "<module>:2", "Report:6", "Report.render", "crunch"]
+
+
+def test_select_regions_reaching_the_sinks_and_feeding_them():
+    selected = callgraph.select(summaries())
+    assert selected == {
+        # the sink calls, the callers building the query and the
+        # functions returning its pieces, not the logging
+        "app.db": {"<module>:6", "run", "where", "get_user"},
+        "app.names": {"<module>:2", "column"},
+        # calls get_user but none of its values flow into the query
+        "app.report": {"Report.render"},
+    }
+
+
+def test_allow_and_deny():
+    selected = callgraph.select(summaries(), allow=["app.report.crunch"], deny=["app.names"])
+    assert selected["app.report"] == {"Report.render", "crunch"}
+    assert selected["app.names"] == set()
+    # denied regions still carry the flow
+    assert "where" in selected["app.db"]
+
+    selected = callgraph.select(summaries(), allow=["app.report"])
+    assert selected["app.report"] == {"<module>:2", "Report:6", "Report.render", "crunch"}
+
+
+def test_methods_and_constructors():
+    selected = callgraph.select(summaries({"app.repo": '''
+        class Repository:
+            def __init__(self, conn):
+                self.conn = conn
+                self.conn.execute("PRAGMA foreign_keys = ON")
+
+            def find(self, name):
+                return self.conn.execute(self.query(), (name,))
+
+            def query(self):
+                return "SELECT * FROM users WHERE name = ?"
+
+            def unrelated(self):
+                return "nothing"
+
+
+        def make(conn):
+            return Repository(conn)
+    '''}))
+    assert selected["app.repo"] == {
+        "Repository.__init__", "Repository.find", "Repository.query", "make"}
+
+
+def test_matches():
+    assert callgraph.matches(["app.db"], "app.db.get_user")
+    assert callgraph.matches(["app.*"], "app.db.Queries.get")
+    assert not callgraph.matches(["app.db"], "app.dbx.get_user")
+    assert not callgraph.matches([], "app")
+
+
+def test_queries_stored_in_attributes():
+    selected = callgraph.select(summaries({"app.repo": '''
+        def build(table):
+            return "SELECT * FROM " + table
+
+
+        class Repository:
+            def __init__(self, conn):
+                self.conn = conn
+                self.query = build("users") + " WHERE id = ?"
+                self.label = "repository"
+
+            def find(self, cur, id):
+                return cur.execute(self.query, (id,)).fetchall()
+
+            def describe(self):
+                return self.label
+    '''}))
+    assert selected["app.repo"] == {"build", "Repository.__init__", "Repository.find"}
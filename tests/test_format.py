@@ -4,9 +4,16 @@ from safe_string.safe_string import (
     get_argument,
     resolve_lookups,
     field_parser,
+    format_cache_info,
+    format_cache_clear,
+    set_format_cache_size,
+    format_cache_size,
 )
 
+from safe_string.trust import TrustMap
 from bitarray import frozenbitarray
+import random
+import pytest
 
 def test_parse_field():
     assert parse_field("{}") == ("", None, "")
@@ -69,6 +76,299 @@ def test_field_parser():
     assert parser("{name[0]:[1]}") == ("f", None, "[1]")
 
 
+def test_format_cache_hits_on_repeated_templates():
+    format_cache_clear()
+    template = safe_string._new_trusted("SELECT * FROM t WHERE a = '{}' AND b = {{{b}}}")
+    for i in range(10):
+        value = safe_string._new_untrusted("v" * i)
+        result = template.format(value, b=i)
+        assert result == "SELECT * FROM t WHERE a = '{}' AND b = {{{}}}".format(value._to_unsafe_str(), i)
+        prefix = len("SELECT * FROM t WHERE a = '")
+        assert result._trusted[:prefix].all()
+        assert not result._trusted[prefix:prefix + i].any()
+        assert result._trusted[prefix + i:-2].all()
+        assert not result._trusted[-2:-1].any()
+        assert result._trusted[-1:].all()
+
+    info = format_cache_info()
+    assert (info["hits"], info["misses"], info["currsize"]) == (9, 1, 1)
+    assert info["hit_rate"] == 0.9
+
+    # same text with different trust values is compiled separately
+    untrusted_template = safe_string._new_untrusted(template._to_unsafe_str())
+    assert not untrusted_template.format("x", b=1)._trusted.any()
+    assert format_cache_info()["misses"] == 2
+
+    format_cache_clear()
+    info = format_cache_info()
+    assert (info["hits"], info["misses"], info["currsize"]) == (0, 0, 0)
+
+
+def test_format_cache_is_bounded():
+    try:
+        set_format_cache_size(2)
+        for i in range(5):
+            safe_string._new_trusted("{}" + "x" * i).format(i)
+        info = format_cache_info()
+        assert info["maxsize"] == 2
+        assert info["currsize"] == 2
+    finally:
+        set_format_cache_size(format_cache_size)
+
+
+def test_format_matches_str_format():
+    nino = b"Ni\xc3\xb10".decode("utf-8")
+    cases = [
+        ("{} and {}", (1, "two"), {}),
+        ("{:>10}|{:<6}|{:^7}", ("a", "bc", "def"), {}),
+        ("{0!r:^12} {0!s} {0!a}", (nino,), {}),
+        ("{:{}}|", ("a", 5), {}),
+        ("{0:{1}{2}}", ("a", ">", 5), {}),
+        ("{0[}]} {0[k]}", ({"}": 1, "k": 2},), {}),
+        ("a{{b}}c{{{x}}}", (), {"x": "y"}),
+        ("{x.real} {y[1]}", (), {"x": 3, "y": [4, 5]}),
+        ("{:.2}|{:05}|{:x^8.3}", ("abcdef", "ab", "abcdef"), {}),
+        ("{:08.3f} {:,}", (3.14159, 1234567), {}),
+    ]
+    for template, args, kwargs in cases:
+        safe_args = [safe_string._new_untrusted(arg) if isinstance(arg, str) else arg
+                     for arg in args]
+        for fmt in (safe_string._new_trusted(template), safe_string._new_untrusted(template)):
+            for fmt_args in (args, safe_args):
+                result = fmt.format(*fmt_args, **kwargs)
+                assert result == template.format(*args, **kwargs)
+                assert len(result._trusted) == len(result)
+
+
+def test_format_trusts_only_safe_string_characters():
+    fmt = safe_string._new_untrusted("{:>6}|{:x<5.1}|{!r}|{!a}")
+    value = safe_string._new_trusted("ab")
+    nino = safe_string._new_trusted(b"\xc3\xb1".decode("utf-8"))
+    result = fmt.format(value, value, value, nino)
+    assert result == "    ab|axxxx|'ab'|'\\xf1'"
+    assert result._trusted.to01() == "000011" "0" "10000" "0" "0110" "0" "011110"
+
+
+def test_format_s_conversion_keeps_the_trust_of_safe_strings():
+    # not depending on the warm up of str(), see test_mod_s_keeps_the_trust_of_safe_strings
+    for _ in range(100):
+        value = safe_string._new_trusted("ab")
+        result = safe_string._new_untrusted("{0!s:>4}|{0!s}").format(value)
+        assert result == "  ab|ab"
+        assert result._trusted.to01() == "0011" "0" "11"
+        assert value._trusted.all()
+
+
+def test_format_ascii_conversion_keeps_trust_of_escaped_chars():
+    chars = "ab '\"\\\n\xe9\xff\u20ac\U0001f600"
+    fmt = safe_string._new_untrusted("{!a}")
+    for _ in range(200):
+        text = "".join(random.choices(chars, k=random.randint(0, 30)))
+        trusted = [random.random() < 0.5 for _ in text]
+        result = fmt.format(safe_string(text, trusted))
+        assert result == ascii(text)
+
+        # the repr of the string, with each non-ascii char escaped
+        value_repr = repr(safe_string(text, trusted))
+        expected = []
+        for char, trust_bit in zip(value_repr, value_repr._trusted):
+            expected.extend([trust_bit] * len(char.encode("ascii", "backslashreplace")))
+        assert result._trusted == TrustMap.from_bits(expected)
+
+
+def test_format_renders_each_field_once():
+    class Expensive:
+        calls = 0
+
+        def __format__(self, spec):
+            Expensive.calls += 1
+            return "formatted"
+
+        def __repr__(self):
+            Expensive.calls += 1
+            return "repr"
+
+    fmt = safe_string._new_trusted("{} {!r} {!s:>12}")
+    assert fmt.format(Expensive(), Expensive(), Expensive()) == "formatted repr         repr"
+    assert Expensive.calls == 3
+
+
+def test_format_raises_same_errors_as_str_format():
+    cases = [
+        ("}", (), ValueError),
+        ("{", (), ValueError),
+        ("{0}{}", (1, 2), ValueError),
+        ("{}{0}", (1, 2), ValueError),
+        ("{1}", (1,), IndexError),
+        ("{name}", (1,), KeyError),
+        ("{0!x}", (1,), ValueError),
+        ("{:d}", ("a",), ValueError),
+        # malformed field names
+        ("{0[0]x}", ("ab",), ValueError),
+        ("{a[b]c}", (), KeyError),
+        ("{>[]]}", (), KeyError),
+        ("]{[]axx}", ("ab",), ValueError),
+        ("{0[]}", ("ab",), ValueError),
+        ("{0.}", ("ab",), ValueError),
+        ("{0..real}", (1,), ValueError),
+    ]
+    for template, args, error in cases:
+        with pytest.raises(error) as str_error:
+            template.format(*args)
+        with pytest.raises(error) as safe_error:
+            safe_string._new_trusted(template).format(*args)
+        assert str(safe_error.value) == str(str_error.value)
+
+
+
+def test_mod_matches_str_mod():
+    nino = b"Ni\xc3\xb10".decode("utf-8")
+    cases = [
+        ("%s and %s", (1, "two")),
+        ("%s", "single"),
+        ("%s", ((1, 2),)),
+        ("%s", {"a": 1}),
+        ("%s", [1, 2]),
+        ("no fields", [1]),
+        ("%10s|%-6s|%.2s|%5.1s", ("a", "bc", "def", "ghi")),
+        ("%*s|%-*s|%.*s|%*.*s", (5, "a", 4, "b", 2, "cdef", -6, 1, "gh")),
+        ("%r %a %s", (nino, nino, nino)),
+        ("%4d %s", (5, "foo")),
+        ("%05.1f|%+d|% d|%#x|%#o|%X|%e|%G|%i|%u|%c|%c|%5c", (3.14159, 3, 4, 255, 8, 255, 1e5, 1e-7, 7, 8, "x", 65, "y")),
+        ("%ld %hs", (3, "h")),
+        ("%(name)s is %(age)5d, %%, %(name)-6r|", {"name": "bob", "age": 42}),
+        ("%(a(b))s %(a(b))s", {"a(b)": 1}),
+        ("%s %(a)s", {"a": 1}),
+        ("100%% %s", ("sure",)),
+    ]
+    for template, values in cases:
+        safe_values = values
+        if isinstance(values, tuple):
+            safe_values = tuple(safe_string._new_untrusted(value) if isinstance(value, str) else value
+                                for value in values)
+        elif isinstance(values, dict):
+            safe_values = {key: safe_string._new_untrusted(value) if isinstance(value, str) else value
+                           for key, value in values.items()}
+        fmt = safe_string._new_trusted(template)
+        for mod_values in (values, safe_values):
+            result = fmt % mod_values
+            assert isinstance(result, safe_string)
+            assert result == template % values
+            assert len(result._trusted) == len(result)
+
+
+def test_mod_trusts_only_safe_string_characters():
+    fmt = safe_string._new_trusted("a%5s|%-4s|%.1r|%d|%%")
+    value = safe_string._new_trusted("xy")
+    plain = "pq"
+    result = fmt % (value, plain, value, 12)
+    assert result == "a   xy|pq  |'|12|%"
+    assert result._trusted.to01() == "1" "00011" "1" "0000" "1" "0" "1" "00" "11"
+
+    keyed = safe_string._new_untrusted("%(a)3s") % {"a": value}
+    assert keyed == " xy"
+    assert keyed._trusted.to01() == "011"
+
+
+def test_mod_s_keeps_the_trust_of_safe_strings():
+    # the first calls of a call site aren't specialized by the interpreter,
+    # which then runs safe_string.__init__ again on the result of str()
+    for _ in range(100):
+        value = safe_string._new_trusted("ab")
+        result = safe_string._new_trusted("%5s") % (value,)
+        assert result._trusted.to01() == "00011"
+        assert value._trusted.all()
+        assert str(value) is value
+        assert value._trusted.all()
+
+
+def test_mod_trust_of_padded_values():
+    for _ in range(200):
+        text = "".join(random.choices("ab c", k=random.randint(0, 8)))
+        value = safe_string(text, [random.random() < 0.5 for _ in text])
+        width = random.choice([None, random.randint(-10, 10)])
+        precision = random.choice([None, random.randint(-2, 10)])
+        left = random.random() < 0.5
+
+        template = "%" + ("-" if left else "") + "*" * (width is not None) + ".*" * (precision is not None) + "s"
+        star_args = tuple(arg for arg in (width, precision) if arg is not None)
+        result = safe_string._new_trusted(template) % (star_args + (value,))
+        assert result == template % (star_args + (text,))
+
+        content = len(text) if precision is None else min(len(text), max(precision, 0))
+        pad = len(result) - content
+        content_trusted = value._trusted.to01()[:content]
+        if left or (width is not None and width < 0):
+            assert result._trusted.to01() == content_trusted + "0" * pad
+        else:
+            assert result._trusted.to01() == "0" * pad + content_trusted
+
+
+def test_rmod_keeps_trust_of_safe_string_value():
+    value = safe_string("ab", [True, False])
+    result = "x=%s" % value
+    assert isinstance(result, safe_string)
+    assert result == "x=ab"
+    assert result._trusted.to01() == "0010"
+
+
+def test_mod_renders_each_value_once():
+    class Expensive:
+        calls = 0
+
+        def __str__(self):
+            Expensive.calls += 1
+            return "str"
+
+        def __repr__(self):
+            Expensive.calls += 1
+            return "repr"
+
+    fmt = safe_string._new_trusted("%s %r %-6s|")
+    assert fmt % (Expensive(), Expensive(), Expensive()) == "str repr str   |"
+    assert Expensive.calls == 3
+
+
+def test_mod_raises_same_errors_as_str_mod():
+    cases = [
+        ("%", (), ValueError),
+        ("%(a", {"a": 1}, ValueError),
+        ("%y", (1,), ValueError),
+        ("%5%", (1,), ValueError),
+        ("%s", (), TypeError),
+        ("%s", (1, 2), TypeError),
+        ("x", 5, TypeError),
+        ("%(a)s", 5, TypeError),
+        ("%(a)s %s", {"a": 1}, TypeError),
+        ("%(b)s", {"a": 1}, KeyError),
+        ("%d", ("a",), TypeError),
+        ("%*s", ("a", "b"), TypeError),
+        ("%c", ("ab",), TypeError),
+    ]
+    for template, values, error in cases:
+        with pytest.raises(error) as str_error:
+            template % values
+        with pytest.raises(error) as safe_error:
+            safe_string._new_trusted(template) % values
+        assert str(safe_error.value) == str(str_error.value)
+
+
+def test_mod_shares_the_format_cache():
+    format_cache_clear()
+    template = safe_string._new_trusted("SELECT * FROM t WHERE a = '%s' AND b = %d")
+    for i in range(10):
+        result = template % (safe_string._new_untrusted("v" * i), i)
+        assert result == "SELECT * FROM t WHERE a = '%s' AND b = %d" % ("v" * i, i)
+    info = format_cache_info()
+    assert (info["hits"], info["misses"], info["currsize"]) == (9, 1, 1)
+
+    # the same text as a str.format format string is compiled separately
+    safe_string._new_trusted("%s {}").format(1)
+    template % ("a", 1)
+    assert format_cache_info()["misses"] == 2
+    format_cache_clear()
+
+
 if __name__ == '__main__':
     fmt_s = "{name[0]!a} {!s} {!r}"
     fmt = safe_string(fmt_s, trusted=frozenbitarray([True] * len(fmt_s)))
@@ -0,0 +1,120 @@
+import importlib
+import os.path
+import sys
+
+import pytest
+
+from safe_string import import_hook
+from safe_string.safe_string import safe_string
+
+
+QUERIES = '''
+TABLE = "users"
+
+
+def query(name):
+    return "SELECT * FROM " + TABLE + " WHERE name = '" + name + "'"
+
+
+def fquery(name):
+    return f"{TABLE!r:>{len(name)}}"
+'''
+
+
+@pytest.fixture
+def app_dir(tmp_path, monkeypatch):
+    "A package `hookapp` with a `queries` module, importable from tmp_path/app."
+    package = tmp_path / "app" / "hookapp"
+    package.mkdir(parents=True)
+    (package / "__init__.py").write_text('"""The app."""\n')
+    (package / "queries.py").write_text(QUERIES)
+    monkeypatch.syspath_prepend(str(tmp_path / "app"))
+    yield tmp_path / "app"
+    import_hook.uninstall()
+    for name in list(sys.modules):
+        if name.split(".")[0] in ("hookapp", "otherapp"):
+            del sys.modules[name]
+
+
+def test_imported_literals_are_trusted(app_dir):
+    import_hook.install(paths=[str(app_dir)])
+    from hookapp import queries
+
+    assert isinstance(queries.TABLE, safe_string)
+    result = queries.query("x' OR 1=1 --")
+    assert result == "SELECT * FROM users WHERE name = 'x' OR 1=1 --'"
+    prefix = len("SELECT * FROM users WHERE name = '")
+    assert result._trusted[:prefix].all()
+    assert not result._trusted[prefix:-1].any()
+    assert result._trusted[-1]
+
+    assert queries.fquery("abcdefghij") == "   'users'"
+    assert not hasattr(queries, "safe_string")
+
+
+def test_modules_outside_the_paths_are_not_rewritten(app_dir, tmp_path, monkeypatch):
+    other = tmp_path / "other" / "otherapp"
+    other.mkdir(parents=True)
+    (other / "__init__.py").write_text('NAME = "other"\n')
+    monkeypatch.syspath_prepend(str(tmp_path / "other"))
+
+    import_hook.install(paths=[str(app_dir)])
+    import otherapp
+    import hookapp.queries
+
+    assert type(otherapp.NAME) is str
+    assert isinstance(hookapp.queries.TABLE, safe_string)
+
+
+def test_packages_are_rewritten_wherever_they_are(app_dir):
+    import_hook.install(packages=["hookapp"])
+    from hookapp import queries
+
+    assert isinstance(queries.TABLE, safe_string)
+
+
+def test_rewritten_code_is_cached(app_dir, monkeypatch):
+    monkeypatch.setattr(sys, "dont_write_bytecode", False)
+    import_hook.install(paths=[str(app_dir)])
+    source = app_dir / "hookapp" / "queries.py"
+
+    import hookapp.queries
+    cached = import_hook.cache_path(str(source))
+    assert os.path.exists(cached)
+    assert hookapp.queries.__cached__ == cached
+
+    # imported again from the cache, without rewriting
+    def fail(data, path):
+        raise AssertionError("rewritten again")
+
+    del sys.modules["hookapp.queries"]
+    with monkeypatch.context() as patch:
+        patch.setattr(import_hook, "compile_source", fail)
+        queries = importlib.import_module("hookapp.queries")
+    assert isinstance(queries.TABLE, safe_string)
+
+    # a changed source is rewritten again
+    source.write_text(QUERIES.replace('"users"', '"people"'))
+    del sys.modules["hookapp.queries"]
+    queries = importlib.import_module("hookapp.queries")
+    assert queries.TABLE == "people"
+    assert isinstance(queries.TABLE, safe_string)
+
+
+def test_main_runs_modules(app_dir, monkeypatch):
+    (app_dir / "hookapp" / "cli.py").write_text('''
+import sys
+import hookapp
+from hookapp.queries import query
+
+hookapp.result = query(sys.argv[1]) + ";", __name__
+''')
+    monkeypatch.setattr(sys, "argv", ["import_hook", "--path", str(app_dir),
+                                      "-m", "hookapp.cli", "x'"])
+    import_hook.main()
+
+    import hookapp
+    result, name = hookapp.result
+    assert name == "__main__"
+    assert result == "SELECT * FROM users WHERE name = 'x'';"
+    assert result._trusted.to01() == "1" * 34 + "00" "11"
@@ -0,0 +1,97 @@
+import sqlite3
+import urllib.request
+
+import pytest
+
+from safe_string.safe_string import safe_string
+from safe_string import metrics, safe_execute, safe_sql
+from safe_string.metrics import Histogram
+
+
+class NullSink:
+    def emit(self, event):
+        pass
+
+
+@pytest.fixture
+def null_sink(monkeypatch):
+    "Don't write the events of the detected injections to stderr."
+    monkeypatch.setattr(safe_execute, "event_sink", NullSink())
+
+
+@pytest.fixture
+def enabled_metrics(monkeypatch, null_sink):
+    metrics.reset()
+    monkeypatch.setattr(metrics, "enabled", True)
+    yield
+    metrics.reset()
+
+
+def run_queries():
+    cursor = sqlite3.connect(":memory:").cursor()
+    template = safe_string._new_trusted("SELECT '{}'")
+    for i in range(10):
+        cursor.execute(template.format(i))
+    with pytest.raises(sqlite3.Error):
+        cursor.execute(template.format("' OR 1=1 --"))
+
+
+def test_histogram():
+    histogram = Histogram((1, 10, 100))
+    for value in (0, 1, 5, 10, 50, 1000):
+        histogram.observe(value)
+    assert list(histogram.cumulative()) == [(1, 2), (10, 4), (100, 5), (float("inf"), 6)]
+    assert histogram.sum == 1066 and histogram.count == 6
+
+
+def test_timed_has_sqli():
+    query = safe_string._new_trusted("SELECT '{}'").format("' OR 1=1 --")
+    sqli, lex_seconds, trust_check_seconds = safe_sql.timed_has_sqli(query)
+    assert sqli == safe_sql.has_sqli(query)
+    assert lex_seconds > 0 and trust_check_seconds > 0
+
+
+def test_guard_records_metrics(enabled_metrics):
+    run_queries()
+    driver = metrics.snapshot()["sqlite3.Cursor"]
+    assert driver["calls"] == 11
+    assert driver["detections"] == 1
+    for name in ("check_seconds", "lex_seconds", "trust_check_seconds", "query_length"):
+        assert driver[name]["count"] == 11
+    assert driver["query_length"]["sum"] == sum(len("SELECT '{}'".format(i)) for i in range(10)) \
+        + len("SELECT '' OR 1=1 --'")
+    assert driver["check_seconds"]["sum"] >= driver["lex_seconds"]["sum"]
+
+
+def test_disabled_metrics_record_nothing(null_sink):
+    metrics.reset()
+    run_queries()
+    assert metrics.snapshot() == {}
+
+
+def test_prometheus_text(enabled_metrics, tmp_path):
+    run_queries()
+    text = metrics.to_prometheus()
+    assert '# TYPE safe_string_guard_calls_total counter' in text
+    assert 'safe_string_guard_calls_total{driver="sqlite3.Cursor"} 11' in text
+    assert 'safe_string_guard_detections_total{driver="sqlite3.Cursor"} 1' in text
+    assert '# TYPE safe_string_guard_query_length histogram' in text
+    assert 'safe_string_guard_query_length_bucket{driver="sqlite3.Cursor",le="+Inf"} 11' in text
+    assert 'safe_string_guard_query_length_count{driver="sqlite3.Cursor"} 11' in text
+
+    path = tmp_path / "guard.prom"
+    metrics.write_prometheus(str(path))
+    assert path.read_text() == text
+    assert [p.name for p in tmp_path.iterdir()] == ["guard.prom"]
+
+
+def test_prometheus_http(enabled_metrics):
+    run_queries()
+    server = metrics.serve_prometheus(port=0)
+    try:
+        url = "http://127.0.0.1:{}/metrics".format(server.server_address[1])
+        with urllib.request.urlopen(url) as response:
+            assert response.read().decode() == metrics.to_prometheus()
+    finally:
+        server.shutdown()
+        server.server_close()
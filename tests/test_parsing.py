@@ -0,0 +1,206 @@
+import ast
+
+from safe_string import safe_string as safe_string_module
+from safe_string.parsing import transform_tree
+from safe_string.safe_string import safe_string
+
+
+SOURCE = '''
+"""The module."""
+from __future__ import annotations
+
+__all__ = ["loop", "Queries"]
+
+
+def loop(n) -> "list":
+    "Build n queries."
+    queries = []
+    for i in range(n):
+        queries.append("SELECT " + {"table": "users"}["table"])
+    return queries
+
+
+class Queries:
+    "Some queries."
+    __slots__ = ("name",)
+
+    def get(self, name: "str"):
+        return "SELECT " + name
+'''
+
+
+def run(source, hoist=True, select=None):
+    "Rewrite and run `source`, returning its globals."
+    tree = ast.parse(source)
+    transform_tree(tree, "__safe_string__", hoist=hoist, select=select)
+    namespace = {"__safe_string__": safe_string_module}
+    exec(compile(tree, "<test>", "exec"), namespace)
+    return namespace
+
+
+def test_literals_are_trusted():
+    for hoist in (True, False):
+        namespace = run(SOURCE, hoist)
+        queries = namespace["loop"](2)
+        assert queries == ["SELECT users"] * 2
+        for query in queries:
+            assert isinstance(query, safe_string)
+            assert query._trusted.all()
+        query = namespace["Queries"]().get(safe_string._new_untrusted("x"))
+        assert query._trusted[:-1].all()
+        assert not query._trusted[-1]
+
+
+def test_literals_are_created_once(monkeypatch):
+    created = []
+    new_trusted = safe_string._new_trusted
+
+    def counting(string):
+        created.append(string)
+        return new_trusted(string)
+
+    monkeypatch.setattr(safe_string, "_new_trusted", staticmethod(counting))
+    namespace = run(SOURCE)
+    count = len(created)
+    # once per distinct literal, "SELECT " is in both functions
+    assert sorted(created) == ["SELECT ", "table", "users"]
+    namespace["loop"](10)
+    namespace["Queries"]().get("x")
+    assert len(created) == count
+
+
+def test_plain_literals_stay_str():
+    namespace = run(SOURCE)
+    assert namespace["__doc__"] == "The module."
+    assert namespace["loop"].__doc__ == "Build n queries."
+    assert namespace["Queries"].__doc__ == "Some queries."
+    assert namespace["__all__"] == ["loop", "Queries"]
+    assert all(type(name) is str for name in namespace["__all__"])
+    assert all(type(name) is str for name in namespace["Queries"].__slots__)
+    assert type(namespace["loop"].__annotations__["return"]) is str
+    assert type(namespace["Queries"].get.__annotations__["name"]) is str
+
+
+def test_match_patterns_are_not_rewritten():
+    namespace = run('''
+def kind(value):
+    match value:
+        case "a":
+            return "letter a"
+        case _:
+            return "other"
+''')
+    assert namespace["kind"]("a") == "letter a"
+    assert isinstance(namespace["kind"]("b"), safe_string)
+
+
+FSTRINGS = '''
+class Money:
+    def __format__(self, spec):
+        return "$" + format(12.5, spec)
+
+    def __repr__(self):
+        return "Money()"
+
+
+def render(name, n, width, money):
+    return [
+        f"SELECT * FROM users WHERE name = '{name}'",
+        f"{name!r:>{width}}",
+        f"{n:{width}.{n}f} and {n:#x}",
+        f"{name=} {n = }",
+        f"{money} {money:>{width}.1f} {money!r} {money!a:^20}",
+        f"{{literal}} {name!s:*<{width + 3}}",
+        f"{'nested ' + name}" f" {n}",
+        f"no fields",
+    ]
+'''
+
+
+def test_fstrings_format_like_fstrings():
+    plain = {}
+    exec(FSTRINGS, plain)
+    for hoist in (True, False):
+        namespace = run(FSTRINGS, hoist)
+        for args in (("bob", 3, 12), ("é\n", 0, 1)):
+            expected = plain["render"](*args, plain["Money"]())
+            results = namespace["render"](*args, namespace["Money"]())
+            assert results == expected
+            assert all(isinstance(result, safe_string) for result in results)
+
+
+def test_fstrings_keep_trust():
+    namespace = run(FSTRINGS)
+    name = safe_string("bo'b", [True, True, False, True])
+    money = namespace["Money"]()
+    query, padded, *_, nested, literal = namespace["render"](name, 3, 8, money)
+
+    prefix = len("SELECT * FROM users WHERE name = '")
+    assert query._trusted[:prefix].all()
+    assert list(query._trusted[prefix:prefix + 4]) == [True, True, False, True]
+    assert query._trusted[-1]
+
+    # the repr is untrusted where the safe_string is, the padding is untrusted
+    assert padded == '  "bo\'b"'
+    assert not padded._trusted[:2].any()
+    assert literal._trusted.all()
+    # the format of a plain value is untrusted, the space between is trusted
+    assert nested == "nested bo'b 3"
+    assert list(nested._trusted) == [True] * 9 + [False, True, True, False]
+
+
+def test_fstring_s_conversion_keeps_trust():
+    namespace = run('''
+def convert(x):
+    return f"{x!s}", f"{x!s:>6}"
+''')
+    # not only once the interpreter has specialized the str() calls
+    for _ in range(100):
+        x = safe_string("bo'b", [True, True, False, True])
+        converted, padded = namespace["convert"](x)
+        assert converted == "bo'b"
+        assert converted._trusted.to01() == "1101"
+        assert padded._trusted.to01() == "00" "1101"
+        assert x._trusted.to01() == "1101"
+
+
+def test_fstring_formatters_are_created_once(monkeypatch):
+    created = []
+    formatter = safe_string_module.FStringFormatter
+
+    def counting(parts):
+        created.append(parts)
+        return formatter(parts)
+
+    monkeypatch.setattr(safe_string_module, "FStringFormatter", counting)
+    namespace = run(FSTRINGS + '''
+def twice(name):
+    return f"SELECT * FROM users WHERE name = '{name}'"
+''')
+    count = len(created)
+    assert count == 7
+    namespace["render"]("bob", 3, 12, namespace["Money"]())
+    namespace["twice"]("bob")
+    assert len(created) == count
+
+
+def test_only_selected_regions_are_rewritten():
+    namespace = run('''
+TABLE = "users"
+OTHER = "other"
+
+
+class Queries:
+    KIND = "kind"
+
+    def get(self):
+        return "SELECT * FROM " + TABLE
+
+    def label(self):
+        return f"label {OTHER}"
+''', select={"<module>:2", "Queries.get"})
+    assert isinstance(namespace["TABLE"], safe_string)
+    assert type(namespace["OTHER"]) is str
+    assert type(namespace["Queries"].KIND) is str
+    assert namespace["Queries"]().get()._trusted.all()
+    assert type(namespace["Queries"]().label()) is str
@@ -0,0 +1,28 @@
+from safe_string import rec
+
+
+def test_selective_rewrite(tmp_path):
+    app = tmp_path / "app"
+    app.mkdir()
+    (app / "repo.py").write_text('''
+import sqlite3
+
+
+class Repo:
+    def __init__(self):
+        self.conn = sqlite3.connect(":memory:")
+        self.query = "SELECT 1"
+
+    def run(self):
+        return self.conn.cursor().execute(self.query).fetchall()
+''')
+    cpu = "# a comment\ndef crunch(n):\n    return 'x' * n  # another\n"
+    (app / "cpu.py").write_text(cpu)
+
+    out = tmp_path / "out"
+    assert rec.run(str(app), str(out), processes=1, quiet=True, selective=True) == []
+    # without selected regions, copied as it is
+    assert (out / "cpu.py").read_text() == cpu
+    rewritten = (out / "repo.py").read_text()
+    assert "_new_trusted('SELECT 1')" in rewritten
+    assert "import safe_execute" in rewritten
@@ -0,0 +1,54 @@
+import io
+import json
+import threading
+
+from safe_string.reporting import JsonLinesSink
+
+
+def test_sink_writes_json_lines():
+    out = io.StringIO()
+    sink = JsonLinesSink(out)
+    for i in range(100):
+        sink.emit({"i": i, "range": (i, i + 1)})
+    sink.flush()
+    lines = out.getvalue().splitlines()
+    assert [json.loads(line) for line in lines] == [{"i": i, "range": [i, i + 1]} for i in range(100)]
+
+
+class BlockedFile:
+    "A file whose writes block until released."
+
+    def __init__(self):
+        self.released = threading.Event()
+        self.lines = []
+
+    def write(self, line):
+        self.released.wait()
+        self.lines.append(line)
+
+    def flush(self):
+        pass
+
+
+def test_sink_never_blocks():
+    out = BlockedFile()
+    sink = JsonLinesSink(out, maxsize=10)
+    for i in range(100):
+        sink.emit({"i": i})
+    # the writer holds one event, the queue ten more
+    assert 89 <= sink.dropped <= 90
+
+    out.released.set()
+    sink.flush()
+    assert len(out.lines) == 100 - sink.dropped
+
+
+def test_sink_survives_write_errors():
+    class BrokenFile:
+        def write(self, line):
+            raise OSError("disk full")
+
+    sink = JsonLinesSink(BrokenFile())
+    sink.emit({"i": 1})
+    sink.emit({"i": 2})
+    sink.flush()
@@ -0,0 +1,193 @@
+import asyncio
+import sqlite3
+import threading
+
+import pytest
+
+from safe_string.safe_string import safe_string
+from safe_string import safe_execute, safe_sql
+
+
+class ListSink:
+    def __init__(self):
+        self.events = []
+
+    def emit(self, event):
+        self.events.append(event)
+
+
+@pytest.fixture(autouse=True)
+def sink(monkeypatch):
+    "Collect the events of the detected injections, instead of writing them to stderr."
+    sink = ListSink()
+    monkeypatch.setattr(safe_execute, "event_sink", sink)
+    return sink
+
+
+@pytest.fixture
+def cursor():
+    conn = sqlite3.connect(":memory:")
+    cursor = conn.cursor()
+    cursor.execute(safe_string._new_trusted("CREATE TABLE people (id INTEGER, name TEXT)"))
+    yield cursor
+    conn.close()
+
+
+def test_execute(cursor):
+    template = safe_string._new_trusted("SELECT * FROM people WHERE name = '{}'")
+    cursor.execute(template.format("bobby"))
+    with pytest.raises(sqlite3.Error):
+        cursor.execute(template.format("' OR 1=1 --"))
+    with pytest.raises(sqlite3.Error):
+        cursor.execute("SELECT * FROM people")
+
+
+def test_execute_checks_queries_in_the_dialect_of_the_driver(cursor):
+    # the backslash doesn't escape the quote in sqlite (it does in mysql)
+    template = safe_string._new_trusted("SELECT * FROM people WHERE name = '{}'")
+    with pytest.raises(sqlite3.Error):
+        cursor.execute(template.format("\\' OR 1=1 --"))
+    cursor.execute(template.format("back\\slash"))
+
+
+def test_executemany_checks_template_once(cursor, monkeypatch):
+    checked = []
+    consumed = []
+    has_sqli = safe_sql.has_sqli
+
+    def counting_has_sqli(query, dialect):
+        # the rows must not be read before the template is checked
+        checked.append(len(consumed))
+        return has_sqli(query, dialect)
+
+    def rows(n):
+        for i in range(n):
+            consumed.append(i)
+            yield (i, "name{}".format(i))
+
+    monkeypatch.setattr(safe_sql, "has_sqli", counting_has_sqli)
+    query = safe_string._new_trusted("INSERT INTO people VALUES (?, ?)")
+    cursor.executemany(query, rows(1000))
+
+    assert checked == [0]
+    assert len(consumed) == 1000
+    cursor.execute(safe_string._new_trusted("SELECT count(*) FROM people"))
+    assert cursor.fetchone() == (1000,)
+
+
+def test_executemany_rejects_sqli(cursor):
+    def rows():
+        raise AssertionError("rows read before rejecting the query")
+        yield
+
+    query = safe_string._new_trusted("INSERT INTO people VALUES (?, '{}')").format("x'); DROP TABLE people; --")
+    with pytest.raises(sqlite3.Error):
+        cursor.executemany(query, rows())
+
+
+class AsyncConnection:
+    "An asyncio sqlite driver stand-in, with aiosqlite/asyncpg style methods."
+
+    def __init__(self):
+        self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+
+    async def execute(self, query, *args):
+        await asyncio.sleep(0)
+        return self.conn.execute(query, *args)
+
+    async def executemany(self, query, rows):
+        await asyncio.sleep(0)
+        return self.conn.executemany(query, rows)
+
+    async def fetch(self, query, *args):
+        await asyncio.sleep(0)
+        return self.conn.execute(query, *args).fetchall()
+
+
+safe_execute.guard_async_class(AsyncConnection, sqlite3.Error, "sqlite")
+
+
+def test_async_execute():
+    async def main():
+        conn = AsyncConnection()
+        await conn.execute(safe_string._new_trusted("CREATE TABLE people (id INTEGER, name TEXT)"))
+        await conn.executemany(safe_string._new_trusted("INSERT INTO people VALUES (?, ?)"),
+                               ((i, "name") for i in range(10)))
+
+        template = safe_string._new_trusted("SELECT id FROM people WHERE name = '{}'")
+        assert len(await conn.fetch(template.format("name"))) == 10
+        for func in (conn.execute, conn.fetch):
+            with pytest.raises(sqlite3.Error):
+                await func(template.format("' OR 1=1 --"))
+        with pytest.raises(sqlite3.Error):
+            await conn.executemany(template.format("' OR 1=1 --"), [])
+
+    asyncio.run(main())
+
+
+def test_async_long_queries_are_checked_in_a_thread(sink, monkeypatch):
+    threads = []
+    has_sqli = safe_sql.has_sqli
+
+    def recording_has_sqli(query, dialect):
+        threads.append((query, threading.get_ident()))
+        return has_sqli(query, dialect)
+
+    monkeypatch.setattr(safe_sql, "has_sqli", recording_has_sqli)
+    monkeypatch.setattr(safe_execute, "async_offload_threshold", 100)
+    template = safe_string._new_trusted("SELECT '{}'")
+
+    short = template.format("short")
+    long = template.format("long" * 100)
+    sqli = template.format("' OR 1=1 --" * 100)
+
+    async def main():
+        conn = AsyncConnection()
+        await conn.fetch(short)
+        await conn.fetch(long)
+        with pytest.raises(sqlite3.Error):
+            await conn.fetch(sqli)
+
+    asyncio.run(main())
+    # the event of the offloaded check has the stack of the caller
+    [event] = sink.events
+    assert any(" in main" in frame for frame in event["stack"])
+
+    main_thread = threading.get_ident()
+    # the stand-in's own sqlite3 calls are checked in the main thread too
+    assert {thread for query, thread in threads if query is short} == {main_thread}
+    assert any(thread != main_thread for query, thread in threads if query is long)
+    assert [thread != main_thread for query, thread in threads if query is sqli] == [True]
+
+
+def test_block_policy_reports_and_raises(cursor, sink):
+    template = safe_string._new_trusted("SELECT * FROM people WHERE name = '{}'")
+    query = template.format("' OR 1=1 --")
+    with pytest.raises(sqlite3.Error):
+        cursor.execute(query)
+
+    [event] = sink.events
+    assert event["query"] == query
+    assert event["class"] == "sqlite3.Cursor"
+    assert event["untrusted"] == [(35, 46)]
+    assert query[event["sqli"]["start"]:event["sqli"]["end"]] == "OR"
+    assert any("test_block_policy_reports_and_raises" in frame for frame in event["stack"])
+
+
+def test_monitoring_policies(cursor, sink, monkeypatch):
+    template = safe_string._new_trusted("SELECT * FROM people WHERE name = '{}'")
+    query = template.format("' OR 1=1 --")
+
+    monkeypatch.setattr(safe_execute, "policy", safe_execute.LOG_ONLY)
+    cursor.execute(query)
+    assert len(sink.events) == 1
+
+    monkeypatch.setattr(safe_execute, "policy", safe_execute.sample(0))
+    for _ in range(100):
+        cursor.execute(query)
+    assert len(sink.events) == 1
+
+    monkeypatch.setattr(safe_execute, "policy", safe_execute.sample(0.5))
+    for _ in range(1000):
+        cursor.execute(query)
+    assert 300 < len(sink.events) < 700
@@ -0,0 +1,172 @@
+import os.path
+import random
+
+import pytest
+import sqlparse
+
+from safe_string.safe_string import safe_string
+from safe_string import safe_sql
+from safe_string.safe_sql import (
+    has_sqli, verdict_cache_info, verdict_cache_clear, set_verdict_cache_size,
+    verdict_cache_size,
+)
+
+EVALUATION_DIR = os.path.join(os.path.dirname(__file__), "..", "evaluation")
+
+TEMPLATES = [
+    "SELECT * FROM people WHERE field = '{}'",
+    'SELECT * FROM people WHERE field = "{}"',
+    "SELECT * FROM people WHERE id = {}",
+    "SELECT * FROM people WHERE id = {} ORDER BY name; DELETE FROM log -- done",
+    "INSERT INTO people (name, note) VALUES ('{}', 'x''s /* not a comment */')",
+]
+
+
+def read_payloads(name):
+    with open(os.path.join(EVALUATION_DIR, name)) as fp:
+        return [line.rstrip("\n") for line in fp]
+
+
+def reference_has_sqli(query):
+    "has_sqli checking every token of the full parse tree."
+    start_idx = 0
+    for statement in sqlparse.parse(query):
+        for token in statement.flatten():
+            end_idx = start_idx + len(token.value)
+            if token.ttype not in sqlparse.tokens.Literal and \
+                    token.ttype not in sqlparse.tokens.Whitespace:
+                if not query._trusted[start_idx:end_idx].all():
+                    return True
+            start_idx = end_idx
+    return False
+
+
+def gen_queries():
+    payloads = read_payloads("payload_string.csv") + read_payloads("payload_numeric.csv")
+    for template in TEMPLATES:
+        template = safe_string._new_trusted(template)
+        for payload in payloads:
+            yield template.format(payload)
+
+
+def test_has_sqli_matches_full_parse():
+    for query in gen_queries():
+        assert bool(has_sqli(query)) == reference_has_sqli(query)
+
+
+def test_has_sqli_with_random_trust():
+    for query in gen_queries():
+        unsafe = query._to_unsafe_str()
+        trusted = [random.random() < 0.9 for _ in unsafe]
+        query = safe_string(unsafe, trusted)
+        assert bool(has_sqli(query)) == reference_has_sqli(query)
+
+
+def test_trusted_queries_have_no_sqli():
+    for template in TEMPLATES:
+        assert not has_sqli(safe_string._new_trusted(template))
+    assert not has_sqli(safe_string._new_trusted(""))
+
+
+def test_untrusted_queries_have_sqli():
+    assert has_sqli("SELECT 1")
+    assert has_sqli(safe_string._new_untrusted("SELECT 1"))
+    template = safe_string._new_trusted("SELECT * FROM people WHERE field = '{}'")
+    assert not has_sqli(template.format("bobby"))
+    assert has_sqli(template.format("' OR 1=1 --"))
+
+
+def test_has_sqli_dialects():
+    template = safe_string._new_trusted("SELECT * FROM people WHERE field = '{}'")
+    for dialect in ("generic", "sqlite", "postgres", "mysql"):
+        assert not has_sqli(template.format("bobby"), dialect)
+        assert has_sqli(template.format("' OR 1=1 --"), dialect)
+
+    # a backslash only escapes the quote where the dialect supports it
+    query = template.format("\\' OR 1=1 --")
+    assert not has_sqli(query, "mysql")
+    assert has_sqli(query, "sqlite")
+    assert has_sqli(query, "postgres")
+
+    # "..." is an identifier in sqlite, not a string
+    query = safe_string._new_trusted('SELECT * FROM people WHERE field = "{}"').format("name")
+    assert not has_sqli(query, "mysql")
+    assert has_sqli(query, "sqlite")
+
+
+def test_has_sqli_reports_offending_token():
+    template = safe_string._new_trusted("SELECT * FROM people WHERE field = '{}' AND id = 1")
+    query = template.format("' OR 1=1 --")
+    sqli = has_sqli(query)
+    start = query.index("OR")
+    assert (sqli.start, sqli.end) == (start, start + 2)
+    assert query[sqli.start:sqli.end] == "OR"
+    assert sqli.token_type == "identifier"
+
+    sqli = has_sqli("SELECT 1")
+    assert sqli and (sqli.start, sqli.end, sqli.token_type) == (0, 8, None)
+
+    for query in gen_queries():
+        sqli = has_sqli(query)
+        if sqli:
+            assert not query._trusted[sqli.start:sqli.end].all()
+
+
+@pytest.fixture
+def empty_verdict_cache():
+    verdict_cache_clear()
+    yield
+    set_verdict_cache_size(verdict_cache_size)
+    verdict_cache_clear()
+
+
+def test_verdict_cache_hits(empty_verdict_cache):
+    template = safe_string._new_trusted("SELECT * FROM people WHERE name = '{}' AND id = {}")
+    assert not has_sqli(template.format("bobby", 1))
+    assert verdict_cache_info()["misses"] == 1
+    assert verdict_cache_info()["currsize"] == 1
+
+    for i, name in enumerate(["alice", "o brien", "x" * 100, "--", "é€"]):
+        assert not has_sqli(template.format(name, i * 1000))
+    info = verdict_cache_info()
+    assert info["hits"] == 5 and info["misses"] == 1
+    assert info["hit_rate"] == 5 / 6
+
+    # contents which could end the string are checked by lexing the query
+    assert has_sqli(template.format("' OR 1=1 --", 1))
+    assert has_sqli(template.format("bobby", "1 OR 1=1"))
+    assert verdict_cache_info()["hits"] == 5
+
+
+def test_verdict_cache_is_bounded(empty_verdict_cache):
+    set_verdict_cache_size(10)
+    for i in range(50):
+        template = safe_string._new_trusted("SELECT * FROM t{} WHERE name = '{{}}'".format(i))
+        assert not has_sqli(template.format("bobby"))
+    assert verdict_cache_info()["currsize"] == 10
+
+    set_verdict_cache_size(0)
+    verdict_cache_clear()
+    assert not has_sqli(template.format("bobby"))
+    assert verdict_cache_info()["currsize"] == 0
+
+
+def test_verdict_cache_never_hides_sqli(empty_verdict_cache, monkeypatch):
+    alphabet = "ab1 '\"\\`´$*/-#;[]()=\n"
+    templates = TEMPLATES + [
+        "SELECT [x '{}' ] FROM t",
+        "SELECT * FROM t WHERE a = '{}' /* '{}' */ AND b = -{}",
+        "SELECT $x$ {} $x$, \"{}\", `{}`",
+    ]
+    for dialect in ("generic", "sqlite", "postgres", "mysql"):
+        for template in templates:
+            template = safe_string._new_trusted(template)
+            values = ["bobby", "1", "12", "a b"] + ["".join(random.choices(alphabet, k=random.randint(1, 6)))
+                                                  for _ in range(100)]
+            for _ in range(200):
+                query = template.format(*random.choices(values, k=3))
+                cached = has_sqli(query, dialect)
+                with monkeypatch.context() as m:
+                    m.setattr(safe_sql, "verdict_cache_size", 0)
+                    assert cached == has_sqli(query, dialect)
+    assert verdict_cache_info()["hits"] > 0
@@ -1,7 +1,9 @@
 import string
+import operator
 
 
-from safe_string.safe_string import safe_string
+from safe_string.safe_string import safe_string, Builder
+from safe_string.trust import TrustMap
 from string import printable
 import random
 from bitarray import bitarray, frozenbitarray
@@ -141,7 +143,7 @@ def test_safe_string_format():
 
 def test_getitem():
     def make_array(item):
-        if isinstance(item, frozenbitarray):
+        if isinstance(item, (frozenbitarray, TrustMap)):
             return item
         else:
             return frozenbitarray([item])
@@ -190,6 +192,28 @@ def test_repr_same_length():
             assert False
 
 
+def test_repr_trusted_matches_each_char():
+    chars = "ab '\"\\\n\t\x00\x7f\xe9\xff\u2028\u20ac\U0001f600"
+    for _ in range(200):
+        unsafe = "".join(random.choices(chars, k=random.randint(0, 30)))
+        trusted = random.choice([
+            gen_random_trusted(len(unsafe)),
+            frozenbitarray([True] * len(unsafe)),
+            frozenbitarray([idx // 4 % 2 == 0 for idx in range(len(unsafe))]),
+        ])
+        safe_repr = repr(safe_string(unsafe, trusted))
+        assert safe_repr == repr(unsafe)
+
+        # each char gets the trust of the char it was escaped from
+        quote = repr(unsafe)[0]
+        expected = [False]
+        for char, trust_bit in zip(unsafe, trusted):
+            len_repr = 2 if char == quote else len(repr(char)) - 2
+            expected.extend([trust_bit] * len_repr)
+        expected.append(False)
+        assert safe_repr._trusted == TrustMap.from_bits(expected)
+
+
 def test_add():
     for _ in range(10):
         first = gen_random_safe_string(50)
@@ -220,6 +244,47 @@ def test_replace():
     assert safe.replace(old_str2, new_str)._trusted == safe._trusted
 
 
+def test_replace_trusted_matches_each_replacement():
+    def expected_trusted(unsafe, trusted, old, new_trusted, count):
+        bits = []
+        num_replaced = 0
+        i = 0
+        while i <= len(unsafe):
+            if (count < 0 or num_replaced < count) and unsafe.startswith(old, i):
+                bits.extend(new_trusted)
+                num_replaced += 1
+                if old:
+                    i += len(old)
+                    continue
+            if i < len(unsafe):
+                bits.append(trusted[i])
+            i += 1
+        return frozenbitarray(bits)
+
+    for _ in range(200):
+        unsafe = "".join(random.choices("ab", k=random.randint(0, 12)))
+        old = "".join(random.choices("ab", k=random.randint(0, 2)))
+        new = "".join(random.choices("xy", k=random.randint(0, 3)))
+        count = random.randint(-1, 4)
+
+        safe = random.choice([
+            gen_random_safe_from_unsafe(unsafe),
+            safe_string._new_trusted(unsafe),
+            safe_string._new_untrusted(unsafe),
+        ])
+        safe_new = random.choice([
+            gen_random_safe_from_unsafe(new),
+            safe_string._new_trusted(new),
+            new,
+        ])
+        new_trusted = safe_new._trusted if isinstance(safe_new, safe_string) \
+            else [False] * len(new)
+
+        replaced = safe.replace(old, safe_new, count)
+        assert replaced == unsafe.replace(old, new, count)
+        assert replaced._trusted == expected_trusted(unsafe, safe._trusted, old, new_trusted, count)
+
+
 def test_count():
     unsafe = "abABabAB"
     unsafe_old1 = "AB"
@@ -533,6 +598,71 @@ def test_join():
             assert len(unsafe_join) == len(safe_join._trusted)
 
 
+def test_join_with_separators_and_mixed_elements():
+    for sep in ("", ",", "\n", "abcd", "\t"):
+        for _ in range(10):
+            safe_sep = gen_random_safe_from_unsafe(sep)
+            elems = [
+                gen_random_safe_string(random.randint(0, 10)) if random.random() < 0.5
+                else gen_random_string(random.randint(0, 10))
+                for _ in range(random.randint(0, 10))
+            ]
+
+            expected_trusted = bitarray()
+            for i, elem in enumerate(elems):
+                if i:
+                    expected_trusted += safe_sep._trusted
+                if isinstance(elem, safe_string):
+                    expected_trusted += elem._trusted
+                else:
+                    expected_trusted += frozenbitarray([False] * len(elem))
+
+            for iterable in (elems, tuple(elems), (elem for elem in elems)):
+                safe_join = safe_sep.join(iterable)
+                assert isinstance(safe_join, safe_string)
+                assert safe_join == sep.join(elems)
+                assert safe_join._trusted == expected_trusted
+
+    with pytest.raises(TypeError):
+        safe_string._new_trusted(",").join(["a", 1])
+
+
+def test_builder():
+    for _ in range(20):
+        builder = Builder()
+        expected = safe_string("")
+        for _ in range(random.randint(0, 20)):
+            piece = gen_random_string(random.randint(0, 5))
+            method = random.choice(["append", "append_safe", "append_trusted",
+                                    "append_untrusted", "extend"])
+            if method == "append":
+                builder.append(piece)
+                expected += piece
+            elif method == "append_safe":
+                safe_piece = gen_random_safe_from_unsafe(piece)
+                builder.append(safe_piece)
+                expected += safe_piece
+            elif method == "append_trusted":
+                builder.append_trusted(piece)
+                expected += safe_string._new_trusted(piece)
+            elif method == "append_untrusted":
+                builder.append_untrusted(gen_random_safe_from_unsafe(piece))
+                expected += safe_string._new_untrusted(piece)
+            else:
+                safe_piece = gen_random_safe_from_unsafe(piece)
+                builder.extend([piece, safe_piece])
+                expected += piece + safe_piece
+            assert len(builder) == len(expected)
+
+        built = builder.build()
+        assert isinstance(built, safe_string)
+        assert built == expected
+        assert built._trusted == expected._trusted
+
+    with pytest.raises(TypeError):
+        Builder().append(1)
+
+
 def test_splitlines():
     unsafe = gen_random_string(20)
     trusted = gen_random_trusted(20)
@@ -581,7 +711,61 @@ def test_splitlines():
             start += len(unsafe_slice)+1
 
 
+def test_splitlines_trusted_matches_line_offsets():
+    boundaries = ["\n", "\r", "\r\n", "\v", "\f", "\x1c", "\x1d", "\x1e",
+                  "\x85", "\u2028", "\u2029"]
+    for _ in range(50):
+        unsafe = "".join(
+            random.choice(boundaries) if random.random() < 0.3 else gen_random_string(3)
+            for _ in range(random.randint(0, 20))
+        )
+        safe = gen_random_safe_from_unsafe(unsafe)
+
+        start = 0
+        for line, line_with_end in zip(safe.splitlines(), safe.splitlines(keepends=True)):
+            assert line._trusted == safe._trusted[start:start + len(line)]
+            assert line_with_end._trusted == safe._trusted[start:start + len(line_with_end)]
+            start += len(line_with_end)
+
+        assert safe.splitlines() == unsafe.splitlines()
+        assert safe.splitlines(keepends=True) == unsafe.splitlines(keepends=True)
+        assert start == len(unsafe)
+
+
 def test_adding_str_to_safe_string_returns_safe_string():
     unsafe = gen_random_string(20)
     safe = gen_random_safe_string(20)
     assert isinstance(unsafe + safe, safe_string)
+
+
+def test_mixed_add_trust():
+    unsafe = gen_random_string(20)
+    safe = gen_random_safe_string(30)
+    untrusted = frozenbitarray([False] * len(unsafe))
+    for sum_, expected, trusted in [
+        (unsafe + safe, unsafe + safe._to_unsafe_str(), untrusted + safe._trusted),
+        (operator.add(unsafe, safe), unsafe + safe._to_unsafe_str(), untrusted + safe._trusted),
+        (safe + unsafe, safe._to_unsafe_str() + unsafe, safe._trusted + untrusted),
+    ]:
+        assert isinstance(sum_, safe_string)
+        assert sum_._to_unsafe_str() == expected
+        assert sum_._trusted == trusted
+
+
+def test_plain_add_returns_plain_str():
+    class Sub(str):
+        pass
+
+    for left, right in [("ab", "cd"), (Sub("ab"), "cd"), ("ab", Sub("cd")), ("", "cd"), ("ab", "")]:
+        for sum_ in (left + right, operator.add(left, right)):
+            assert sum_ == str.__str__(left) + str.__str__(right)
+            assert type(sum_) is str
+
+
+def test_add_errors_are_raised():
+    with pytest.raises(TypeError, match="can only concatenate str"):
+        "ab" + 1
+    with pytest.raises(TypeError, match="can only concatenate list"):
+        [1] + "ab"
+    with pytest.raises(TypeError):
+        safe_string._new_trusted("ab") + 1
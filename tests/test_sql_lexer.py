@@ -0,0 +1,107 @@
+import pytest
+
+from safe_string.sql_lexer import (
+    tokenize, GENERIC, SQLITE, POSTGRES, MYSQL,
+    WHITESPACE, COMMENT, STRING, NUMBER, IDENTIFIER, QUOTED_IDENTIFIER,
+    PLACEHOLDER, OPERATOR, PUNCTUATION, ERROR,
+)
+
+DIALECTS = [GENERIC, SQLITE, POSTGRES, MYSQL]
+
+
+def tokens(query, dialect=GENERIC):
+    return [(ttype, query[start:end]) for ttype, start, end in tokenize(query, dialect)]
+
+
+def significant(query, dialect=GENERIC):
+    return [token for token in tokens(query, dialect) if token[0] != WHITESPACE]
+
+
+@pytest.mark.parametrize("dialect", DIALECTS)
+def test_tokens_cover_query(dialect):
+    queries = [
+        "",
+        "SELECT * FROM people WHERE name = 'bobby' AND id = -12.5e3; -- done",
+        "SELECT \"a\"\"b\", `c`, [d] FROM t /* comment */ WHERE x <> ? OR y LIKE '%\\'%'",
+        "INSERT INTO t VALUES ($1, :name, %(name)s, %s, X'00ff', $tag$ ' $tag$)",
+        "' unbalanced \" quotes ` and /* comments",
+        "\x00é€{}\\",
+    ]
+    for query in queries:
+        pos = 0
+        for ttype, start, end in tokenize(query, dialect):
+            assert start == pos and end > start
+            pos = end
+        assert pos == len(query)
+
+
+def test_unknown_dialect():
+    with pytest.raises(ValueError):
+        list(tokenize("SELECT 1", "oracle"))
+
+
+def test_common_tokens():
+    for dialect in DIALECTS:
+        assert significant("SELECT name, 12 FROM people WHERE id >= 1.5;", dialect) == [
+            (IDENTIFIER, "SELECT"), (IDENTIFIER, "name"), (PUNCTUATION, ","),
+            (NUMBER, "12"), (IDENTIFIER, "FROM"), (IDENTIFIER, "people"),
+            (IDENTIFIER, "WHERE"), (IDENTIFIER, "id"), (OPERATOR, ">="),
+            (NUMBER, "1.5"), (PUNCTUATION, ";"),
+        ]
+        assert significant("a = 'it''s' -- comment", dialect)[-2:] == [
+            (STRING, "'it''s'"), (COMMENT, "-- comment"),
+        ]
+    for dialect in (GENERIC, SQLITE, MYSQL):
+        assert significant("/* x */ `y`", dialect) == [
+            (COMMENT, "/* x */"), (QUOTED_IDENTIFIER, "`y`"),
+        ]
+
+
+def test_generic_dialect():
+    assert significant('"name"') == [(STRING, '"name"')]
+    assert significant("'\\' OR 1=1 --'") == [(STRING, "'\\' OR 1=1 --'")]
+    assert significant("-5") == [(NUMBER, "-5")]
+    assert significant("ORDER  BY") == [(IDENTIFIER, "ORDER  BY")]
+    assert significant("$a$ it's $a$") == [(STRING, "$a$ it's $a$")]
+    assert significant("# note") == [(COMMENT, "# note")]
+
+
+def test_sqlite_dialect():
+    assert significant('"name" [other]', SQLITE) == [
+        (QUOTED_IDENTIFIER, '"name"'), (QUOTED_IDENTIFIER, "[other]"),
+    ]
+    # no backslash escapes
+    assert significant("'\\' OR 1=1", SQLITE)[:2] == [(STRING, "'\\'"), (IDENTIFIER, "OR")]
+    assert significant("x'00ff' ?1 :name", SQLITE) == [
+        (STRING, "x'00ff'"), (PLACEHOLDER, "?1"), (PLACEHOLDER, ":name"),
+    ]
+    assert significant("/* unterminated", SQLITE) == [(COMMENT, "/* unterminated")]
+
+
+def test_postgres_dialect():
+    assert significant('"name"', POSTGRES) == [(QUOTED_IDENTIFIER, '"name"')]
+    assert significant("'\\' OR 1=1", POSTGRES)[:2] == [(STRING, "'\\'"), (IDENTIFIER, "OR")]
+    assert significant("E'\\' OR 1=1'", POSTGRES) == [(STRING, "E'\\' OR 1=1'")]
+    assert significant("$$ it's $$ $tag$ x $tag$ $1", POSTGRES) == [
+        (STRING, "$$ it's $$"), (STRING, "$tag$ x $tag$"), (PLACEHOLDER, "$1"),
+    ]
+    assert significant("x::int", POSTGRES) == [
+        (IDENTIFIER, "x"), (PUNCTUATION, "::"), (IDENTIFIER, "int"),
+    ]
+
+
+def test_mysql_dialect():
+    assert significant('"name"', MYSQL) == [(STRING, '"name"')]
+    assert significant("'\\' OR 1=1'", MYSQL) == [(STRING, "'\\' OR 1=1'")]
+    assert significant("# note\n1", MYSQL) == [(COMMENT, "# note"), (NUMBER, "1")]
+    # "--" only starts a comment when followed by whitespace
+    assert significant("1--1", MYSQL) == [(NUMBER, "1"), (OPERATOR, "-"), (NUMBER, "-1")]
+    assert significant("1 -- x", MYSQL) == [(NUMBER, "1"), (COMMENT, "-- x")]
+    assert significant("@@version @x", MYSQL) == [
+        (IDENTIFIER, "@@version"), (IDENTIFIER, "@x"),
+    ]
+
+
+def test_error_tokens():
+    assert tokens("{", GENERIC) == [(ERROR, "{")]
+    assert all(ttype == ERROR for ttype, _ in tokens("{}", SQLITE))
@@ -0,0 +1,144 @@
+from safe_string.trust import TrustMap
+from bitarray import bitarray, frozenbitarray
+import random
+
+
+def gen_random_trusted(length):
+    return frozenbitarray(random.choices([True, False], k=length))
+
+
+def gen_random_runs(length):
+    # long runs of the same value, more realistic than independent bits
+    bits = bitarray()
+    while len(bits) < length:
+        bits.extend([random.choice([True, False])] * random.randint(1, 10))
+    return frozenbitarray(bits[:length])
+
+
+def test_from_bits_round_trips():
+    for length in range(50):
+        for gen in (gen_random_trusted, gen_random_runs):
+            bits = gen(length)
+            trust = TrustMap.from_bits(bits)
+            assert len(trust) == length
+            assert trust == bits
+            assert frozenbitarray(trust) == bits
+            assert trust.to01() == bits.to01()
+            assert TrustMap.from_bits(list(bits)) == trust
+
+
+def test_uniform_maps_are_compact():
+    assert TrustMap.trusted(1000)._bounds == (0, 1000)
+    assert TrustMap.untrusted(1000)._bounds == ()
+    assert TrustMap.from_bits(frozenbitarray([True] * 1000)) == TrustMap.trusted(1000)
+    assert TrustMap.from_bits(frozenbitarray([False] * 1000)) == TrustMap.untrusted(1000)
+
+    assert (TrustMap.trusted(5) + TrustMap.trusted(7))._bounds == (0, 12)
+    assert (TrustMap.untrusted(5) + TrustMap.untrusted(7))._bounds == ()
+    assert (TrustMap.trusted(5) * 10)._bounds == (0, 50)
+
+
+def test_indexing():
+    bits = gen_random_runs(100)
+    trust = TrustMap.from_bits(bits)
+    for i in range(-100, 100):
+        assert trust[i] == bits[i]
+
+    for i in (-101, 100, 1000):
+        try:
+            trust[i]
+        except IndexError:
+            pass
+        else:
+            assert False
+
+
+def test_slicing():
+    length = 60
+    for gen in (gen_random_trusted, gen_random_runs):
+        bits = gen(length)
+        trust = TrustMap.from_bits(bits)
+        for i in range(-(length + 5), length + 5):
+            for j in range(-(length + 5), length + 5):
+                assert trust[i:j] == bits[i:j]
+            for step in (-3, -1, 2, 5):
+                assert trust[i::step] == bits[i::step]
+
+
+def test_add_and_mul():
+    for _ in range(50):
+        first = gen_random_runs(random.randint(0, 30))
+        second = gen_random_runs(random.randint(0, 30))
+        assert TrustMap.from_bits(first) + TrustMap.from_bits(second) == first + second
+        assert TrustMap.from_bits(first) + second == first + second
+        assert first + TrustMap.from_bits(second) == first + second
+        assert TrustMap.from_bits(first) + list(second) == first + second
+
+        n = random.randint(-1, 5)
+        assert TrustMap.from_bits(first) * n == first * n
+        assert n * TrustMap.from_bits(first) == n * first
+
+        before, after = random.randint(0, 5), random.randint(0, 5)
+        padded = bitarray(before) + first + bitarray(after)
+        padded[:before] = padded[len(padded) - after:] = False
+        assert TrustMap.from_bits(first).padded(before, after) == padded
+
+
+def test_mul_is_linear():
+    # used to add the copies one by one, copying the bounds every time
+    trust = TrustMap.from_bits([True, False]) * 200_000
+    assert len(trust) == 400_000
+    assert len(trust._bounds) == 400_000
+    assert trust[:6] == [True, False] * 3
+    assert trust[-2:] == [True, False]
+    assert TrustMap.from_bits([False, True, True, False]) * 3 == bitarray("0110" * 3)
+    assert TrustMap.from_bits([True, False, True]) * 3 == bitarray("101" * 3)
+
+
+def test_all_any_count():
+    for _ in range(50):
+        bits = gen_random_runs(random.randint(0, 30))
+        trust = TrustMap.from_bits(bits)
+        assert trust.all() == bits.all()
+        assert trust.any() == bits.any()
+        assert trust.count() == bits.count(True)
+        assert trust.count(False) == bits.count(False)
+
+
+def test_find_and_rfind():
+    for _ in range(50):
+        bits = gen_random_runs(random.randint(0, 30))
+        trust = TrustMap.from_bits(bits)
+        for value in (True, False):
+            for start in range(-2, len(bits) + 2):
+                for stop in range(-2, len(bits) + 2):
+                    indices = range(len(bits))[start:stop]
+                    matches = [i for i in indices if bits[i] == value]
+                    assert trust.find(value, start, stop) == (matches[0] if matches else -1)
+                    assert trust.rfind(value, start, stop) == (matches[-1] if matches else -1)
+            assert trust.find(value) == bits.find(value)
+
+
+def test_lazy_slices():
+    bits = frozenbitarray([i // 3 % 2 == 0 for i in range(3000)])
+    trust = TrustMap.from_bits(bits)
+
+    view = trust[1:-1]
+    assert type(view) is not TrustMap and view._parent_bounds is trust._bounds
+    assert not view.all() and view.any()
+    assert view[100:2000] == bits[101:2001]
+    assert view._parent_bounds is not None
+
+    assert view == bits[1:-1]
+    assert view._parent_bounds is None
+    assert view.count() == bits[1:-1].count()
+
+    # small slices of large maps are copied, not to keep the parent alive
+    assert type(trust[10:100]) is TrustMap
+    assert trust[10:100] == bits[10:100]
+
+    for start, stop in [(0, 3000), (5, 2995), (1500, 3000), (0, 1000)]:
+        for outer in (trust[start:stop], TrustMap.from_bits(bits[start:stop])):
+            assert outer.all() == bits[start:stop].all()
+            assert outer.any() == bits[start:stop].any()
+            assert outer + trust[:1] == bits[start:stop] + bits[:1]